@@ -0,0 +1,620 @@
+from __future__ import print_function
+import gc
+import io
+import time
+import timeit
+import tracemalloc
+
+import ramen
+from ramen.core import compile
+from ramen.core import evaluate
+from ramen.core import history
+from ramen.core import instanced
+from ramen.core import patch
+from ramen.core import reachability
+from ramen.core import serialize
+from ramen.core import signal
+
+# Quick micro-benchmarks for the core -- run with `python benchmark.py`
+
+
+def report(name, count, seconds, unit):
+    print('%-40s %12.0f %s/sec' % (name, count / seconds, unit))
+
+
+# Signal.emit
+# The "legacy" signal introspects every slot on every emit, which is how
+# Signal.emit worked before call plans were built at connect time.
+class LegacySignal(signal.Signal):
+    def emit(self, *args, **kwargs):
+        for slot, plan in list(self._slots.items()):
+            conn_args, conn_kwargs = plan[:2]
+            full_args = list(conn_args)
+            full_args.extend(args)
+
+            full_kwargs = dict(conn_kwargs)
+            full_kwargs.update(kwargs)
+            argspec = signal._getargspec(slot)
+            if not getattr(argspec, 'varkw', getattr(argspec, 'keywords',
+                                                      None)):
+                for key in list(full_kwargs.keys()):
+                    if key not in argspec.args:
+                        del full_kwargs[key]
+
+            slot(*full_args, **full_kwargs)
+
+
+class Receiver(object):
+    def pos_slot(self, node, pos):
+        pass
+
+    def no_arg_slot(self):
+        pass
+
+    def kwargs_slot(self, **kwargs):
+        pass
+
+
+def bench_emit(signal_cls, num_slots, number):
+    sig = signal_cls()
+    for i in range(num_slots):
+        receiver = Receiver()
+        # mix of filtered, connection-time and **kwargs slots
+        slot_type = i % 3
+        if slot_type == 0:
+            sig.connect(receiver.pos_slot, node=receiver)
+        elif slot_type == 1:
+            sig.connect(receiver.no_arg_slot)
+        else:
+            sig.connect(receiver.kwargs_slot)
+    return timeit.timeit(lambda: sig.emit(pos=(0, 0)), number=number)
+
+
+print('Signal.emit')
+for num_slots in (1, 10, 100):
+    number = 100000 // num_slots
+    for signal_cls in (LegacySignal, signal.Signal):
+        seconds = bench_emit(signal_cls, num_slots, number)
+        report('  %s, %d slots' % (signal_cls.__name__, num_slots),
+               number, seconds, 'emits')
+
+
+# Node creation
+def bench_create_node(num_nodes):
+    graph = ramen.Graph()
+    graph.root_node
+    return timeit.timeit(
+        lambda: [graph.create_node(label='node') for i in range(num_nodes)],
+        number=1)
+
+
+def bench_create_nodes(num_nodes):
+    graph = ramen.Graph()
+    graph.root_node
+    specs = [('node', None, 0, None) for i in range(num_nodes)]
+    return timeit.timeit(lambda: graph.create_nodes(specs), number=1)
+
+
+print('Node creation')
+for num_nodes in (1000, 5000):
+    report('  create_node, %d nodes' % num_nodes, num_nodes,
+           bench_create_node(num_nodes), 'nodes')
+    report('  create_nodes, %d nodes' % num_nodes, num_nodes,
+           bench_create_nodes(num_nodes), 'nodes')
+
+
+# Saving and loading
+def make_chain_graph(num_nodes):
+    graph = ramen.Graph()
+    new_nodes = graph.create_nodes(
+        [('node', None, 0, None) for i in range(num_nodes)])
+    prev_out = None
+    for new_node in new_nodes:
+        sink = new_node.create_parameter('in', parameter_id='in', sink=True)
+        source = new_node.create_parameter('out', parameter_id='out',
+                                           source=True)
+        if prev_out is not None:
+            prev_out.connect(sink)
+        prev_out = source
+    return graph
+
+
+print('Saving and loading')
+for num_nodes in (1000, 5000):
+    graph = make_chain_graph(num_nodes)
+    for binary in (False, True):
+        name = 'binary' if binary else 'JSON lines'
+        stream = io.BytesIO()
+        seconds = timeit.timeit(
+            lambda: serialize.write(graph, stream, binary=binary), number=1)
+        report('  save %s, %d nodes' % (name, num_nodes), num_nodes, seconds,
+               'nodes')
+        stream.seek(0)
+        seconds = timeit.timeit(lambda: serialize.read(stream), number=1)
+        report('  load %s, %d nodes' % (name, num_nodes), num_nodes, seconds,
+               'nodes')
+
+
+# Memory
+# The "legacy" layout is how nodes and parameters were laid out before
+# __slots__ and LazySignals: every instance (signals included) has a
+# __dict__, and every signal is created up front and connected to the one
+# it lofts to.
+class DictSignal(signal.Signal):
+    pass
+
+
+def lofted_slot(**kwargs):
+    pass
+
+
+def create_signals(obj):
+    for cls in type(obj).__mro__:
+        for attr in vars(cls).values():
+            if isinstance(attr, signal.LazySignal):
+                sig = DictSignal()
+                sig.connect(lofted_slot, sender=obj)
+                setattr(obj, attr.slot, sig)
+
+
+class LegacyNode(ramen.node.Node):
+    def __init__(self, *args, **kwargs):
+        super(LegacyNode, self).__init__(*args, **kwargs)
+        create_signals(self)
+
+    def create_parameter(self, *args, **kwargs):
+        kwargs['node'] = self
+        kwargs['parent'] = self.root_parameter
+        return LegacyParameter(*args, **kwargs)
+
+
+class LegacyParameter(ramen.node.Parameter):
+    def __init__(self, *args, **kwargs):
+        super(LegacyParameter, self).__init__(*args, **kwargs)
+        create_signals(self)
+
+
+def bench_memory(node_cls, num_nodes, num_params):
+    '''Bytes allocated per node and per parameter'''
+    graph = ramen.Graph()
+    graph.root_node
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    new_nodes = [node_cls(graph=graph, label='node')
+                 for i in range(num_nodes)]
+    after_nodes = tracemalloc.get_traced_memory()[0]
+    for new_node in new_nodes:
+        for i in range(num_params):
+            new_node.create_parameter('param', parameter_id=i, sink=True)
+    after_params = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return ((after_nodes - start) / float(num_nodes),
+            (after_params - after_nodes) / float(num_nodes * num_params))
+
+
+print('Memory')
+for node_cls in (LegacyNode, ramen.node.Node):
+    node_bytes, param_bytes = bench_memory(node_cls, 2000, 10)
+    print('  %-38s %12.0f bytes' % ('%s, per node' % node_cls.__name__,
+                                    node_bytes))
+    print('  %-38s %12.0f bytes' % ('%s, per parameter' % node_cls.__name__,
+                                    param_bytes))
+
+
+# Teardown
+def bench_teardown(num_nodes):
+    '''Seconds to free a chain graph by dropping it, and how many objects
+    were left for the cyclic garbage collector'''
+    graph = make_chain_graph(num_nodes)
+    gc.collect()
+    gc.disable()
+    start = time.time()
+    del graph
+    seconds = time.time() - start
+    uncollected = gc.collect()
+    gc.enable()
+    return seconds, uncollected
+
+
+print('Teardown')
+for num_nodes in (10000, 100000):
+    seconds, uncollected = bench_teardown(num_nodes)
+    report('  free by refcount, %d nodes' % num_nodes, num_nodes, seconds,
+           'nodes')
+    print('  %-38s %12d objects' % ('  left for the cyclic gc',
+                                        uncollected))
+
+
+# Undo/redo
+def bench_history(num_nodes, num_edits):
+    '''Bytes per undo step of moving a node, and seconds to undo and redo
+    them all'''
+    graph = make_chain_graph(num_nodes)
+    graph_history = history.History(graph)
+    nodes = list(graph.nodes)
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    for i in range(num_edits):
+        nodes[i % num_nodes].pos = (i, i)
+        graph_history.commit()
+    step_bytes = (tracemalloc.get_traced_memory()[0] - start) / float(
+        num_edits)
+    tracemalloc.stop()
+    start = time.time()
+    while graph_history.undo():
+        pass
+    while graph_history.redo():
+        pass
+    return step_bytes, time.time() - start
+
+
+print('Undo/redo')
+for num_nodes in (1000, 100000):
+    step_bytes, seconds = bench_history(num_nodes, 10000)
+    print('  %-38s %12.0f bytes' % ('per step, %d nodes' % num_nodes,
+                                     step_bytes))
+    report('  undo and redo, %d nodes' % num_nodes, 20000, seconds, 'steps')
+
+
+# Diffing and patching
+def bench_patch(num_nodes, num_edits):
+    '''Seconds to diff an edited copy of a graph and patch the original,
+    the seconds to apply the patch alone, and the seconds to rebuild the
+    original from the copy instead'''
+    graph = make_chain_graph(num_nodes)
+    stream = io.BytesIO()
+    serialize.write(graph, stream, binary=True)
+    stream.seek(0)
+    edited = serialize.read(stream)
+    nodes = [edited_node for edited_node in edited.nodes
+             if edited_node is not edited.root_node]
+    for i in range(num_edits):
+        nodes[i * 7 % len(nodes)].pos = (i, i)
+        nodes[i * 13 % len(nodes)].label = 'edited %d' % i
+    start = time.time()
+    edits = patch.diff(graph, edited)
+    diff_seconds = time.time() - start
+    start = time.time()
+    patch.apply_patch(graph, edits)
+    apply_seconds = time.time() - start
+    stream = io.BytesIO()
+    start = time.time()
+    serialize.write(edited, stream, binary=True)
+    stream.seek(0)
+    serialize.read(stream)
+    rebuild_seconds = time.time() - start
+    return diff_seconds, apply_seconds, rebuild_seconds
+
+
+print('Diffing and patching')
+for num_nodes in (10000, 50000):
+    diff_seconds, apply_seconds, rebuild_seconds = bench_patch(num_nodes,
+                                                               300)
+    print('  %-38s %12.3f sec' % ('diff, %d nodes' % num_nodes,
+                                  diff_seconds))
+    print('  %-38s %12.3f sec' % ('apply 600 edits, %d nodes' % num_nodes,
+                                  apply_seconds))
+    print('  %-38s %12.3f sec' % ('rebuild, %d nodes' % num_nodes,
+                                  rebuild_seconds))
+
+
+# Snapshots and forks
+def bench_snapshot(num_nodes, num_variants):
+    '''Seconds for the first snapshot of a chain graph, and for the next one
+    after 10 edits; then per variant, seconds and bytes to fork the graph
+    with one value changed, against seconds to copy the graph instead'''
+    graph = make_chain_graph(num_nodes)
+    nodes = list(graph.nodes)
+    start = time.time()
+    graph.snapshot()
+    first_seconds = time.time() - start
+    for i in range(10):
+        nodes[i * 97 % num_nodes].pos = (i, i)
+    start = time.time()
+    base = graph.snapshot()
+    next_seconds = time.time() - start
+    node_id = nodes[-1].node_id
+    variants = []
+    tracemalloc.start()
+    start_bytes = tracemalloc.get_traced_memory()[0]
+    start = time.time()
+    for i in range(num_variants):
+        variant = base.fork()
+        variant.set_value((node_id, 'in', False), i)
+        variants.append(variant.snapshot())
+    fork_seconds = (time.time() - start) / num_variants
+    fork_bytes = (tracemalloc.get_traced_memory()[0] - start_bytes) / float(
+        num_variants)
+    tracemalloc.stop()
+    start = time.time()
+    stream = io.BytesIO()
+    serialize.write(graph, stream, binary=True)
+    stream.seek(0)
+    serialize.read(stream)
+    copy_seconds = time.time() - start
+    return first_seconds, next_seconds, fork_seconds, fork_bytes, copy_seconds
+
+
+print('Snapshots and forks')
+for num_nodes in (10000, 100000):
+    (first_seconds, next_seconds, fork_seconds, fork_bytes,
+     copy_seconds) = bench_snapshot(num_nodes, 100)
+    print('  %-38s %12.4f sec' % ('first snapshot, %d nodes' % num_nodes,
+                                  first_seconds))
+    print('  %-38s %12.4f sec' % ('snapshot after 10 edits', next_seconds))
+    print('  %-38s %12.4f sec' % ('fork with one change', fork_seconds))
+    print('  %-38s %12.0f bytes' % ('per fork', fork_bytes))
+    print('  %-38s %12.4f sec' % ('copy of the graph', copy_seconds))
+
+
+# Freezing
+def bench_freeze(num_nodes):
+    '''Seconds to freeze a chain graph and build its flow index, then to
+    find where values flow from every source parameter in the frozen
+    graph and in the object graph, and to count every parameter's fan
+    in'''
+    graph = make_chain_graph(num_nodes)
+    start = time.time()
+    frozen = graph.freeze()
+    freeze_seconds = time.time() - start
+    start = time.time()
+    frozen.flow()
+    flow_seconds = time.time() - start
+    sources = [param for cur_node in graph.nodes
+               for param in cur_node.parameters if param.source]
+    start = time.time()
+    frozen.reachable([frozen.index(param) for param in sources])
+    frozen_seconds = time.time() - start
+    start = time.time()
+    seen = set(sources)
+    frontier = sources
+    while frontier:
+        frontier = [succ for param in frontier
+                    for succ in reachability.successors(param)
+                    if succ not in seen]
+        seen.update(frontier)
+    object_seconds = time.time() - start
+    start = time.time()
+    frozen.fan_in()
+    fan_in_seconds = time.time() - start
+    return (freeze_seconds, flow_seconds, frozen_seconds, object_seconds,
+            fan_in_seconds)
+
+
+print('Freezing')
+for num_nodes in (10000, 100000):
+    (freeze_seconds, flow_seconds, frozen_seconds, object_seconds,
+     fan_in_seconds) = bench_freeze(num_nodes)
+    print('  %-38s %12.3f sec' % ('freeze, %d nodes' % num_nodes,
+                                  freeze_seconds))
+    print('  %-38s %12.3f sec' % ('flow index', flow_seconds))
+    print('  %-38s %12.3f sec' % ('reachable from sources, frozen',
+                                  frozen_seconds))
+    print('  %-38s %12.3f sec' % ('reachable from sources, objects',
+                                  object_seconds))
+    print('  %-38s %12.3f sec' % ('fan in, frozen', fan_in_seconds))
+
+
+# Lofting
+def bench_deep_connect(depth, num_connections):
+    '''Seconds to connect num_connections nodes at the bottom of a
+    hierarchy depth subgraphs deep to a node at the top'''
+    graph = ramen.Graph()
+    subgraph = graph.root_node
+    for i in range(depth):
+        subgraph = ramen.node.SubgraphNode(parent=subgraph)
+    top_in = graph.create_node().create_parameter('in', sink=True)
+    sources = [ramen.node.Node(parent=subgraph).create_parameter(
+        'out', source=True) for i in range(num_connections)]
+    start = time.time()
+    for source in sources:
+        source.connect(top_in)
+    return time.time() - start
+
+
+def bench_deep_fan_out(depth, num_connections):
+    '''Seconds to connect a node at the bottom of a hierarchy depth
+    subgraphs deep to num_connections nodes at the top, which reuses the
+    parameters lofted for the first connection'''
+    graph = ramen.Graph()
+    subgraph = graph.root_node
+    for i in range(depth):
+        subgraph = ramen.node.SubgraphNode(parent=subgraph)
+    source = ramen.node.Node(parent=subgraph).create_parameter(
+        'out', source=True)
+    sinks = [graph.create_node().create_parameter('in', sink=True)
+             for i in range(num_connections)]
+    start = time.time()
+    for sink in sinks:
+        source.connect(sink)
+    return time.time() - start
+
+
+print('Lofting')
+for depth in (10, 100, 500):
+    report('  connect across %d subgraphs' % depth, 100,
+           bench_deep_connect(depth, 100), 'connections')
+for depth in (10, 100, 500):
+    report('  fan out across %d subgraphs' % depth, 100,
+           bench_deep_fan_out(depth, 100), 'connections')
+
+
+# Bulk connecting
+def make_rig(depth, num_sources, num_sinks):
+    '''Sources at the bottom of a hierarchy depth subgraphs deep, and sinks
+    at the top'''
+    graph = ramen.Graph()
+    subgraph = graph.root_node
+    for i in range(depth):
+        subgraph = ramen.node.SubgraphNode(parent=subgraph)
+    sources = [ramen.node.Node(parent=subgraph).create_parameter(
+        'out', source=True) for i in range(num_sources)]
+    sinks = [graph.create_node().create_parameter('in', sink=True)
+             for i in range(num_sinks)]
+    return graph, [(source, sink) for source in sources for sink in sinks]
+
+
+def bench_connect_many(depth, num_sources, num_sinks, bulk):
+    graph, pairs = make_rig(depth, num_sources, num_sinks)
+    start = time.time()
+    if bulk:
+        graph.connect_many(pairs)
+    else:
+        for source, sink in pairs:
+            source.connect(sink)
+    return time.time() - start
+
+
+print('Bulk connecting')
+for depth in (1, 10, 50):
+    for bulk in (False, True):
+        report('  %s, %d subgraphs deep' % (
+            'connect_many' if bulk else 'connect', depth), 5000,
+            bench_connect_many(depth, 50, 100, bulk), 'connections')
+
+
+# Flattening
+def make_nested(depth, num_nodes):
+    '''num_nodes producers depth subgraphs deep, each feeding a consumer
+    depth subgraphs deep in another branch'''
+    graph = ramen.Graph()
+    branches = []
+    for branch in range(2):
+        subgraph = graph.root_node
+        for i in range(depth):
+            subgraph = ramen.node.SubgraphNode(parent=subgraph)
+        branches.append(subgraph)
+    consumers = []
+    pairs = []
+    for i in range(num_nodes):
+        source = ramen.node.Node(parent=branches[0]).create_parameter(
+            'out', source=True)
+        consumer = ramen.node.Node(parent=branches[1])
+        consumers.append(consumer)
+        pairs.append((source, consumer.create_parameter('in', sink=True)))
+    graph.connect_many(pairs)
+    return graph, consumers
+
+
+def bench_dependencies(depth, num_nodes, number):
+    graph, consumers = make_nested(depth, num_nodes)
+    walked = timeit.timeit(
+        lambda: [evaluate.dependencies(consumer) for consumer in consumers],
+        number=number)
+    start = time.time()
+    flat = compile.flatten(graph.root_node)
+    flat.nodes
+    build = time.time() - start
+    flattened = timeit.timeit(
+        lambda: [flat.dependencies(consumer) for consumer in consumers],
+        number=number)
+    return walked, build, flattened
+
+
+print('Flattening')
+for depth in (1, 10, 50):
+    walked, build, flattened = bench_dependencies(depth, 200, 20)
+    report('  dependencies, %d subgraphs deep' % depth, 4000, walked,
+           'nodes')
+    report('  flattened, %d subgraphs deep' % depth, 4000, flattened,
+           'nodes')
+    print('  %-38s %12.4f sec' % ('flattening, %d subgraphs deep' % depth,
+                                  build))
+
+
+# Generated evaluators
+def add_one(inputs):
+    return {'out': inputs['in'] + 1}
+
+
+def make_program_graph(num_nodes, depth):
+    '''A chain of num_nodes nodes, each depth subgraphs deeper than the
+    last (starting over every 10), inside a subgraph with an input and an
+    output'''
+    graph = ramen.Graph()
+    outer = ramen.node.SubgraphNode(graph=graph)
+    x = outer.create_parameter('x', sink=True)
+    y = outer.create_parameter('y', source=True)
+    pairs = []
+    prev = outer.get_tunnel_parameter(x)
+    parent = outer
+    for i in range(num_nodes):
+        if i % 10 == 0:
+            parent = outer
+        for j in range(depth):
+            parent = ramen.node.SubgraphNode(parent=parent)
+        chain_node = ramen.node.Node(parent=parent)
+        chain_node.compute = add_one
+        pairs.append((prev, chain_node.create_parameter(
+            'in', parameter_id='in', sink=True)))
+        prev = chain_node.create_parameter('out', parameter_id='out',
+                                           source=True)
+    pairs.append((prev, outer.get_tunnel_parameter(y)))
+    graph.connect_many(pairs)
+    return graph, outer, x, y
+
+
+def bench_program(num_nodes, depth, number):
+    graph, outer, x, y = make_program_graph(num_nodes, depth)
+
+    def interpreted():
+        # A new input each time, so everything is recomputed
+        x.value += 1
+        return graph.evaluate(y)
+    x.value = 0
+    interpreted_seconds = timeit.timeit(interpreted, number=number)
+    function = graph.program(outer).function
+    inputs = [{x.parameter_id: i} for i in range(number)]
+    start = time.time()
+    for node_inputs in inputs:
+        function(node_inputs)
+    return interpreted_seconds, time.time() - start
+
+
+print('Generated evaluators')
+for depth in (0, 2):
+    interpreted, generated = bench_program(100, depth, 200)
+    report('  evaluator, 100 nodes, %d deep' % depth, 200, interpreted,
+           'evaluations')
+    report('  generated, 100 nodes, %d deep' % depth, 200, generated,
+           'evaluations')
+
+
+# Instanced evaluation
+def vectorized_add_one(inputs):
+    values = inputs['in']
+    if instanced.numpy is not None:
+        return {'out': values + 1}
+    return {'out': [value + 1 for value in values]}
+
+
+def bench_instanced(num_nodes, num_records, vectorized):
+    '''Seconds to evaluate a chain of num_nodes nodes over num_records
+    records: one at a time with the generated evaluator (vectorized None),
+    or instanced'''
+    graph, outer, x, y = make_program_graph(num_nodes, 0)
+    records = list(range(num_records))
+    if vectorized is None:
+        function = graph.program(outer).function
+        start = time.time()
+        for record in records:
+            function({x.parameter_id: record})
+        return time.time() - start
+    if vectorized:
+        for graph_node in graph.nodes:
+            if graph_node.compute is not None:
+                graph_node.compute = vectorized_add_one
+                graph_node.compute_hints = [instanced.VECTORIZED]
+    program = graph.instanced_program(outer)
+    columns = {x.parameter_id: instanced.column(records)}
+    start = time.time()
+    program(columns, batch_size=4096)
+    return time.time() - start
+
+
+print('Instanced evaluation')
+for name, vectorized in (('one record at a time', None),
+                         ('instanced', False),
+                         ('instanced, vectorized', True)):
+    report('  %s, 100 nodes' % name, 10000,
+           bench_instanced(100, 10000, vectorized), 'records')
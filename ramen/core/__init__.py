@@ -1 +1,2 @@
 import ramen.core.node
+from ramen.core.patch import diff, apply_patch
@@ -0,0 +1,137 @@
+import collections
+
+
+class ChangeSet(object):
+    '''Consolidated graph changes, recorded during a Graph.batch() and
+    delivered once when the batch ends.
+
+    Redundant changes are collapsed as they are recorded: only the latest
+    value of a node attribute is kept, and a node or connection that is
+    added and then removed (or removed and then re-added) in the same batch
+    cancels out. Attribute and parent changes are not recorded for nodes
+    added in the batch, since listeners read their current state anyway,
+    and aren't reported for nodes removed in it, but are kept in case the
+    node comes back before the batch ends.
+    '''
+    def __init__(self):
+        # OrderedDicts are used as ordered sets
+        self._added_nodes = collections.OrderedDict()
+        self._removed_nodes = collections.OrderedDict()
+        # node -> new parent
+        self._reparented_nodes = collections.OrderedDict()
+        # node -> {attribute name: latest value}
+        self._changed_attributes = collections.OrderedDict()
+        # (source, sink) pairs
+        self._added_connections = collections.OrderedDict()
+        self._removed_connections = collections.OrderedDict()
+        # parameter -> set of changed attribute names ('sink', 'source')
+        self._changed_parameters = collections.OrderedDict()
+
+    def __bool__(self):
+        return bool(self._added_nodes or self._removed_nodes or
+                    self._reparented_nodes or self._changed_attributes or
+                    self._added_connections or self._removed_connections or
+                    self._changed_parameters)
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return ('<%s: +%d -%d nodes, +%d -%d connections>' % (
+            self.__class__.__name__, len(self._added_nodes),
+            len(self._removed_nodes), len(self._added_connections),
+            len(self._removed_connections)))
+
+    @property
+    def added_nodes(self):
+        return list(self._added_nodes)
+
+    @property
+    def removed_nodes(self):
+        return list(self._removed_nodes)
+
+    @property
+    def reparented_nodes(self):
+        return dict((node, parent) for node, parent
+                    in self._reparented_nodes.items()
+                    if node not in self._removed_nodes)
+
+    @property
+    def changed_attributes(self):
+        return dict((node, dict(attrs)) for node, attrs
+                    in self._changed_attributes.items()
+                    if node not in self._removed_nodes)
+
+    @property
+    def added_connections(self):
+        return list(self._added_connections)
+
+    @property
+    def removed_connections(self):
+        return list(self._removed_connections)
+
+    @property
+    def changed_parameters(self):
+        return dict((param, set(attrs)) for param, attrs
+                    in self._changed_parameters.items())
+
+    def _forget_node(self, node):
+        self._reparented_nodes.pop(node, None)
+        self._changed_attributes.pop(node, None)
+
+    # Recorders. These are connected to the graph's signals for the
+    # duration of a batch, so they take the same kwargs as those signals.
+    def record_node_added(self, node):
+        if node in self._removed_nodes:
+            del self._removed_nodes[node]
+        else:
+            self._added_nodes[node] = True
+            self._forget_node(node)
+
+    def record_node_removed(self, node):
+        if node in self._added_nodes:
+            del self._added_nodes[node]
+            self._forget_node(node)
+        else:
+            self._removed_nodes[node] = True
+
+    def record_node_parent_changed(self, node, parent):
+        if node in self._added_nodes or node in self._removed_nodes:
+            return
+        self._reparented_nodes[node] = parent
+
+    def record_node_attribute_changed(self, node, **kwargs):
+        if node in self._added_nodes or node in self._removed_nodes:
+            return
+        attrs = self._changed_attributes.setdefault(node, {})
+        attrs.update(kwargs)
+
+    def record_node_id_changed(self, node, node_id):
+        self.record_node_attribute_changed(node, node_id=node_id)
+
+    def record_node_label_changed(self, node, label):
+        self.record_node_attribute_changed(node, label=label)
+
+    def record_node_pos_changed(self, node, pos):
+        self.record_node_attribute_changed(node, pos=pos)
+
+    def record_node_selected_changed(self, node, selected):
+        self.record_node_attribute_changed(node, selected=selected)
+
+    def record_connection_added(self, source, sink):
+        connection = (source, sink)
+        if connection in self._removed_connections:
+            del self._removed_connections[connection]
+        else:
+            self._added_connections[connection] = True
+
+    def record_connection_removed(self, source, sink):
+        connection = (source, sink)
+        if connection in self._added_connections:
+            del self._added_connections[connection]
+        else:
+            self._removed_connections[connection] = True
+
+    def record_parameter_sink_changed(self, parameter):
+        self._changed_parameters.setdefault(parameter, set()).add('sink')
+
+    def record_parameter_source_changed(self, parameter):
+        self._changed_parameters.setdefault(parameter, set()).add('source')
@@ -0,0 +1,180 @@
+'''Generating straight-line Python evaluators for subgraphs.
+
+A Program turns the flattened contents of a SubgraphNode (see
+ramen.core.compile) into one generated Python function that, like a
+node's compute, is called with {input parameter_id: value} for the
+subgraph's sink parameters and returns {output parameter_id: value} for
+its source parameters. Inputs that aren't given take the parameter's
+value. For example:
+
+    def evaluate(inputs):
+        i0 = inputs.get('x', p0._value)
+        n0 = c0({'in': i0})
+        o1 = n0.get('out', p1._value)
+        return {'y': o1}
+
+Each node in the upstream cone of the outputs is computed once, in
+dependency order, by calling its compute function directly, with
+intermediate values in locals: no graph traversal, output cache or signals
+per call. Values are read from the parameters when the function is called,
+so changing them needs no regeneration. The function is regenerated when
+the graph changes structurally: connections, nodes, parameters, sink and
+source flags, or compute functions.
+
+Values are worked out as in ramen.core.evaluate, except that a sink fed
+through tunnels by several sources gets them all in one flat list (in
+evaluate.source_key order, as usual).
+'''
+from ramen.core.compile import flatten
+
+
+def _literal(value):
+    '''Whether repr(value) is a Python literal for it'''
+    return (type(value) in (str, int, bool, float) or value is None or
+            (type(value) is tuple and all(_literal(item) for item in value)))
+
+
+class Program(object):
+    '''A generated evaluator of a subgraph. See the module docstring.'''
+    # The generated function's arguments
+    _arguments = 'inputs'
+
+    def __init__(self, subgraph):
+        self._flat = flatten(subgraph)
+        self._function = None
+        self._version = None
+        self._namespace = None
+        self.source = None
+        self.register_callbacks()
+
+    def register_callbacks(self):
+        # Weakly, like the FlatGraph underneath
+        graph = self._flat.subgraph.graph
+        for signal in (graph.node_compute_changed, graph.parameter_added,
+                       graph.parameter_removed, graph.parameter_sink_changed,
+                       graph.parameter_source_changed):
+            signal.connect_weak(self.invalidate)
+
+    @property
+    def subgraph(self):
+        return self._flat.subgraph
+
+    @property
+    def function(self):
+        '''The generated function, regenerated first if the graph changed
+        structurally since it was'''
+        version = self._flat.version
+        if self._function is None or version != self._version:
+            self._generate()
+            self._version = version
+        return self._function
+
+    def __call__(self, inputs=None):
+        if inputs is None:
+            inputs = {}
+        return self.function(inputs)
+
+    def invalidate(self):
+        self._function = None
+
+    def _bind(self, prefix, obj):
+        '''A name for obj in the generated function's globals'''
+        name = '%s%d' % (prefix, len(self._namespace))
+        self._namespace[name] = obj
+        return name
+
+    def _compute_call(self, compute_node, compute, inputs, outputs):
+        '''The expression calling compute_node's compute (bound as
+        compute). inputs are (key, value, sources) of its sinks, where
+        sources are the locals the value comes from (none if it's the
+        parameter's), and outputs are (key, default) of the sources used.'''
+        return '%s({%s})' % (compute, ', '.join(
+            '%s: %s' % (key, value) for key, value, sources in inputs))
+
+    def _fan_in(self, sources):
+        '''The expression for the value of a sink fed by the locals
+        sources (more than one)'''
+        return '[%s]' % ', '.join(sources)
+
+    def _generate(self):
+        flat = self._flat
+        subgraph = flat.subgraph
+        # Name -> object, the generated function's globals
+        self._namespace = namespace = {}
+        # param -> the name of the local its value goes in
+        local_names = {}
+        lines = ['def evaluate(%s):' % self._arguments]
+        bind = self._bind
+
+        def key(parameter_id):
+            if _literal(parameter_id):
+                return repr(parameter_id)
+            return bind('k', parameter_id)
+
+        def sink_value(param):
+            sources = [local_names[source] for source in flat.sources(param)]
+            if not sources:
+                return '%s._value' % bind('p', param)
+            if len(sources) == 1:
+                return sources[0]
+            return self._fan_in(sources)
+
+        # Only the nodes the outputs depend on
+        outputs = flat.outputs
+        needed = set()
+        stack = [source.node for output in outputs
+                 for source in flat.sources(output)
+                 if source.node is not subgraph]
+        while stack:
+            compute_node = stack.pop()
+            if compute_node not in needed:
+                needed.add(compute_node)
+                stack.extend(flat.dependencies(compute_node))
+
+        for param in flat.inputs:
+            if flat.sinks(param):
+                local_names[param] = 'i%d' % len(local_names)
+                lines.append('    %s = inputs.get(%s, %s._value)' % (
+                    local_names[param], key(param.parameter_id),
+                    bind('p', param)))
+        for index, compute_node in enumerate(flat.order()):
+            if compute_node not in needed:
+                continue
+            outputs_name = 'n%d' % index
+            used = [param for param in compute_node.parameters
+                    if flat.sinks(param)]
+            defaults = dict((param, '%s._value' % bind('p', param))
+                            for param in used)
+            if compute_node.compute is not None:
+                node_inputs = [(key(param.parameter_id), sink_value(param),
+                                [local_names[source]
+                                 for source in flat.sources(param)])
+                               for param in compute_node.parameters
+                               if param.sink]
+                lines.append('    %s = %s' % (outputs_name, self._compute_call(
+                    compute_node, bind('c', compute_node.compute),
+                    node_inputs, [(key(param.parameter_id), defaults[param])
+                                  for param in used])))
+            for param in used:
+                local_names[param] = 'o%d' % len(local_names)
+                if compute_node.compute is None:
+                    value = defaults[param]
+                else:
+                    value = '%s.get(%s, %s)' % (
+                        outputs_name, key(param.parameter_id),
+                        defaults[param])
+                lines.append('    %s = %s' % (local_names[param], value))
+        lines.append('    return {%s}' % ', '.join(
+            '%s: %s' % (key(param.parameter_id), sink_value(param))
+            for param in outputs))
+
+        self.source = '\n'.join(lines) + '\n'
+        code = compile(self.source, '<generated %s>' % subgraph, 'exec')
+        exec(code, namespace)
+        self._function = namespace['evaluate']
+        self._namespace = None
+
+
+def generate(subgraph_node):
+    '''A Program of subgraph_node. Graph.program caches one per subgraph.'''
+    return Program(subgraph_node)
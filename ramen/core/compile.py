@@ -0,0 +1,265 @@
+'''Flattening subgraphs into direct dependencies between computing nodes.
+
+A connection into or out of a SubgraphNode goes through a chain of
+parameters: a source, the tunnel of a lofted parameter, the lofted
+parameter, and so on up and down the subgraphs, to a sink. flatten()
+collapses every such chain inside a SubgraphNode (nested subgraphs
+included) into one edge, so a FlatGraph is just:
+
+    nodes       the computing (non-subgraph) nodes inside the subgraph
+    edges       (source, sink) pairs, where a source is a source parameter
+                of one of the nodes or one of the subgraph's own parameters
+                (an input), and a sink is a sink parameter of one of the
+                nodes or one of the subgraph's own parameters (an output)
+
+path(source, sink) maps an edge back to the parameters it was collapsed
+from, for error reporting. version changes whenever the nodes or edges do.
+
+A FlatGraph follows the graph: connections changing only re-resolve the
+edges into the sinks downstream of them (when next asked for), and nodes
+or parameters being added, removed or moved rebuild it lazily.
+'''
+from ramen.core import node
+from ramen.core.evaluate import source_key
+
+
+def _is_tunnel(param):
+    return isinstance(param, node.parameter.TunnelParameter)
+
+
+class FlatGraph(object):
+    '''The flattened contents of a subgraph. See the module docstring.'''
+    def __init__(self, subgraph):
+        self._subgraph = subgraph
+        self._stale = True
+        # Parameters whose incoming connections changed since the last
+        # update
+        self._pending = set()
+        self._version = 0
+        self.register_callbacks()
+
+    def register_callbacks(self):
+        # Weakly, so dropping the FlatGraph disconnects it
+        graph = self._subgraph.graph
+        graph.connection_added.connect_weak(self._connection_changed_callback)
+        graph.connection_removed.connect_weak(
+            self._connection_changed_callback)
+        graph.parameter_added.connect_weak(self._parameter_added_callback)
+        for signal in (graph.parameter_removed, graph.node_added,
+                       graph.node_removed, graph.node_parent_changed):
+            signal.connect_weak(self.invalidate)
+
+    @property
+    def subgraph(self):
+        return self._subgraph
+
+    @property
+    def version(self):
+        self._update()
+        return self._version
+
+    @property
+    def nodes(self):
+        self._update()
+        return list(self._nodes)
+
+    @property
+    def inputs(self):
+        '''The subgraph's parameters that values flow in through'''
+        return [param for param in self._subgraph.parameters if param.sink]
+
+    @property
+    def outputs(self):
+        '''The subgraph's parameters that values flow out through'''
+        return [param for param in self._subgraph.parameters
+                if param.source]
+
+    def edges(self):
+        self._update()
+        return [(source, sink) for sink, sources in self._sources.items()
+                for source in sources]
+
+    def sources(self, sink):
+        '''What sink gets its value from, in evaluate.source_key order'''
+        self._update()
+        return sorted(self._sources.get(sink, ()), key=source_key)
+
+    def sinks(self, source):
+        '''What source passes its value on to'''
+        self._update()
+        return list(self._sinks.get(source, ()))
+
+    def path(self, source, sink):
+        '''The parameters the edge from source to sink was collapsed from,
+        source first and sink last, or None if there's no such edge'''
+        self._update()
+        return self._sources.get(sink, {}).get(source)
+
+    def dependencies(self, compute_node):
+        '''The nodes compute_node gets its inputs from'''
+        self._update()
+        deps = set()
+        for param in compute_node.parameters:
+            for source in self._sources.get(param, ()):
+                if source.node in self._nodes:
+                    deps.add(source.node)
+        return deps
+
+    def order(self):
+        '''The nodes, each after every node it depends on'''
+        self._update()
+        deps = dict((compute_node, self.dependencies(compute_node))
+                    for compute_node in self._nodes)
+        dependents = dict((compute_node, []) for compute_node in deps)
+        for compute_node, node_deps in deps.items():
+            for dep in node_deps:
+                dependents[dep].append(compute_node)
+        counts = dict((compute_node, len(node_deps))
+                      for compute_node, node_deps in deps.items())
+        ready = [compute_node for compute_node, count in counts.items()
+                 if not count]
+        order = []
+        while ready:
+            compute_node = ready.pop()
+            order.append(compute_node)
+            for dependent in dependents[compute_node]:
+                counts[dependent] -= 1
+                if not counts[dependent]:
+                    ready.append(dependent)
+        if len(order) < len(counts):
+            raise RuntimeError('Cycle in %s' % self._subgraph)
+        return order
+
+    def invalidate(self):
+        self._stale = True
+        self._pending.clear()
+
+    def _connection_changed_callback(self, source, sink):
+        if not self._stale:
+            self._pending.add(sink)
+
+    def _parameter_added_callback(self, parameter):
+        # New parameters have no connections, and change nothing until
+        # they get some. One coming back keeps its connections.
+        if parameter._connections_in or parameter._connections_out:
+            self.invalidate()
+
+    def _update(self):
+        if self._stale:
+            self._rebuild()
+        elif self._pending:
+            pending = self._pending
+            self._pending = set()
+            flat_sinks = set()
+            for param in pending:
+                flat_sinks.update(self._flat_sinks(param))
+            for flat_sink in flat_sinks:
+                self._resolve(flat_sink)
+
+    def _rebuild(self):
+        self._nodes = set()
+        self._subgraphs = set([self._subgraph])
+        stack = [self._subgraph]
+        while stack:
+            for child in stack.pop().children:
+                if isinstance(child, node.SubgraphNode):
+                    self._subgraphs.add(child)
+                    stack.append(child)
+                else:
+                    self._nodes.add(child)
+        # flat sink -> {flat source: path}, and flat source -> flat sinks
+        self._sources = {}
+        self._sinks = {}
+        for compute_node in self._nodes:
+            for param in compute_node.parameters:
+                if param._connections_in:
+                    self._resolve(param)
+        for param in self._subgraph.parameters:
+            self._resolve(param)
+        self._stale = False
+        self._pending.clear()
+        self._version += 1
+
+    def _resolve(self, flat_sink):
+        '''Work out again what flat_sink gets its value from'''
+        old_sources = self._sources.pop(flat_sink, {})
+        for source in old_sources:
+            flat_sinks = self._sinks[source]
+            flat_sinks.discard(flat_sink)
+            if not flat_sinks:
+                del self._sinks[source]
+        sources = {}
+        if flat_sink.node is self._subgraph:
+            # An output, fed by its tunnel from inside
+            tunnel = self._subgraph.get_tunnel_parameter(flat_sink)
+            stack = []
+            if tunnel is not None:
+                stack = [(param, (tunnel, flat_sink))
+                         for param in tunnel.iter_connections_in()]
+        else:
+            stack = [(param, (flat_sink,))
+                     for param in flat_sink.iter_connections_in()]
+        seen = set()
+        while stack:
+            param, path = stack.pop()
+            if param in seen:
+                continue
+            seen.add(param)
+            path = (param,) + path
+            param_node = param.node
+            if _is_tunnel(param):
+                if param_node is self._subgraph:
+                    # The inside face of an input
+                    outer = param.tunneled_parameter
+                    sources[outer] = (outer,) + path
+                elif param_node in self._subgraphs:
+                    outer = param.tunneled_parameter
+                    stack.extend((source, (outer,) + path)
+                                 for source in outer.iter_connections_in())
+            elif param_node in self._nodes:
+                sources[param] = path
+            elif (param_node in self._subgraphs and
+                  param_node is not self._subgraph):
+                # A nested subgraph's output, fed by its tunnel
+                tunnel = param_node.get_tunnel_parameter(param)
+                if tunnel is not None:
+                    stack.extend((source, (tunnel,) + path)
+                                 for source in tunnel.iter_connections_in())
+        if sources:
+            self._sources[flat_sink] = sources
+            for source in sources:
+                self._sinks.setdefault(source, set()).add(flat_sink)
+        if set(sources) != set(old_sources):
+            self._version += 1
+
+    def _flat_sinks(self, param):
+        '''The flat sinks param passes its value on to, through tunnels
+        (itself, if it's a flat sink)'''
+        flat_sinks = []
+        seen = set()
+        stack = [param]
+        while stack:
+            param = stack.pop()
+            if param in seen:
+                continue
+            seen.add(param)
+            param_node = param.node
+            if _is_tunnel(param):
+                if param_node is self._subgraph:
+                    flat_sinks.append(param.tunneled_parameter)
+                elif param_node in self._subgraphs:
+                    outer = param.tunneled_parameter
+                    stack.extend(outer.iter_connections_out())
+            elif param_node in self._nodes:
+                flat_sinks.append(param)
+            elif (param_node in self._subgraphs and
+                  param_node is not self._subgraph):
+                tunnel = param_node.get_tunnel_parameter(param)
+                if tunnel is not None:
+                    stack.extend(tunnel.iter_connections_out())
+        return flat_sinks
+
+
+def flatten(subgraph_node):
+    '''A FlatGraph of subgraph_node, kept up to date as the graph changes'''
+    return FlatGraph(subgraph_node)
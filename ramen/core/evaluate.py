@@ -0,0 +1,364 @@
+'''Demand driven (pull) evaluation of parameter values.
+
+A node computes values by registering a compute function
+(``node.compute = fn``). It is called with a dict of
+{sink parameter_id: value} for the node's sink parameters, and returns a
+dict of {source parameter_id: value} for its source parameters.
+
+A sink parameter pulls its value from the source it is connected to, or
+uses its static ``value`` if nothing is connected (a list of values if
+several sources are connected, in source_key order). Connections into
+and out of a SubgraphNode go through its TunnelParameters. A parameter on
+the subgraph node passes through the value connected to the other face of
+its tunnel, so subgraphs themselves never compute anything.
+
+Only the nodes in the upstream cone of the evaluated parameter are
+computed, each at most once per evaluation.
+
+Computed outputs are cached per node, in an OutputCache bounded by a
+number of entries and/or bytes (least recently used first out). Changing
+a parameter value, a compute function, a sink/source flag or a connection
+marks the downstream cone dirty and evicts it, so the next evaluation only
+recomputes what changed.
+'''
+import collections
+import sys
+import weakref
+
+from ramen.core import node
+
+
+def _is_tunnel(param):
+    return isinstance(param, node.parameter.TunnelParameter)
+
+
+def _is_subgraph_parameter(param):
+    return isinstance(param.node, node.SubgraphNode) and not _is_tunnel(param)
+
+
+def _sort_key(value):
+    # ids may be of different types, which don't compare on python 3
+    return (type(value).__name__, value)
+
+
+def source_key(param):
+    '''The key the values of several sources feeding one sink are ordered
+    by: the source's node_id, then its parameter_id. Unlike the order of
+    connections_in, it doesn't change from run to run.'''
+    return (_sort_key(param.node.node_id), _sort_key(param.parameter_id))
+
+
+def source_terminals(param):
+    '''The source parameters on computing (non-subgraph) nodes that provide
+    the value of param, acting as a source. Tunnels and subgraph parameters
+    are passed through.'''
+    return _terminals([param])
+
+
+def sink_terminals(param):
+    '''The source parameters on computing (non-subgraph) nodes that param,
+    acting as a sink, pulls its value from.'''
+    return _terminals(param.iter_connections_in())
+
+
+def _terminals(sources):
+    terminals = []
+    seen = set()
+    stack = list(sources)
+    while stack:
+        source = stack.pop()
+        if source in seen:
+            continue
+        seen.add(source)
+        if _is_tunnel(source):
+            # The inside face of a subgraph sink, passing its value in
+            stack.extend(source.tunneled_parameter.iter_connections_in())
+        elif _is_subgraph_parameter(source):
+            # The outside face of a subgraph source, passing its value out
+            tunnel = source.node.get_tunnel_parameter(source)
+            if tunnel is not None:
+                stack.extend(tunnel.iter_connections_in())
+        else:
+            terminals.append(source)
+    return terminals
+
+
+def dependencies(compute_node):
+    '''The computing nodes that compute_node pulls its inputs from'''
+    deps = set()
+    for param in compute_node.parameters:
+        if param.sink:
+            for terminal in sink_terminals(param):
+                deps.add(terminal.node)
+    return deps
+
+
+def downstream(param):
+    '''The parameters that param directly passes its value on to'''
+    params = list(param.iter_connections_out())
+    if _is_tunnel(param):
+        if param.sink:
+            params.append(param.tunneled_parameter)
+    elif _is_subgraph_parameter(param):
+        if param.sink:
+            tunnel = param.node.get_tunnel_parameter(param)
+            if tunnel is not None:
+                params.append(tunnel)
+    elif param.sink and param.node is not None:
+        params.extend(node_param for node_param in param.node.parameters
+                      if node_param.source)
+    return params
+
+
+def upstream_nodes(params, skip=None):
+    '''The computing nodes in the upstream cone of params, ordered so that
+    every node comes after the nodes it depends on. Nodes for which skip
+    returns True are left out, along with whatever only they depend on.'''
+    order = []
+    # node -> False while its dependencies are being visited, True when done
+    visited = {}
+    stack = []
+    for param in params:
+        if param.source:
+            terminals = source_terminals(param)
+        else:
+            terminals = sink_terminals(param)
+        stack.extend((terminal.node, False) for terminal in terminals)
+    while stack:
+        cur_node, expanded = stack.pop()
+        if expanded:
+            visited[cur_node] = True
+            order.append(cur_node)
+            continue
+        if cur_node in visited:
+            continue
+        if skip is not None and skip(cur_node):
+            visited[cur_node] = True
+            continue
+        visited[cur_node] = False
+        stack.append((cur_node, True))
+        for dep in dependencies(cur_node):
+            if dep not in visited:
+                stack.append((dep, False))
+            elif not visited[dep]:
+                raise RuntimeError('Cycle through %s and %s' %
+                                   (cur_node, dep))
+    return order
+
+
+def default_sizeof(outputs):
+    return sys.getsizeof(outputs) + sum(sys.getsizeof(value)
+                                        for value in outputs.values())
+
+
+class OutputCache(object):
+    '''Least recently used cache of node outputs, optionally bounded by a
+    number of entries and/or a total size in bytes (as measured by sizeof,
+    a shallow sys.getsizeof by default).'''
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=None):
+        # node -> (outputs, size), least recently used first
+        self._entries = collections.OrderedDict()
+        self._nbytes = 0
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self.sizeof = sizeof or default_sizeof
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    @property
+    def max_entries(self):
+        return self._max_entries
+
+    @max_entries.setter
+    def max_entries(self, max_entries):
+        self._max_entries = max_entries
+        self._trim()
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._trim()
+
+    def get(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        # Reinsert as the most recently used
+        self._entries[key] = entry
+        return entry[0]
+
+    def put(self, key, outputs):
+        self.evict(key)
+        size = self.sizeof(outputs)
+        self._entries[key] = (outputs, size)
+        self._nbytes += size
+        self._trim()
+
+    def evict(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._nbytes -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self._nbytes = 0
+
+    def _trim(self):
+        while self._entries and (
+                (self._max_entries is not None and
+                 len(self._entries) > self._max_entries) or
+                (self._max_bytes is not None and
+                 self._nbytes > self._max_bytes)):
+            _, (_, size) = self._entries.popitem(last=False)
+            self._nbytes -= size
+
+
+class Evaluator(object):
+    '''Evaluates parameters of a graph. See the module docstring.'''
+    def __init__(self, graph, max_entries=None, max_bytes=None):
+        # The graph owns this, so only reference it weakly
+        self._graph = weakref.ref(graph)
+        self._cache = OutputCache(max_entries=max_entries,
+                                  max_bytes=max_bytes)
+        self.register_callbacks()
+
+    def register_callbacks(self):
+        self.graph.connection_added.connect(self._connection_changed_callback)
+        self.graph.connection_removed.connect(
+            self._connection_changed_callback)
+        self.graph.parameter_value_changed.connect(self.invalidate)
+        self.graph.parameter_sink_changed.connect(self.invalidate)
+        self.graph.parameter_source_changed.connect(self.invalidate)
+        self.graph.node_compute_changed.connect(self.invalidate_node)
+        self.graph.node_removed.connect(self.invalidate_node)
+
+    def deregister_callbacks(self):
+        self.graph.connection_added.disconnect(
+            self._connection_changed_callback)
+        self.graph.connection_removed.disconnect(
+            self._connection_changed_callback)
+        self.graph.parameter_value_changed.disconnect(self.invalidate)
+        self.graph.parameter_sink_changed.disconnect(self.invalidate)
+        self.graph.parameter_source_changed.disconnect(self.invalidate)
+        self.graph.node_compute_changed.disconnect(self.invalidate_node)
+        self.graph.node_removed.disconnect(self.invalidate_node)
+
+    @property
+    def graph(self):
+        return self._graph()
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def evaluate(self, param):
+        '''Return the value of param: what it outputs if it's a source,
+        otherwise what it receives.'''
+        # node -> its outputs
+        outputs = {}
+        for compute_node in self.nodes_to_compute([param], outputs):
+            self.store_outputs(compute_node,
+                               self.compute_node(compute_node, outputs),
+                               outputs)
+        return self.value(param, outputs)
+
+    def nodes_to_compute(self, params, outputs):
+        '''The uncached nodes in the upstream cone of params, in dependency
+        order. The outputs of cached nodes are pinned in outputs as they're
+        found, so computing the rest can't evict them mid evaluation.'''
+        def is_cached(compute_node):
+            cached = self._cache.get(compute_node)
+            if cached is None:
+                return False
+            outputs[compute_node] = cached
+            return True
+        return upstream_nodes(params, skip=is_cached)
+
+    def compute_node(self, compute_node, outputs):
+        '''Compute compute_node, given the outputs of all the nodes it
+        depends on.'''
+        if compute_node.compute is None:
+            return {}
+        inputs = self.gather_inputs(compute_node, outputs)
+        return compute_node.compute(inputs)
+
+    def store_outputs(self, compute_node, result, outputs):
+        '''Record the freshly computed result of compute_node'''
+        outputs[compute_node] = result
+        self._cache.put(compute_node, result)
+        for param in compute_node.parameters:
+            param._dirty = False
+
+    def value(self, param, outputs):
+        '''The value of param, given the outputs of its upstream cone'''
+        param._dirty = False
+        if param.source:
+            return self._output(param, outputs)
+        return self._input(param, outputs)
+
+    def invalidate(self, parameter):
+        '''Mark parameter and everything downstream of it dirty, and evict
+        the affected outputs'''
+        stack = [parameter]
+        while stack:
+            param = stack.pop()
+            if param._dirty and param is not parameter:
+                # Everything downstream of a dirty parameter is dirty
+                continue
+            param._dirty = True
+            if param.node is not None:
+                self._cache.evict(param.node)
+            stack.extend(downstream(param))
+
+    def invalidate_node(self, node):
+        self._cache.evict(node)
+        for param in node.parameters:
+            if param.source:
+                self.invalidate(param)
+
+    def _connection_changed_callback(self, source, sink):
+        self.invalidate(sink)
+
+    def gather_inputs(self, compute_node, outputs):
+        inputs = {}
+        for param in compute_node.parameters:
+            if param.sink:
+                inputs[param.parameter_id] = self._input(param, outputs)
+        return inputs
+
+    def _input(self, param, outputs):
+        '''The value param receives, acting as a sink'''
+        param._dirty = False
+        sources = param._connections_in
+        if not sources:
+            return param.value
+        if len(sources) == 1:
+            return self._output(next(param.iter_connections_in()), outputs)
+        return [self._output(source, outputs) for source in
+                sorted(param.iter_connections_in(), key=source_key)]
+
+    def _output(self, param, outputs):
+        '''The value param provides, acting as a source'''
+        param._dirty = False
+        if _is_tunnel(param):
+            return self._input(param.tunneled_parameter, outputs)
+        if _is_subgraph_parameter(param):
+            tunnel = param.node.get_tunnel_parameter(param)
+            if tunnel is None or not tunnel._connections_in:
+                return param.value
+            return self._input(tunnel, outputs)
+        if param.node.compute is None:
+            return param.value
+        return outputs[param.node].get(param.parameter_id, param.value)
@@ -0,0 +1,291 @@
+'''A read-only compiled form of a graph, for analytics over big graphs.
+
+graph.freeze() returns a FrozenGraph: nodes and parameters (tunnels
+included) get dense integer indices, and the structure goes into flat
+arrays of indices rather than objects and sets:
+
+    node_parent[i]      the parent of node i, -1 for the root node
+    node_depth[i]       the number of ancestors of node i
+    child_indptr, child_indices
+                        the children of node i are
+                        child_indices[child_indptr[i]:child_indptr[i + 1]]
+    param_node[p]       the node of parameter p
+    param_flags[p]      SINK, SOURCE and TUNNEL bits
+    param_partner[p]    the other face of a subgraph boundary (a tunnel's
+                        parameter, a subgraph parameter's tunnel), or -1
+    out_indptr, out_indices
+                        connections_out, in compressed sparse row form: the
+                        sinks of p are out_indices[out_indptr[p]:
+                        out_indptr[p + 1]]
+    in_indptr, in_indices
+                        connections_in, the same way
+
+Nodes come parents first, and each node's parameters are contiguous.
+node_ids and params (endpoints, as in ramen.core.serialize) map indices
+back, node_index and param_index map them to indices.
+
+The arrays are array.arrays, or NumPy arrays (sharing the same memory) if
+NumPy is installed, and the analytics (fan_in, fan_out, reachable and
+feeds) are vectorized with it. Values flow as in ramen.core.reachability:
+along connections, and from a sink to its partner.
+
+A FrozenGraph doesn't follow the graph's changes: freeze it again.
+'''
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ramen.core.serialize import _endpoint
+
+# param_flags bits
+SINK = 1
+SOURCE = 2
+TUNNEL = 4
+
+_INDEX = 'l'
+
+
+def _indices(values=()):
+    return array.array(_INDEX, values)
+
+
+def _finish(values):
+    '''values as the array type the FrozenGraph exposes'''
+    if numpy is not None:
+        return numpy.frombuffer(values, dtype=values.typecode)
+    return values
+
+
+def _gather(indptr, indices, rows):
+    '''The entries of rows of a CSR matrix, concatenated'''
+    if numpy is not None:
+        rows = numpy.asarray(rows, dtype=indptr.dtype)
+        starts = indptr[rows]
+        counts = indptr[rows + 1] - starts
+        # Each entry's row start, shifted by where the row lands in the
+        # result
+        offsets = numpy.repeat(starts - numpy.cumsum(counts) + counts,
+                               counts)
+        return indices[offsets + numpy.arange(len(offsets))]
+    entries = []
+    for row in rows:
+        entries.extend(indices[indptr[row]:indptr[row + 1]])
+    return entries
+
+
+def _csr(rows):
+    '''indptr and indices arrays for rows, an iterable of lists of
+    indices'''
+    indptr = _indices([0])
+    indices = _indices()
+    for row in rows:
+        indices.extend(row)
+        indptr.append(len(indices))
+    return indptr, indices
+
+
+class FrozenGraph(object):
+    '''A graph compiled to arrays. See the module docstring.'''
+    def __init__(self, graph):
+        # node -> index, and the reverse
+        node_index = {}
+        nodes = []
+        # Parents first: a node's unindexed ancestors go before it
+        for graph_node in graph.nodes:
+            chain = []
+            cur_node = graph_node
+            while (cur_node is not None and cur_node not in node_index and
+                   cur_node.graph is graph):
+                chain.append(cur_node)
+                cur_node = cur_node.parent
+            for cur_node in reversed(chain):
+                node_index[cur_node] = len(nodes)
+                nodes.append(cur_node)
+
+        node_parent = _indices()
+        node_depth = _indices()
+        for graph_node in nodes:
+            parent = node_index.get(graph_node.parent, -1)
+            node_parent.append(parent)
+            node_depth.append(0 if parent < 0 else node_depth[parent] + 1)
+        children = [[] for graph_node in nodes]
+        for index, parent in enumerate(node_parent):
+            if parent >= 0:
+                children[parent].append(index)
+
+        # param -> index, and the reverse
+        param_index = {}
+        params = []
+        param_node = _indices()
+        for index, graph_node in enumerate(nodes):
+            node_params = graph_node.parameters
+            node_params.extend(
+                getattr(graph_node, '_tunnel_parameters', {}).values())
+            for param in node_params:
+                param_index[param] = len(params)
+                params.append(param)
+                param_node.append(index)
+
+        param_flags = array.array('b')
+        param_partner = _indices()
+        for param in params:
+            tunneled = getattr(param, 'tunneled_parameter', None)
+            flags = (SINK if param.sink else 0) | (
+                SOURCE if param.source else 0)
+            if tunneled is not None:
+                flags |= TUNNEL
+                partner = tunneled
+            else:
+                partner = getattr(param.node, '_parameter_to_tunnel',
+                                  {}).get(param)
+            param_flags.append(flags)
+            param_partner.append(param_index.get(partner, -1))
+
+        def connected(refs):
+            row = []
+            for ref in refs:
+                index = param_index.get(ref())
+                if index is not None:
+                    row.append(index)
+            row.sort()
+            return row
+        out_indptr, out_indices = _csr(
+            connected(param._connections_out) for param in params)
+        in_indptr, in_indices = _csr(
+            connected(param._connections_in) for param in params)
+        child_indptr, child_indices = _csr(children)
+
+        self.node_ids = [graph_node.node_id for graph_node in nodes]
+        self.node_index = dict((node_id, index) for index, node_id in
+                               enumerate(self.node_ids))
+        self.params = [_endpoint(param) for param in params]
+        self.param_index = dict((endpoint, index) for index, endpoint in
+                                enumerate(self.params))
+        self.node_parent = _finish(node_parent)
+        self.node_depth = _finish(node_depth)
+        self.child_indptr = _finish(child_indptr)
+        self.child_indices = _finish(child_indices)
+        self.param_node = _finish(param_node)
+        self.param_flags = _finish(param_flags)
+        self.param_partner = _finish(param_partner)
+        self.out_indptr = _finish(out_indptr)
+        self.out_indices = _finish(out_indices)
+        self.in_indptr = _finish(in_indptr)
+        self.in_indices = _finish(in_indices)
+        # (indptr, indices) of where values flow, forward and backward,
+        # built on first use
+        self._flow = {}
+
+    @property
+    def num_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def num_params(self):
+        return len(self.params)
+
+    @property
+    def num_connections(self):
+        return len(self.out_indices)
+
+    def index(self, param):
+        '''The index of param, a Parameter of the frozen graph'''
+        return self.param_index[_endpoint(param)]
+
+    def children(self, node):
+        return self.child_indices[self.child_indptr[node]:
+                                  self.child_indptr[node + 1]]
+
+    def connections_out(self, param):
+        return self.out_indices[self.out_indptr[param]:
+                                self.out_indptr[param + 1]]
+
+    def connections_in(self, param):
+        return self.in_indices[self.in_indptr[param]:
+                               self.in_indptr[param + 1]]
+
+    def _degrees(self, indptr):
+        if numpy is not None:
+            return numpy.diff(indptr)
+        return _indices(indptr[i + 1] - indptr[i]
+                        for i in range(len(indptr) - 1))
+
+    def fan_in(self):
+        '''The number of connections into each parameter'''
+        return self._degrees(self.in_indptr)
+
+    def fan_out(self):
+        '''The number of connections out of each parameter'''
+        return self._degrees(self.out_indptr)
+
+    def flow(self, backward=False):
+        '''(indptr, indices) of the parameters each parameter passes its
+        value on to (or, backward, gets its value from): its connections,
+        plus its partner if it's a sink (a source, backward)'''
+        if backward not in self._flow:
+            if backward:
+                indptr, indices, crossing = (self.in_indptr,
+                                             self.in_indices, SOURCE)
+            else:
+                indptr, indices, crossing = (self.out_indptr,
+                                             self.out_indices, SINK)
+            rows = []
+            for param in range(self.num_params):
+                row = list(indices[indptr[param]:indptr[param + 1]])
+                partner = self.param_partner[param]
+                if partner >= 0 and self.param_flags[param] & crossing:
+                    row.append(partner)
+                rows.append(row)
+            flow_indptr, flow_indices = _csr(rows)
+            self._flow[backward] = (_finish(flow_indptr),
+                                    _finish(flow_indices))
+        return self._flow[backward]
+
+    def _search(self, sources, backward, target=None):
+        '''Flags of the parameters reachable from sources, stopping early
+        once target is reached'''
+        indptr, indices = self.flow(backward)
+        if numpy is not None:
+            reached = numpy.zeros(self.num_params, dtype=bool)
+            frontier = numpy.asarray(sources, dtype=indptr.dtype)
+            while len(frontier):
+                frontier = numpy.unique(_gather(indptr, indices, frontier))
+                frontier = frontier[~reached[frontier]]
+                reached[frontier] = True
+                if target is not None and reached[target]:
+                    break
+            return reached
+        reached = bytearray(self.num_params)
+        frontier = list(sources)
+        while frontier:
+            next_frontier = []
+            for param in _gather(indptr, indices, frontier):
+                if not reached[param]:
+                    reached[param] = 1
+                    next_frontier.append(param)
+            if target is not None and reached[target]:
+                break
+            frontier = next_frontier
+        return reached
+
+    def reachable(self, sources, backward=False):
+        '''The indices of the parameters that values flow to from sources
+        (or, backward, that flow into sources), in order'''
+        reached = self._search(sources, backward)
+        if numpy is not None:
+            return numpy.flatnonzero(reached)
+        return _indices(param for param, flag in enumerate(reached) if flag)
+
+    def feeds(self, source, sink):
+        '''Whether a value flows from the parameter at index source to the
+        one at index sink'''
+        if source == sink:
+            return False
+        return bool(self._search([source], False, target=sink)[sink])
+
+
+def freeze(graph):
+    return FrozenGraph(graph)
@@ -1,15 +1,40 @@
+import contextlib
+import itertools
+import weakref
+
 from ramen.core.signal import Signal
+from ramen.core.changeset import ChangeSet
+from ramen.core.idallocator import IdAllocator
+from ramen.core.selection import SelectionView
+from ramen.core.evaluate import Evaluator
+from ramen.core import topology
+from ramen.core import codegen
+from ramen.core import frozen
+from ramen.core import instanced
+from ramen.core.reachability import ReachabilityIndex
+from ramen.core.snapshot import SnapshotTracker
 from ramen.core import node
 
 
+class CreatedNode(object):
+    '''A parent in Graph._create_nodes specs: the node created for the
+    spec at index, earlier in the same call'''
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+
 class Graph(object):
     '''The graph. Contains all our nodes.'''
     def __init__(self):
         # ID -> node
         self._nodes = {}
+        self._node_id_allocator = IdAllocator()
         self._root_node_id = None
 
         self._selected_nodes = set()
+        self._selected_nodes_view = SelectionView(self._selected_nodes)
 
         # Nodes
         self.node_added = Signal()
@@ -21,10 +46,29 @@ class Graph(object):
         self.parameter_removed = Signal()
         self.parameter_sink_changed = Signal()
         self.parameter_source_changed = Signal()
+        self.parameter_value_changed = Signal()
 
         # Connections
         self.connection_added = Signal()
         self.connection_removed = Signal()
+        # Emitted with source, sink for a connection that would create a
+        # cycle. If reject_cycles is set, it isn't made.
+        self.cycle_detected = Signal()
+        self.reject_cycles = True
+        self._topology = topology.Topology()
+        # (source, sink) connections kept despite creating a cycle, which
+        # the topology leaves out
+        self._cyclic_connections = set()
+        # Set while connect_many connects pairs it already added to the
+        # topology together
+        self._adding_edges = False
+        # (source, sink) -> (source node, sink node, subgraph) of every
+        # connection between the graph's parameters, and the connections
+        # by the node they're out of, into, and the subgraph they're in
+        self._connections = {}
+        self._connections_from = {}
+        self._connections_to = {}
+        self._connections_within = {}
 
         # node attributes
         self.node_id_changed = Signal()
@@ -33,11 +77,39 @@ class Graph(object):
         self.node_pos_changed = Signal()
         self.node_selected_changed = Signal()
         self.node_name_changed = Signal()
+        self.node_compute_changed = Signal()
+
+        # Selection
+        # Emitted with added=frozenset, removed=frozenset of nodes
+        self.selection_changed = Signal()
 
-        self.node_added.connect(self._node_added_callback)
-        self.node_removed.connect(self._node_removed_callback)
-        self.node_selected_changed.connect(
+        # Batching
+        # Emitted with changes=ChangeSet when the outermost batch ends
+        self.batch_committed = Signal()
+        self._batch_depth = 0
+        self._batch_changes = None
+
+        self._evaluator = None
+        self._reachability_index = None
+        self._snapshot_tracker = None
+        # SubgraphNode -> {generate function: the program it made}
+        self._programs = {}
+
+        # Weakly, so the graph isn't a reference cycle with its own signals
+        # (and can be freed without the cyclic garbage collector)
+        self.node_added.connect_weak(self._node_added_callback)
+        self.node_removed.connect_weak(self._node_removed_callback)
+        self.node_id_changed.connect_weak(self._node_id_changed_callback)
+        self.node_selected_changed.connect_weak(
             self._node_selected_changed_callback)
+        self.connection_added.connect_weak(self._connection_added_callback)
+        self.connection_removed.connect_weak(
+            self._connection_removed_callback)
+        self.node_parent_changed.connect_weak(
+            self._node_parent_changed_callback)
+        self.parameter_added.connect_weak(self._parameter_added_callback)
+        self.parameter_removed.connect_weak(
+            self._parameter_removed_callback)
 
     @property
     def nodes(self):
@@ -51,26 +123,328 @@ class Graph(object):
         new_nodes.add(self.root_node)
         nodes_to_add = new_nodes.difference(cur_nodes)
         nodes_to_remove = cur_nodes.difference(new_nodes)
-        for node in nodes_to_add:
-            node.graph = self
-        for node in nodes_to_remove:
-            node.graph = None
+        with self.batch():
+            for node in nodes_to_add:
+                node.graph = self
+            for node in nodes_to_remove:
+                node.graph = None
 
     @nodes.deleter
     def nodes(self):
         self.clear()
 
+    @property
+    def connections(self):
+        '''A live read-only view of every connection between the graph's
+        parameters, as (source, sink) pairs'''
+        return self._connections.keys()
+
+    def connections_from(self, node):
+        '''The connections out of node's parameters (and tunnels)'''
+        return list(self._connections_from.get(node, ()))
+
+    def connections_to(self, node):
+        '''The connections into node's parameters (and tunnels)'''
+        return list(self._connections_to.get(node, ()))
+
+    def connections_within(self, subgraph):
+        '''The connections inside subgraph: between its children and its
+        tunnels. None for the ones between the root node's parameters.'''
+        return list(self._connections_within.get(subgraph, ()))
+
     def create_node(self, *args, **kwargs):
         # convenience
         kwargs['graph'] = self
         return node.Node(*args, **kwargs)
 
+    def create_nodes(self, specs, node_class=None):
+        '''Create many nodes at once. Returns the new nodes in order.
+
+        specs is an iterable of (label, parent, node_id, pos) tuples, where
+        parent and pos may be None for the root node and (0, 0). A parent
+        must be in this graph.
+        Unlike create_node, ids are allocated in one pass and parents are
+        assigned in one pass, all inside one batch. The new nodes don't
+        emit parent_changed, since nothing can be connected to them yet,
+        but their parents emit child_added, and the graph node_added, for
+        each of them as usual.
+        '''
+        if node_class is None:
+            node_class = node.Node
+        return self._create_nodes(
+            (node_class, label, parent, node_id, pos)
+            for label, parent, node_id, pos in specs)
+
+    def _create_nodes(self, specs):
+        '''create_nodes, with specs of (node_class, label, parent, node_id,
+        pos). A parent may also be a CreatedNode, for a node created earlier
+        in the same call. Used by ramen.core.serialize.'''
+        root_node = self.root_node
+        new_nodes = []
+        parents = []
+        with self.batch():
+            # id allocation pass
+            for node_class, label, parent, node_id, pos in specs:
+                if (parent is not None and
+                        not isinstance(parent, CreatedNode) and
+                        parent.graph is not self):
+                    for new_node in new_nodes:
+                        del self._nodes[new_node.node_id]
+                    raise ValueError('%s is not in %s' % (parent, self))
+                node_id = self._uniquefy_node_id(node_id)
+                new_node = node_class._create_quietly(label, node_id, self)
+                if pos is not None:
+                    new_node._pos = pos
+                self._nodes[node_id] = new_node
+                self._node_id_allocator.note(node_id)
+                new_nodes.append(new_node)
+                parents.append(parent)
+
+            # parenting pass
+            for new_node, parent in zip(new_nodes, parents):
+                if isinstance(parent, CreatedNode):
+                    parent = new_nodes[parent.index]
+                if parent is None or not parent.accepts_children:
+                    parent = root_node
+                new_node._parent = weakref.ref(parent)
+                parent._children.add(new_node)
+                parent._emit('child_added', child=new_node)
+
+            # notification
+            for new_node in new_nodes:
+                new_node.register_callbacks()
+                self.node_added.emit(node=new_node)
+        return new_nodes
+
+    def connect_many(self, pairs):
+        '''Connect many (source, sink) parameter pairs at once. Returns, for
+        each pair, the (source, sink) connection made for it (between
+        parameters lofted to the lowest subgraph containing both, as with
+        Parameter.connect), or None if it couldn't be made.
+
+        Unlike connecting each pair, every parameter is lofted once however
+        many pairs share it, and the connections are made with only
+        connection_added emitted (not the parameters' and nodes' signals),
+        all inside one batch.
+        '''
+        # (subgraph, other subgraph) -> the lowest subgraph containing both
+        commons = {}
+        # (param, common subgraph) -> param lofted up to it
+        lofted_sources = {}
+        lofted_sinks = {}
+        connections = []
+        with self.batch():
+            # Planning pass: loft every end, creating the lofted parameters
+            # and tunnels that aren't there yet
+            for source, sink in pairs:
+                if not (source.source and sink.sink):
+                    print('unable to connect')
+                    connections.append(None)
+                    continue
+                subgraph = source.connection_subgraph
+                other_subgraph = sink.connection_subgraph
+                if subgraph is not other_subgraph:
+                    key = (subgraph, other_subgraph)
+                    if key not in commons:
+                        commons[key] = None
+                        if (subgraph is not None and
+                                other_subgraph is not None):
+                            commons[key] = subgraph.lowest_common_ancestor(
+                                other_subgraph)
+                    common = commons[key]
+                    source = _loft_to(source, common, lofted_sources,
+                                      'loft_source')
+                    sink = _loft_to(sink, common, lofted_sinks, 'loft_sink')
+                    if source is None or sink is None:
+                        connections.append(None)
+                        continue
+                connections.append((source, sink))
+
+            # Connecting pass. The new edges are added to the topology
+            # together first, so the ones that would make a cycle are
+            # turned down before they're connected.
+            new = []
+            seen = set()
+            for i, connection in enumerate(connections):
+                if connection is None or connection in seen:
+                    continue
+                seen.add(connection)
+                source, sink = connection
+                if weakref.ref(sink) not in source._connections_out:
+                    new.append(i)
+            rejected = set(new[i] for i in self._topology.add_edges(
+                (topology.vertex(connections[i][0]),
+                 topology.vertex(connections[i][1])) for i in new))
+            adding_edges = self._adding_edges
+            self._adding_edges = True
+            try:
+                for i in new:
+                    source, sink = connections[i]
+                    if i in rejected:
+                        self.cycle_detected.emit(source=source, sink=sink)
+                        if self.reject_cycles:
+                            connections[i] = None
+                            continue
+                        self._cyclic_connections.add((source, sink))
+                    self._connect_quietly(source, sink)
+            finally:
+                self._adding_edges = adding_edges
+        return [connection if connection is not None and
+                weakref.ref(connection[1]) in connection[0]._connections_out
+                else None for connection in connections]
+
+    def _connect_quietly(self, source, sink):
+        '''Connect source to sink emitting only connection_added. Used by
+        connect_many and ramen.core.serialize.'''
+        sink_ref = weakref.ref(sink)
+        if sink_ref in source._connections_out:
+            return
+        if not self._connection_allowed(source, sink):
+            return
+        source._add_connection_out(sink)
+        sink._add_connection_in(source)
+        for param in (source, sink):
+            if isinstance(param, node.parameter.TunnelParameter):
+                # The subgraph's tunnel index isn't told otherwise
+                param.node._index_tunnel_connection(source, sink, True)
+        self.connection_added.emit(source=source, sink=sink)
+
     def clear(self):
         self.nodes = []
 
+    def _batch_recorders(self, changes):
+        # graph signal -> ChangeSet recorder
+        return [
+            (self.node_added, changes.record_node_added),
+            (self.node_removed, changes.record_node_removed),
+            (self.node_parent_changed, changes.record_node_parent_changed),
+            (self.node_id_changed, changes.record_node_id_changed),
+            (self.node_label_changed, changes.record_node_label_changed),
+            (self.node_pos_changed, changes.record_node_pos_changed),
+            (self.node_selected_changed,
+             changes.record_node_selected_changed),
+            (self.connection_added, changes.record_connection_added),
+            (self.connection_removed, changes.record_connection_removed),
+            (self.parameter_sink_changed,
+             changes.record_parameter_sink_changed),
+            (self.parameter_source_changed,
+             changes.record_parameter_source_changed),
+        ]
+
     @property
-    def selected_nodes(self):
-        return set(self._selected_nodes)
+    def batching(self):
+        return self._batch_depth > 0
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Coalesce the graph's change notifications:
+
+            with graph.batch():
+                ...
+
+        Every signal still fires per event, and the graph (and any slot
+        connected normally) stays up to date as it does. Slots connected
+        with Signal.connect_batched, to the graph's signals or to those of
+        its nodes and parameters, are skipped until the outermost batch
+        ends, when batch_committed is emitted once with a ChangeSet of the
+        collapsed changes.
+        '''
+        if self._batch_depth == 0:
+            self._batch_changes = ChangeSet()
+            for signal, recorder in self._batch_recorders(
+                    self._batch_changes):
+                signal.connect(recorder)
+                signal.deferring = True
+        self._batch_depth += 1
+        try:
+            yield self._batch_changes
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                changes = self._batch_changes
+                self._batch_changes = None
+                for signal, recorder in self._batch_recorders(changes):
+                    signal.disconnect(recorder)
+                    signal.deferring = False
+                if changes:
+                    self.batch_committed.emit(changes=changes)
+
+    def topological_order(self):
+        '''The computing (non-subgraph) nodes, each after every node it
+        depends on through connections. Maintained as connections change,
+        see ramen.core.topology.'''
+        return list(self.iter_topological_order())
+
+    def iter_topological_order(self):
+        '''topological_order, generated without copying it. The graph's
+        connections mustn't change while it's being iterated.'''
+        for vert in self._topology:
+            if isinstance(vert, node.Node) and vert.graph is self:
+                yield vert
+
+    @property
+    def reachability_index(self):
+        return self._reachability_index
+
+    def enable_reachability_index(self):
+        '''Answer Parameter.feeds queries from a transitive closure index,
+        see ramen.core.reachability'''
+        if self._reachability_index is None:
+            self._reachability_index = ReachabilityIndex(self)
+        return self._reachability_index
+
+    def disable_reachability_index(self):
+        if self._reachability_index is not None:
+            self._reachability_index.deregister_callbacks()
+            self._reachability_index = None
+
+    @property
+    def evaluator(self):
+        if self._evaluator is None:
+            self._evaluator = Evaluator(self)
+        return self._evaluator
+
+    def evaluate(self, param):
+        '''Pull the value of param, computing only what it depends on.
+        See ramen.core.evaluate.'''
+        return self.evaluator.evaluate(param)
+
+    def program(self, subgraph_node=None):
+        '''A generated evaluator of subgraph_node (the root node by
+        default), regenerated as the graph changes structurally. See
+        ramen.core.codegen.'''
+        return self._program(codegen.generate, subgraph_node)
+
+    def instanced_program(self, subgraph_node=None):
+        '''A generated evaluator of subgraph_node (the root node by
+        default) over many records at once. See ramen.core.instanced.'''
+        return self._program(instanced.generate, subgraph_node)
+
+    def _program(self, generate, subgraph_node):
+        if subgraph_node is None:
+            subgraph_node = self.root_node
+        programs = self._programs.setdefault(subgraph_node, {})
+        if generate not in programs:
+            programs[generate] = generate(subgraph_node)
+        return programs[generate]
+
+    def snapshot(self):
+        '''An immutable view of the graph as it is now, sharing whatever
+        didn't change with earlier snapshots. See ramen.core.snapshot.'''
+        if self._snapshot_tracker is None:
+            # Changes are only tracked from the first snapshot on
+            self._snapshot_tracker = SnapshotTracker(self)
+        return self._snapshot_tracker.snapshot()
+
+    def fork(self):
+        '''A mutable copy of the graph's snapshot, for what-if
+        evaluations. See ramen.core.snapshot.'''
+        return self.snapshot().fork()
+
+    def freeze(self):
+        '''A read-only compiled form of the graph as it is now, with dense
+        indices and arrays. See ramen.core.frozen.'''
+        return frozen.freeze(self)
 
     def __getitem__(self, node_id):
         return self._nodes.get(node_id, None)
@@ -80,42 +454,62 @@ class Graph(object):
 
     @property
     def selected_nodes(self):
-        return set(self._selected_nodes)
+        '''A read-only live view of the selection'''
+        return self._selected_nodes_view
 
     @selected_nodes.setter
     def selected_nodes(self, selected_nodes):
         selected_nodes = set(selected_nodes)
-        nodes_to_select = selected_nodes.difference(self._selected_nodes)
-        nodes_to_unselect = self._selected_nodes.difference(selected_nodes)
-        for node in nodes_to_select:
-            node.selected = True
-        for node in nodes_to_unselect:
-            node.selected = False
+        self._change_selection(
+            selected_nodes.difference(self._selected_nodes),
+            self._selected_nodes.difference(selected_nodes))
+
+    def select(self, nodes):
+        self._change_selection(nodes, ())
+
+    def deselect(self, nodes):
+        self._change_selection((), nodes)
+
+    def toggle(self, nodes):
+        nodes = set(nodes)
+        nodes_to_unselect = nodes.intersection(self._selected_nodes)
+        self._change_selection(nodes.difference(nodes_to_unselect),
+                               nodes_to_unselect)
 
     def clear_selection(self):
-        for node in self.get_selected_nodes():
-            node.set_selected(False)
+        self.deselect(list(self._selected_nodes))
+
+    def _change_selection(self, nodes_to_select, nodes_to_unselect):
+        # The whole change is made first, then every node emits its
+        # selected_changed, and the graph one selection_changed, all inside
+        # one batch
+        added = set()
+        removed = set()
+        for node in nodes_to_select:
+            if node not in self._selected_nodes and node.graph is self:
+                self._selected_nodes.add(node)
+                node._selected = True
+                added.add(node)
+        for node in nodes_to_unselect:
+            if node in self._selected_nodes:
+                self._selected_nodes.remove(node)
+                node._selected = False
+                removed.add(node)
+        if not (added or removed):
+            return
+        with self.batch():
+            for node in itertools.chain(added, removed):
+                node._emit('selected_changed', selected=node._selected)
+            self.selection_changed.emit(added=frozenset(added),
+                                        removed=frozenset(removed))
 
     def _uniquefy_node_id(self, node_id):
-        if node_id not in self:
-            return node_id
-        # The node_id can be either a string or int (or anything else you want,
-        # but we need to be able to make a unique type)
-        if type(node_id) == str:
-            attempt = 0
-            unique_node_id = node_id
-            while unique_node_id in self:
-                attempt += 1
-                unique_node_id = node_id + '_' + str(attempt)
-            return unique_node_id
-
-        elif type(node_id) == int or type(node_id) == float:
-            while node_id in self:
-                node_id += 1
-            return node_id
-
-        print('Warning! Unable to unquefy node_id type %s' %
-              str(type(node_id)))
+        return self._node_id_allocator.uniquefy(node_id, self._nodes)
+
+    def _unique_node_id(self, node, node_id):
+        '''node_id for node, or a unique one if another node has it'''
+        if self._nodes.get(node_id, node) is not node:
+            return self._uniquefy_node_id(node_id)
         return node_id
 
     @property
@@ -129,23 +523,172 @@ class Graph(object):
 
     def _node_added_callback(self, node):
         node_id = node.node_id
-        if node_id in self:
+        # Nodes from create_nodes are already registered under their id
+        if self._nodes.get(node_id, node) is not node:
             node_id = self._uniquefy_node_id(node_id)
             node.node_id = node_id
         if node.parent is None and node_id != self._root_node_id:
             node.parent = self.root_node
         self._nodes[node_id] = node
+        self._node_id_allocator.note(node_id)
+        if topology.is_vertex_node(node):
+            self._topology.add_vertex(node)
+        # A node coming back keeps its connections (to nodes in the graph,
+        # the others add theirs when they come back)
+        params = node.parameters
+        params.extend(getattr(node, '_tunnel_parameters', {}).values())
+        for param in params:
+            for sink in param.connections_out:
+                if sink.node.graph is self:
+                    self._index_connection(param, sink)
+                    self._topology.add_edge(topology.vertex(param),
+                                            topology.vertex(sink))
+            for source in param.connections_in:
+                if source.node.graph is self:
+                    self._index_connection(source, param)
+                    self._topology.add_edge(topology.vertex(source),
+                                            topology.vertex(param))
 
     def _node_removed_callback(self, node):
-        if node.node_id not in self:
+        if self._nodes.get(node.node_id) is not node:
             return
         if node.node_id == self._root_node_id:
             print('Warning: deleting root node')
             self._root_node_id = None
         del self._nodes[node.node_id]
+        self._programs.pop(node, None)
+        for pair in (self.connections_from(node) +
+                     self.connections_to(node)):
+            self._unindex_connection(*pair)
+        self._topology.remove_vertex(node)
+        for param in node.parameters:
+            self._topology.remove_vertex(param)
+        # A node isn't selected outside of a graph
+        node._selected = False
+        if node in self._selected_nodes:
+            self._selected_nodes.remove(node)
+            self.selection_changed.emit(added=frozenset(),
+                                        removed=frozenset([node]))
+
+    def _index_connection(self, source, sink):
+        pair = (source, sink)
+        if pair in self._connections:
+            return
+        subgraph = source.connection_subgraph
+        self._connections[pair] = (source.node, sink.node, subgraph)
+        self._connections_from.setdefault(source.node, set()).add(pair)
+        self._connections_to.setdefault(sink.node, set()).add(pair)
+        self._connections_within.setdefault(subgraph, set()).add(pair)
+
+    def _unindex_connection(self, source, sink):
+        pair = (source, sink)
+        if pair not in self._connections:
+            return
+        source_node, sink_node, subgraph = self._connections.pop(pair)
+        for index, key in ((self._connections_from, source_node),
+                           (self._connections_to, sink_node),
+                           (self._connections_within, subgraph)):
+            pairs = index[key]
+            pairs.discard(pair)
+            if not pairs:
+                del index[key]
+
+    def _connection_allowed(self, source, sink):
+        '''Whether source may be connected to sink. Parameters ask before
+        making a connection, so one that would make a cycle is turned down
+        (with cycle_detected) before anyone hears of it.'''
+        if not self.reject_cycles or self._adding_edges:
+            return True
+        if not self._topology.would_create_cycle(topology.vertex(source),
+                                                 topology.vertex(sink)):
+            return True
+        self.cycle_detected.emit(source=source, sink=sink)
+        return False
+
+    def _connection_added_callback(self, source, sink):
+        if weakref.ref(sink) not in source._connections_out:
+            # Already disconnected again
+            return
+        if source.node.graph is self and sink.node.graph is self:
+            self._index_connection(source, sink)
+        if self._adding_edges:
+            return
+        if not self._topology.add_edge(topology.vertex(source),
+                                       topology.vertex(sink)):
+            # Cycles are allowed, so it's kept but left out of the order
+            self._cyclic_connections.add((source, sink))
+            self.cycle_detected.emit(source=source, sink=sink)
+
+    def _connection_removed_callback(self, source, sink):
+        self._unindex_connection(source, sink)
+        if (source, sink) in self._cyclic_connections:
+            self._cyclic_connections.remove((source, sink))
+            return
+        self._topology.remove_edge(topology.vertex(source),
+                                   topology.vertex(sink))
+
+    def _node_parent_changed_callback(self, node):
+        # The connections of its parameters moved to another subgraph
+        for pair in (self.connections_from(node) +
+                     self.connections_to(node)):
+            self._unindex_connection(*pair)
+            self._index_connection(*pair)
+
+    def _parameter_added_callback(self, parameter):
+        # A parameter coming back keeps its connections (new ones have
+        # none)
+        if not (parameter._connections_out or parameter._connections_in):
+            return
+        for sink in parameter.connections_out:
+            if sink.node is not None and sink.node.graph is self:
+                self._index_connection(parameter, sink)
+        for source in parameter.connections_in:
+            if source.node is not None and source.node.graph is self:
+                self._index_connection(source, parameter)
+
+    def _parameter_removed_callback(self, parameter):
+        for sink in parameter.connections_out:
+            self._unindex_connection(parameter, sink)
+        for source in parameter.connections_in:
+            self._unindex_connection(source, parameter)
+        # A subgraph parameter is a vertex of its own
+        if topology.vertex(parameter) is parameter:
+            self._topology.remove_vertex(parameter)
+
+    def _node_id_changed_callback(self, node, old_node_id, node_id):
+        if self._nodes.get(old_node_id) is not node:
+            # Not registered under this id (yet), e.g. being uniquefied
+            # while it's added
+            return
+        del self._nodes[old_node_id]
+        self._nodes[node_id] = node
+        self._node_id_allocator.note(node_id)
+        if old_node_id == self._root_node_id:
+            self._root_node_id = node_id
 
     def _node_selected_changed_callback(self, node):
-        if not node.selected and node in self.selected_nodes:
+        if not node.selected and node in self._selected_nodes:
             self._selected_nodes.remove(node)
-        elif node.selected and node not in self.selected_nodes:
+            self.selection_changed.emit(added=frozenset(),
+                                        removed=frozenset([node]))
+        elif node.selected and node not in self._selected_nodes:
             self._selected_nodes.add(node)
+            self.selection_changed.emit(added=frozenset([node]),
+                                        removed=frozenset())
+
+
+def _loft_to(param, common, lofted, loft):
+    '''param lofted (by its loft method, loft_source or loft_sink) up to
+    the common subgraph, or None if it can't be. lofted caches the results by
+    (param, common) for every parameter on the way.'''
+    chain = []
+    while param is not None and param.connection_subgraph is not common:
+        key = (param, common)
+        if key in lofted:
+            param = lofted[key]
+            break
+        chain.append(key)
+        param = getattr(param, loft)()
+    for key in chain:
+        lofted[key] = param
+    return param
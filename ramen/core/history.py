@@ -0,0 +1,318 @@
+'''Undo/redo journal of a graph's changes.
+
+A History listens to the graph's signals and records every change as a
+small delta tuple, holding the objects involved and the old and new values
+rather than a copy of anything:
+
+    (NODE_ADDED, node, parent)
+    (NODE_REMOVED, node)
+    (NODE_PARENT, node, old parent, new parent)
+    (ATTRIBUTE, node or parameter, name, old value, new value)
+        for node_id, label and pos of nodes, and value, sink and source of
+        parameters
+    (PARAMETER_ADDED, parameter, node, parent parameter)
+    (PARAMETER_REMOVED, parameter, node, parent parameter)
+    (CONNECTED, source, sink)
+    (DISCONNECTED, source, sink)
+
+So a step costs memory in proportion to what changed, not to the graph.
+Removed nodes and parameters are kept alive by the journal, so undoing
+brings back the same objects (with their connections). TunnelParameters
+are recorded like any other parameter, which covers the ones created by
+Parameter.loft_sink/loft_source.
+
+Deltas are grouped into transactions:
+
+    with history.transaction('Move nodes'):
+        ...
+
+commits the transaction as one undo step when it ends, or rolls its
+changes back if it raises. begin(), commit() and rollback() do the same
+explicitly, and transactions nest (an inner one rolls back on its own, and
+is part of the outer one's step when committed). Changes made outside a
+transaction are grouped until the next commit() (undo and redo commit them
+first).
+
+undo() and redo() replay the deltas backwards or forwards through the same
+setters the changes went through, while the History ignores the signals
+that causes.
+'''
+import contextlib
+
+from ramen.core.node import parameter
+
+NODE_ADDED = 'node_added'
+NODE_REMOVED = 'node_removed'
+NODE_PARENT = 'node_parent'
+ATTRIBUTE = 'attribute'
+PARAMETER_ADDED = 'parameter_added'
+PARAMETER_REMOVED = 'parameter_removed'
+CONNECTED = 'connected'
+DISCONNECTED = 'disconnected'
+
+
+def _is_root_parameter(param, node):
+    '''Whether param is node's root parameter (or its tunnel), which the node
+    creates the first time it's needed and keeps, so it isn't a change'''
+    if isinstance(param, parameter.TunnelParameter):
+        param = param.tunneled_parameter
+    return param is node._root_parameter
+
+
+class History(object):
+    '''Undo/redo journal of a graph. See the module docstring.
+
+    max_steps limits how many undo steps are kept (oldest first out).
+    '''
+    def __init__(self, graph, max_steps=None):
+        self._graph = graph
+        self.max_steps = max_steps
+        # Deltas since the last commit
+        self._deltas = []
+        # Open transactions, outermost first: (index into _deltas, label)
+        self._transactions = []
+        # Committed steps: (label, deltas)
+        self._undo_steps = []
+        self._redo_steps = []
+        # Set while replaying, when changes aren't recorded
+        self._replaying = False
+        self.register_callbacks()
+
+    def _graph_callbacks(self):
+        graph = self.graph
+        return [
+            (graph.node_added, self._node_added_callback),
+            (graph.node_removed, self._node_removed_callback),
+            (graph.node_parent_changed, self._node_parent_changed_callback),
+            (graph.node_id_changed, self._node_id_changed_callback),
+            (graph.node_label_changed, self._node_label_changed_callback),
+            (graph.node_pos_changed, self._node_pos_changed_callback),
+            (graph.parameter_added, self._parameter_added_callback),
+            (graph.parameter_removed, self._parameter_removed_callback),
+            (graph.parameter_value_changed,
+             self._parameter_value_changed_callback),
+            (graph.parameter_sink_changed,
+             self._parameter_sink_changed_callback),
+            (graph.parameter_source_changed,
+             self._parameter_source_changed_callback),
+            (graph.connection_added, self._connection_added_callback),
+            (graph.connection_removed, self._connection_removed_callback),
+        ]
+
+    def register_callbacks(self):
+        # Weakly, so a History can be dropped without deregistering
+        for signal, callback in self._graph_callbacks():
+            signal.connect_weak(callback)
+
+    def deregister_callbacks(self):
+        for signal, callback in self._graph_callbacks():
+            signal.disconnect(callback)
+
+    @property
+    def graph(self):
+        return self._graph
+
+    @property
+    def can_undo(self):
+        return bool(self._undo_steps or self._deltas)
+
+    @property
+    def can_redo(self):
+        return bool(self._redo_steps)
+
+    @property
+    def undo_labels(self):
+        '''Labels of the undo steps, most recent last'''
+        return [label for label, _ in self._undo_steps]
+
+    @property
+    def redo_labels(self):
+        '''Labels of the redo steps, next one last'''
+        return [label for label, _ in self._redo_steps]
+
+    @property
+    def in_transaction(self):
+        return bool(self._transactions)
+
+    def clear(self):
+        '''Forget everything, including uncommitted changes'''
+        self._deltas = []
+        self._transactions = []
+        self._undo_steps = []
+        self._redo_steps = []
+
+    # Transactions
+    def begin(self, label=None):
+        self._transactions.append((len(self._deltas), label))
+
+    def commit(self):
+        '''End the innermost transaction. The outermost one (or, outside a
+        transaction, the changes since the last commit) becomes an undo
+        step.'''
+        label = None
+        if self._transactions:
+            _, label = self._transactions.pop()
+            if self._transactions:
+                return
+        if not self._deltas:
+            return
+        self._undo_steps.append((label, self._deltas))
+        self._deltas = []
+        self._redo_steps = []
+        if (self.max_steps is not None and
+                len(self._undo_steps) > self.max_steps):
+            del self._undo_steps[:-self.max_steps]
+
+    def rollback(self):
+        '''Revert the changes of the innermost transaction (or, outside a
+        transaction, the changes since the last commit) and end it.'''
+        start = 0
+        if self._transactions:
+            start, _ = self._transactions.pop()
+        deltas = self._deltas[start:]
+        del self._deltas[start:]
+        self._replay(reversed(deltas), undo=True)
+
+    @contextlib.contextmanager
+    def transaction(self, label=None):
+        self.begin(label)
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def undo(self):
+        '''Undo the last step. Returns whether there was one.'''
+        if self._transactions:
+            raise RuntimeError('Cannot undo during a transaction')
+        self.commit()
+        if not self._undo_steps:
+            return False
+        step = self._undo_steps.pop()
+        self._replay(reversed(step[1]), undo=True)
+        self._redo_steps.append(step)
+        return True
+
+    def redo(self):
+        '''Redo the last undone step. Returns whether there was one.'''
+        if self._transactions:
+            raise RuntimeError('Cannot redo during a transaction')
+        self.commit()
+        if not self._redo_steps:
+            return False
+        step = self._redo_steps.pop()
+        self._replay(step[1], undo=False)
+        self._undo_steps.append(step)
+        return True
+
+    # Replaying
+    def _replay(self, deltas, undo):
+        self._replaying = True
+        try:
+            with self.graph.batch():
+                for delta in deltas:
+                    if undo:
+                        self._undo_delta(delta)
+                    else:
+                        self._redo_delta(delta)
+        finally:
+            self._replaying = False
+
+    def _undo_delta(self, delta):
+        kind = delta[0]
+        if kind == NODE_ADDED:
+            delta[1].graph = None
+        elif kind == NODE_REMOVED:
+            delta[1].graph = self.graph
+        elif kind == NODE_PARENT:
+            delta[1].parent = delta[2]
+        elif kind == ATTRIBUTE:
+            setattr(delta[1], delta[2], delta[3])
+        elif kind == PARAMETER_ADDED:
+            delta[1].node = None
+        elif kind == PARAMETER_REMOVED:
+            self._add_parameter(delta[1], delta[2], delta[3])
+        elif kind == CONNECTED:
+            delta[1].disconnect_from_sink(delta[2])
+        elif kind == DISCONNECTED:
+            delta[1].connect_to_sink(delta[2])
+
+    def _redo_delta(self, delta):
+        kind = delta[0]
+        if kind == NODE_ADDED:
+            delta[1].parent = delta[2]
+            delta[1].graph = self.graph
+        elif kind == NODE_REMOVED:
+            delta[1].graph = None
+        elif kind == NODE_PARENT:
+            delta[1].parent = delta[3]
+        elif kind == ATTRIBUTE:
+            setattr(delta[1], delta[2], delta[4])
+        elif kind == PARAMETER_ADDED:
+            self._add_parameter(delta[1], delta[2], delta[3])
+        elif kind == PARAMETER_REMOVED:
+            delta[1].node = None
+        elif kind == CONNECTED:
+            delta[1].connect_to_sink(delta[2])
+        elif kind == DISCONNECTED:
+            delta[1].disconnect_from_sink(delta[2])
+
+    def _add_parameter(self, param, node, parent):
+        param.node = node
+        if parent is not None:
+            param.parent = parent
+
+    # Recording
+    def _record(self, *delta):
+        if not self._replaying:
+            self._deltas.append(delta)
+
+    def _record_attribute(self, obj, name, old_value, new_value):
+        # Values can be anything, so they aren't compared for equality
+        if old_value is not new_value:
+            self._record(ATTRIBUTE, obj, name, old_value, new_value)
+
+    def _node_added_callback(self, node):
+        self._record(NODE_ADDED, node, node.parent)
+
+    def _node_removed_callback(self, node):
+        self._record(NODE_REMOVED, node)
+
+    def _node_parent_changed_callback(self, node, parent, old_parent):
+        if parent is not old_parent:
+            self._record(NODE_PARENT, node, old_parent, parent)
+
+    def _node_id_changed_callback(self, node, old_node_id, node_id):
+        self._record_attribute(node, 'node_id', old_node_id, node_id)
+
+    def _node_label_changed_callback(self, node, label, old_label):
+        self._record_attribute(node, 'label', old_label, label)
+
+    def _node_pos_changed_callback(self, node, pos, old_pos):
+        self._record_attribute(node, 'pos', old_pos, pos)
+
+    def _parameter_added_callback(self, node, parameter):
+        if not _is_root_parameter(parameter, node):
+            self._record(PARAMETER_ADDED, parameter, node, parameter.parent)
+
+    def _parameter_removed_callback(self, node, parameter, parent):
+        self._record(PARAMETER_REMOVED, parameter, node, parent)
+
+    def _parameter_value_changed_callback(self, parameter, value,
+                                          old_value):
+        self._record_attribute(parameter, 'value', old_value, value)
+
+    def _parameter_sink_changed_callback(self, parameter, sink, old_sink):
+        self._record_attribute(parameter, 'sink', old_sink, sink)
+
+    def _parameter_source_changed_callback(self, parameter, source,
+                                           old_source):
+        self._record_attribute(parameter, 'source', old_source, source)
+
+    def _connection_added_callback(self, source, sink):
+        self._record(CONNECTED, source, sink)
+
+    def _connection_removed_callback(self, source, sink):
+        self._record(DISCONNECTED, source, sink)
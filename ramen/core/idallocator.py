@@ -0,0 +1,60 @@
+import math
+
+
+class IdAllocator(object):
+    '''Makes ids unique against the ids already in use.
+
+    Remembers the next suffix to try for each string id, and the largest
+    number in use, so making an id unique is amortized O(1) instead of
+    probing id_1, id_2, ... (or id + 1, id + 2, ...) from the start every
+    time. Ids freed by renames or removals are simply not handed out again.
+    Every id that goes into use has to be passed to note().
+    '''
+    __slots__ = ('_next_suffix', '_max_number')
+
+    def __init__(self):
+        # string id -> next suffix to try
+        self._next_suffix = {}
+        self._max_number = None
+
+    def note(self, used_id):
+        if type(used_id) == int or type(used_id) == float:
+            if self._max_number is None or used_id > self._max_number:
+                self._max_number = used_id
+
+    def uniquefy(self, used_id, *used_ids):
+        '''Return used_id, or a unique variation of it if it is in any of
+        the used_ids containers'''
+        def in_use(candidate):
+            for ids in used_ids:
+                if candidate in ids:
+                    return True
+            return False
+
+        if not in_use(used_id):
+            return used_id
+        # The id can be either a string or int (or anything else you want,
+        # but we need to be able to make a unique type)
+        if type(used_id) == str:
+            suffix = self._next_suffix.get(used_id, 1)
+            unique_id = used_id + '_' + str(suffix)
+            while in_use(unique_id):
+                suffix += 1
+                unique_id = used_id + '_' + str(suffix)
+            self._next_suffix[used_id] = suffix + 1
+            return unique_id
+
+        elif type(used_id) == int or type(used_id) == float:
+            if self._max_number is None:
+                self._max_number = used_id
+            unique_id = used_id + 1
+            if unique_id <= self._max_number:
+                unique_id = type(used_id)(math.floor(self._max_number)) + 1
+            # Only ids that weren't noted can be in use past the max
+            while in_use(unique_id):
+                unique_id += 1
+            self._max_number = unique_id
+            return unique_id
+
+        print('Warning! Unable to unquefy id type %s' % str(type(used_id)))
+        return used_id
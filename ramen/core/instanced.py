@@ -0,0 +1,251 @@
+'''Instanced evaluation: one subgraph over many records at once.
+
+An InstancedProgram evaluates a subgraph (as a ramen.core.codegen Program
+does) over N records, given as columns: {input parameter_id: column of N
+values}. It returns {output parameter_id: column of N values}. Inputs that
+aren't given are the parameter's value for every record.
+
+The records go through in batches of at most batch_size, to bound memory,
+and each batch goes through the graph once:
+
+    nodes whose compute_hints include VECTORIZED have their compute called
+    once per batch, with a column for each sink a connection feeds (a list
+    of columns, one per source, if several do, and the parameter's value
+    as is for the others), and return a column, or a single value for
+    every record, for each source; lists they return are columns
+    other nodes have their compute called once per record, as usual, and
+    their outputs gathered into columns
+
+If none of the nodes the outputs depend on are vectorized, the records go
+through the subgraph's Program (Graph.program) one at a time instead,
+which is quicker than gathering each node's outputs into columns.
+
+Columns are NumPy arrays if NumPy is installed, and Column lists
+otherwise, so vectorized computes can use NumPy's operators and
+broadcasting, and values that are lists aren't taken for columns.
+Connections and subgraphs work as they do everywhere else.
+'''
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ramen.core import codegen
+
+# compute_hints
+VECTORIZED = 'vectorized'
+
+DEFAULT_BATCH_SIZE = 65536
+
+
+class Column(list):
+    '''A column, without NumPy'''
+    __slots__ = ()
+
+
+def column(values):
+    '''values (an iterable) as a column'''
+    if numpy is None:
+        return Column(values)
+    values = list(values)
+    try:
+        res = numpy.asarray(values)
+    except ValueError:
+        # Sequences of different lengths
+        res = None
+    if res is None or res.ndim != 1:
+        # Values that are sequences stay whole
+        res = numpy.empty(len(values), dtype=object)
+        for i, value in enumerate(values):
+            res[i] = value
+    return res
+
+
+def is_column(value):
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        return value.ndim > 0
+    return isinstance(value, Column)
+
+
+def _broadcast(value, size):
+    '''value as a column of size, repeating it unless it is one'''
+    if is_column(value) and len(value) == size:
+        return value
+    return column([value] * size)
+
+
+def _values(values):
+    '''The column values as a list of plain Python values, which are much
+    quicker to go through one at a time than a NumPy array'''
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return values.tolist()
+    return values
+
+
+def _rows(values, start, stop):
+    '''The records of the column values from start to stop, as a column'''
+    if isinstance(values, Column):
+        return Column(values[start:stop])
+    return values[start:stop]
+
+
+def _records(size, *values):
+    '''A column of a list per record of values (columns, or the same value
+    for every record), for a sink several sources feed'''
+    values = [(_values(value), True) if is_column(value) else (value, False)
+              for value in values]
+    return column([value[i] if is_value_column else value
+                   for value, is_value_column in values]
+                  for i in range(size))
+
+
+def _vectorized(outputs):
+    '''The outputs of a vectorized compute, with lists as columns'''
+    return dict((key, column(value) if isinstance(value, list) and
+                 not is_column(value) else value)
+                for key, value in outputs.items())
+
+
+def _per_record(compute, inputs, flowing, size, defaults):
+    '''Call compute once per record, and gather its outputs into columns.
+    The inputs keyed in flowing are columns (or the same value for every
+    record), the others are passed as they are.'''
+    columns = [key for key in flowing if is_column(inputs[key])]
+    record = dict(inputs)
+    if not columns:
+        results = [compute(record) for i in range(size)]
+    elif len(columns) == 1:
+        key = columns[0]
+        results = []
+        for value in _values(inputs[key]):
+            record[key] = value
+            results.append(compute(record))
+    else:
+        results = []
+        for row in zip(*[_values(inputs[key]) for key in columns]):
+            record.update(zip(columns, row))
+            results.append(compute(record))
+    return dict((key, column([outputs.get(key, default)
+                              for outputs in results]))
+                for key, default in defaults.items())
+
+
+def _each_record(function, columns, size):
+    '''Call function, a Program's, once per record of columns, and gather
+    its outputs into columns'''
+    keys = list(columns)
+    if len(keys) == 1:
+        key = keys[0]
+        results = [function({key: value}) for value in _values(columns[key])]
+    elif keys:
+        rows = zip(*[_values(columns[key]) for key in keys])
+        results = [function(dict(zip(keys, row))) for row in rows]
+    else:
+        results = [function({}) for i in range(size)]
+    if not results:
+        return {}
+    return dict((key, column([outputs[key] for outputs in results]))
+                for key in results[0])
+
+
+def _concatenate(parts):
+    if numpy is not None:
+        return numpy.concatenate(parts)
+    res = Column()
+    for part in parts:
+        res.extend(part)
+    return res
+
+
+class InstancedProgram(codegen.Program):
+    '''A generated evaluator of a subgraph over many records. See the
+    module docstring.'''
+    _arguments = 'inputs, size'
+
+    def __init__(self, subgraph, batch_size=DEFAULT_BATCH_SIZE):
+        super(InstancedProgram, self).__init__(subgraph)
+        self.batch_size = batch_size
+        # Whether any of the nodes computed are vectorized
+        self._vectorized = False
+
+    def _generate(self):
+        self._vectorized = False
+        super(InstancedProgram, self)._generate()
+
+    def _fan_in(self, sources):
+        return '%s(size, %s)' % (self._bind('r', _records),
+                                 ', '.join(sources))
+
+    def _compute_call(self, compute_node, compute, inputs, outputs):
+        if VECTORIZED in compute_node.compute_hints:
+            # Values that are the same for every record still come as
+            # columns
+            broadcast = self._bind('b', _broadcast)
+            self._vectorized = True
+
+            def argument(key, value, sources):
+                if not sources:
+                    return '%s: %s' % (key, value)
+                columns = ['%s(%s, size)' % (broadcast, source)
+                           for source in sources]
+                if len(columns) == 1:
+                    return '%s: %s' % (key, columns[0])
+                return '%s: [%s]' % (key, ', '.join(columns))
+            return '%s(%s({%s}))' % (
+                self._bind('v', _vectorized), compute,
+                ', '.join(argument(*arg) for arg in inputs))
+        return '%s(%s, {%s}, (%s), size, {%s})' % (
+            self._bind('f', _per_record), compute,
+            ', '.join('%s: %s' % (key, value)
+                      for key, value, sources in inputs),
+            ''.join('%s, ' % key for key, value, sources in inputs
+                    if sources),
+            ', '.join('%s: %s' % output for output in outputs))
+
+    def __call__(self, columns, size=None, batch_size=None):
+        '''Evaluate the subgraph over the records in columns. size is the
+        number of records, needed only if there are no columns.'''
+        if size is None:
+            if not columns:
+                raise ValueError('No columns to take the size from')
+            size = len(next(iter(columns.values())))
+        for parameter_id, values in columns.items():
+            if len(values) != size:
+                raise ValueError('Column %s has %d records, not %d' %
+                                 (parameter_id, len(values), size))
+        if batch_size is None:
+            batch_size = self.batch_size
+        if batch_size < 1:
+            raise ValueError('Invalid batch size %s' % batch_size)
+        columns = dict(columns)
+        for parameter_id, values in columns.items():
+            if not is_column(values):
+                columns[parameter_id] = column(values)
+        function = self.function
+        if not self._vectorized:
+            subgraph = self.subgraph
+            record_function = subgraph.graph.program(subgraph).function
+        # output parameter_id -> its column for each batch
+        parts = {}
+        for start in range(0, size, batch_size):
+            stop = min(start + batch_size, size)
+            batch = dict((parameter_id, _rows(values, start, stop))
+                         for parameter_id, values in columns.items())
+            if self._vectorized:
+                outputs = function(batch, stop - start)
+            else:
+                outputs = _each_record(record_function, batch, stop - start)
+            for parameter_id, values in outputs.items():
+                parts.setdefault(parameter_id, []).append(
+                    _broadcast(values, stop - start))
+        if not parts:
+            return dict((param.parameter_id, column([]))
+                        for param in self._flat.outputs)
+        return dict((parameter_id, _concatenate(values))
+                    for parameter_id, values in parts.items())
+
+
+def generate(subgraph_node, batch_size=DEFAULT_BATCH_SIZE):
+    '''An InstancedProgram of subgraph_node. Graph.instanced_program caches
+    one per subgraph.'''
+    return InstancedProgram(subgraph_node, batch_size=batch_size)
@@ -1,17 +1,59 @@
+import weakref
+
+from ramen.core.signal import LazySignal, SignalEmitter
 # TODO: add support for parent-child connections, with a deep
 # sink/source
 
 
-class Connectable(object):
+def _live(refs):
+    '''The objects in a set of _ConnectionRefs. They drop themselves when
+    their parameter dies, so they're all alive.'''
+    return set([ref() for ref in refs])
+
+
+def _connection_freed(ref):
+    owner = ref._owner()
+    if owner is not None:
+        getattr(owner, ref._attr).discard(ref)
+
+
+class _ConnectionRef(weakref.ref):
+    '''A weak reference to a connected parameter, which removes itself from
+    its owner's connections (the attribute named attr) when the parameter
+    is freed. There's nobody to tell, since the connection's other end is
+    gone. It equals a plain weak reference to the same parameter.'''
+    __slots__ = ('_owner', '_attr')
+
+    def __new__(cls, param, owner, attr):
+        self = weakref.ref.__new__(cls, param, _connection_freed)
+        # The owner's plain weak reference, which is shared
+        self._owner = weakref.ref(owner)
+        self._attr = attr
+        return self
+
+    def __init__(self, param, owner, attr):
+        super(_ConnectionRef, self).__init__(param, _connection_freed)
+
+
+class Connectable(SignalEmitter):
+    # No __slots__ of its own, since Parameter also derives from Parentable
+    # (two bases can't both have slots). Classes deriving from it need
+    # slots for _connections_in, _connections_out, _sink, _source and the
+    # signals below.
+    __slots__ = ()
+
+    connection_added = LazySignal('_connection_added')
+    connection_removed = LazySignal('_connection_removed')
+    sink_changed = LazySignal('_sink_changed')
+    source_changed = LazySignal('_source_changed')
+
     def __init__(self):
+        # Weak references (_ConnectionRefs) to the connected parameters.
+        # Parameters are owned by their nodes, so a connection doesn't keep
+        # either end alive (or make a reference cycle between them).
         self._connections_in = set()
         self._connections_out = set()
 
-        self.connection_added = Signal()
-        self.connection_removed = Signal()
-        self.sink_changed = Signal()
-        self.source_changed = Signal()
-
         self._sink = False
         self._source = False
 
@@ -21,8 +63,9 @@ class Connectable(object):
 
     @sink.setter
     def sink(self, sink):
+        old_sink = self._sink
         self._sink = sink
-        self.sink_changed.emit()
+        self._emit('sink_changed', sink=sink, old_sink=old_sink)
 
     @property
     def source(self):
@@ -30,22 +73,44 @@ class Connectable(object):
 
     @source.setter
     def source(self, source):
+        old_source = self._source
         self._source = source
-        self.source_changed.emit()
+        self._emit('source_changed', source=source, old_source=old_source)
+
+    def _add_connection_in(self, param):
+        self._connections_in.add(
+            _ConnectionRef(param, self, '_connections_in'))
+
+    def _add_connection_out(self, param):
+        self._connections_out.add(
+            _ConnectionRef(param, self, '_connections_out'))
+
+    def iter_connections_in(self):
+        '''The parameters connected into this one, without copying them
+        into a set. Connections mustn't change while iterating.'''
+        for ref in self._connections_in:
+            yield ref()
+
+    def iter_connections_out(self):
+        '''The parameters this one is connected to, without copying them
+        into a set. Connections mustn't change while iterating.'''
+        for ref in self._connections_out:
+            yield ref()
 
     @property
     def connections_out(self):
-        return set(self._connections_out)
+        return _live(self._connections_out)
 
     @property
     def connections_in(self):
         # TODO: make this work with .append and .extend, etc
-        return set(self._connections_in)
+        return _live(self._connections_in)
 
     @connections_out.setter
     def connections_out(self, new_conns):
-        nodes_to_connect = new_conns.difference(self._connections_out)
-        nodes_to_disconnect = self._connections_out.difference(new_conns)
+        cur_conns = self.connections_out
+        nodes_to_connect = new_conns.difference(cur_conns)
+        nodes_to_disconnect = cur_conns.difference(new_conns)
         for node in nodes_to_connect:
             self.connect_to_source(node)
         for node in nodes_to_disconnect:
@@ -53,8 +118,9 @@ class Connectable(object):
 
     @connections_in.setter
     def connections_in(self, new_conns):
-        nodes_to_connect = new_conns.difference(self._connections_in)
-        nodes_to_disconnect = self._connections_in.difference(new_conns)
+        cur_conns = self.connections_in
+        nodes_to_connect = new_conns.difference(cur_conns)
+        nodes_to_disconnect = cur_conns.difference(new_conns)
         for node in nodes_to_connect:
             self.connect_to_sink(node)
         for node in nodes_to_disconnect:
@@ -62,7 +128,8 @@ class Connectable(object):
 
     @property
     def connections(self):
-        all_conns = self._connections_in.union(self._connections_out)
+        all_conns = _live(self._connections_in)
+        all_conns.update(_live(self._connections_out))
         return all_conns
 
     @connections.setter
@@ -90,46 +157,62 @@ class Connectable(object):
         self.disconnect_from_source(param)
 
     def disconnect_from_source(self, param):
-        if param in self._connections_in:
-            self._connections_in.remove(param)
+        param_ref = weakref.ref(param)
+        if param_ref in self._connections_in:
+            self._connections_in.remove(param_ref)
             param.disconnect(self)
-            self.connection_removed.emit(source=param, sink=self)
+            self._emit('connection_removed', source=param, sink=self)
 
     def disconnect_from_sink(self, param):
-        if param in self._connections_out:
-            self._connections_out.remove(param)
+        param_ref = weakref.ref(param)
+        if param_ref in self._connections_out:
+            self._connections_out.remove(param_ref)
             param.disconnect(self)
-            self.connection_removed.emit(source=self, sink=param)
+            self._emit('connection_removed', source=self, sink=param)
+
+    def _connection_allowed(self, source, sink):
+        '''Whether a connection from source to sink may be made. Asked once
+        per connection, by the end it's made from, before either end
+        records it.'''
+        return True
 
     def connect_to_source(self, param):
         if not (self.sink and param.source):
             return
 
-        if param in self._connections_in:
+        param_ref = weakref.ref(param)
+        if param_ref in self._connections_in:
             # This if is a little bit tricky w/ circular recursion
             # One side knows about this connection, so we don't need to
             # do anything.
             return
-        self._connections_in.add(param)
+        if (weakref.ref(self) not in param._connections_out and
+                not self._connection_allowed(param, self)):
+            return
+        self._add_connection_in(param)
         param.connect_to_sink(self)
         # This parameter connection may have been rejected, so
         # check that it was successfully created before emitting
-        if param in self._connections_in:
+        if param_ref in self._connections_in:
             # This creates two connection_added emissions (one on source and
             # one on sink). TODO: should we make it only one signal?
-            self.connection_added.emit(source=param, sink=self)
+            self._emit('connection_added', source=param, sink=self)
 
     def connect_to_sink(self, param):
         if not (self.source and param.sink):
             return
-        if param in self._connections_out:
+        param_ref = weakref.ref(param)
+        if param_ref in self._connections_out:
+            return
+        if (weakref.ref(self) not in param._connections_in and
+                not self._connection_allowed(self, param)):
             return
-        self._connections_out.add(param)
+        self._add_connection_out(param)
         param.connect_to_source(self)
         # This parameter connection may have been rejected, so
         # check that it was successfully created before emitting
-        if param in self._connections_out:
-            self.connection_added.emit(source=self, sink=param)
+        if param_ref in self._connections_out:
+            self._emit('connection_added', source=self, sink=param)
 
     def disconnectAll(self):
         self.connections = set()
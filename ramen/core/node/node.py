@@ -1,9 +1,63 @@
-from ramen.core.signal import Signal
+import weakref
+
+from ramen.core.signal import LazySignal
+from ramen.core.idallocator import IdAllocator
 from ramen.core.node import parentable
 from ramen.core.node import parameter
 
+# Node signal -> (graph signal it lofts up to, whether the graph signal
+# gets node=)
+_GRAPH_SIGNALS = {
+    'pos_changed': ('node_pos_changed', True),
+    'selected_changed': ('node_selected_changed', True),
+    'node_id_changed': ('node_id_changed', True),
+    'label_changed': ('node_label_changed', True),
+    'parent_changed': ('node_parent_changed', True),
+    'parameter_added': ('parameter_added', True),
+    'parameter_removed': ('parameter_removed', True),
+    'attributes_changed': ('node_attributes_changed', True),
+    'compute_changed': ('node_compute_changed', True),
+    'connection_added': ('connection_added', False),
+    'connection_removed': ('connection_removed', False),
+    'parameter_sink_changed': ('parameter_sink_changed', False),
+    'parameter_source_changed': ('parameter_source_changed', False),
+    'parameter_value_changed': ('parameter_value_changed', False),
+}
+# "attributes_changed" is really one of these
+_ATTRIBUTE_SIGNALS = frozenset(['pos_changed', 'selected_changed',
+                                'label_changed'])
+
 
 class Node(parentable.Parentable):
+    __slots__ = ('_node_id', '_label', '_pos', '_selected', '_graph',
+                 '_parameters', '_parameter_id_allocator', '_root_parameter',
+                 '_compute', '_compute_hints', '_registered',
+                 '_node_id_changed', '_label_changed', '_pos_changed',
+                 '_selected_changed', '_compute_changed',
+                 '_attributes_changed', '_parameter_added',
+                 '_parameter_removed', '_connection_added',
+                 '_connection_removed', '_parameter_sink_changed',
+                 '_parameter_source_changed', '_parameter_value_changed')
+
+    # Signals
+    node_id_changed = LazySignal('_node_id_changed')
+    label_changed = LazySignal('_label_changed')
+    pos_changed = LazySignal('_pos_changed')
+    selected_changed = LazySignal('_selected_changed')
+    compute_changed = LazySignal('_compute_changed')
+    attributes_changed = LazySignal('_attributes_changed')
+
+    # Parameters
+    parameter_added = LazySignal('_parameter_added')
+    parameter_removed = LazySignal('_parameter_removed')
+
+    # Parameter's signals loft up
+    connection_added = LazySignal('_connection_added')
+    connection_removed = LazySignal('_connection_removed')
+    parameter_sink_changed = LazySignal('_parameter_sink_changed')
+    parameter_source_changed = LazySignal('_parameter_source_changed')
+    parameter_value_changed = LazySignal('_parameter_value_changed')
+
     def __init__(self, parent=None, label=None, node_id=0, graph=None):
         super(Node, self).__init__()
         # If a parent is provided, use the parent's graph.
@@ -16,46 +70,42 @@ class Node(parentable.Parentable):
         if graph is None:
             raise RuntimeError('Node created with an invalid graph')
 
+        self._init_node(label, node_id, graph)
+
+        self.parent = parent
+        self.accepts_children = False
+        self.register_callbacks()
+        graph.node_added.emit(node=self)
+
+    @classmethod
+    def _create_quietly(cls, label, node_id, graph):
+        '''Create a node without parenting it, registering its callbacks or
+        emitting anything. Used by Graph.create_nodes.'''
+        new_node = cls.__new__(cls)
+        parentable.Parentable.__init__(new_node)
+        new_node._init_node(label, node_id, graph)
+        # As in __init__, the setter forces the class's own value
+        new_node.accepts_children = False
+        return new_node
+
+    def _init_node(self, label, node_id, graph):
         # Properties
         self._node_id = node_id
         self._label = label
         self._pos = (0, 0)
         self._selected = False
-        self._graph = graph
+        # Weak reference to the graph, which owns its nodes
+        self._graph = weakref.ref(graph)
         self._parameters = {}
+        self._parameter_id_allocator = IdAllocator()
         self._root_parameter = None
-
-        # Signals
-        self.node_id_changed = Signal()
-        self.label_changed = Signal()
-        self.pos_changed = Signal()
-        self.selected_changed = Signal()
-
-        self.attributes_changed = Signal()
-        # "attributes_changed" is really one of four other signals
-        # TODO: we could change the args into a dict
-        self.pos_changed.connect(self.attributes_changed.emit)
-        self.selected_changed.connect(self.attributes_changed.emit)
-        self.label_changed.connect(self.attributes_changed.emit)
-
-        # Parameters
-        self.parameter_added = Signal()
-        self.parameter_removed = Signal()
-
-        # Parameter's signals loft up
-        self.connection_added = Signal()
-        self.connection_removed = Signal()
-        self.parameter_sink_changed = Signal()
-        self.parameter_source_changed = Signal()
-
-        # Connect parameter_added to callbacks here
-        self.parameter_added.connect(self._parameter_added_callback)
-        self.parameter_removed.connect(self._parameter_removed_callback)
-
-        self.parent = parent
-        self.accepts_children = False
-        self.register_callbacks()
-        self._graph.node_added.emit(node=self)
+        # Called with {sink parameter_id: value}, returns
+        # {source parameter_id: value}. See ramen.core.evaluate
+        self._compute = None
+        # How compute can be scheduled, see ramen.core.scheduler
+        self._compute_hints = frozenset()
+        # Whether signals loft up to the graph
+        self._registered = False
 
     def delete(self):
         self.parent = None
@@ -69,62 +119,45 @@ class Node(parentable.Parentable):
         return '<%s: %s%s>' % (self.__class__.__name__, self.node_id,
                                label_str)
 
-    def _connection_added_filter(self, fn, **kwargs):
-        """Prevent duplicate lofted connection_added signals by only
-        emitting if we're the source of the connection added"""
-        source = kwargs['source']
-        if source.node == self:
-            fn(**kwargs)
+    def _emit(self, name, **kwargs):
+        super(Node, self)._emit(name, **kwargs)
+        if name in _ATTRIBUTE_SIGNALS:
+            self._emit('attributes_changed', **kwargs)
+        if not self._registered or name not in _GRAPH_SIGNALS:
+            return
+        if name in ('connection_added', 'connection_removed'):
+            # Prevent duplicate lofted connection signals by only lofting
+            # if we're the source of the connection
+            if kwargs['source'].node is not self:
+                return
+        graph = self._graph()
+        if graph is None:
+            return
+        graph_name, with_node = _GRAPH_SIGNALS[name]
+        if with_node:
+            kwargs['node'] = self
+        getattr(graph, graph_name).emit(**kwargs)
 
-    def _connection_removed_filter(self, fn, **kwargs):
-        """Prevent duplicate lofted connection_removed signals by only
-        emitting if we're the source of the connection added"""
-        source = kwargs['source']
-        if source.node == self:
-            fn(**kwargs)
+    def _deferring(self):
+        graph = self.graph
+        return graph is not None and graph.batching
 
     def register_callbacks(self):
-        # Graph level signals
-        self.pos_changed.connect(self.graph.node_pos_changed.emit, node=self)
-        self.selected_changed.connect(self.graph.node_selected_changed.emit,
-                                      node=self)
-        self.node_id_changed.connect(self.graph.node_id_changed.emit,
-                                     node=self)
-        self.label_changed.connect(self.graph.node_label_changed.emit,
-                                   node=self)
-        self.parent_changed.connect(self.graph.node_parent_changed.emit,
-                                    node=self)
-        self.attributes_changed.connect(
-            self.graph.node_attributes_changed.emit, node=self)
-
-        # lofted parameter signals
-        # self.connection_added.connect(self.graph.connection_added.emit)
-        self.connection_added.connect(self._connection_added_filter,
-                                      fn=self.graph.connection_added.emit)
-        self.connection_removed.connect(self._connection_removed_filter,
-                                        fn=self.graph.connection_removed.emit)
-        self.parameter_sink_changed.connect(
-            self.graph.parameter_sink_changed.emit)
-        self.parameter_source_changed.connect(
-            self.graph.parameter_source_changed.emit)
+        # Graph level signals, and lofted parameter signals
+        self._registered = True
 
     def deregister_callbacks(self):
-        # Graph level signals
-        self.pos_changed.disconnect(self.graph.node_pos_changed.emit)
-        self.selected_changed.disconnect(self.graph.node_selected_changed.emit)
-        self.node_id_changed.disconnect(self.graph.node_id_changed.emit)
-        self.label_changed.disconnect(self.graph.node_label_changed.emit)
-        self.parent_changed.disconnect(self.graph.node_parent_changed.emit)
-        self.attributes_changed.disconnect(
-                self.graph.node_attributes_changed.emit)
-
-        # lofted parameter signals
-        self.connection_added.disconnect(self._connection_added_filter)
-        self.connection_removed.disconnect(self._connection_removed_filter)
-        self.parameter_sink_changed.disconnect(
-                self.graph.parameter_sink_changed.emit)
-        self.parameter_source_changed.disconnect(
-                self.graph.parameter_source_changed.emit)
+        self._registered = False
+
+    def _add_parameter(self, parameter):
+        self._parameter_added_callback(parameter)
+        self._emit('parameter_added', parameter=parameter, param=parameter)
+
+    def _remove_parameter(self, parameter, parent=None):
+        # parent is the one the parameter had, for undoing
+        self._parameter_removed_callback(parameter)
+        self._emit('parameter_removed', parameter=parameter, param=parameter,
+                   parent=parent)
 
     @property
     def node_id(self):
@@ -133,9 +166,14 @@ class Node(parentable.Parentable):
     @node_id.setter
     def node_id(self, val):
         old_node_id = self._node_id
+        graph = self.graph
+        if graph is not None:
+            # Renaming onto a used id gets a unique one instead, before
+            # anyone hears of it
+            val = graph._unique_node_id(self, val)
         self._node_id = val
-        self.node_id_changed.emit(old_node_id=old_node_id,
-                                  node_id=self._node_id)
+        self._emit('node_id_changed', old_node_id=old_node_id,
+                   node_id=self._node_id)
 
     @node_id.deleter
     def node_id(self):
@@ -147,8 +185,9 @@ class Node(parentable.Parentable):
 
     @label.setter
     def label(self, val):
+        old_label = self._label
         self._label = val
-        self.label_changed.emit(label=self._label)
+        self._emit('label_changed', label=self._label, old_label=old_label)
 
     @label.deleter
     def label(self):
@@ -160,8 +199,9 @@ class Node(parentable.Parentable):
 
     @pos.setter
     def pos(self, val):
+        old_pos = self._pos
         self._pos = val
-        self.pos_changed.emit(pos=self._pos)
+        self._emit('pos_changed', pos=self._pos, old_pos=old_pos)
 
     @pos.deleter
     def pos(self):
@@ -174,16 +214,39 @@ class Node(parentable.Parentable):
     @selected.setter
     def selected(self, val):
         self._selected = val
-        self.selected_changed.emit(selected=self._selected)
+        self._emit('selected_changed', selected=self._selected)
 
     @selected.deleter
     def selected(self):
         del self._selected
 
+    @property
+    def compute(self):
+        return self._compute
+
+    @compute.setter
+    def compute(self, compute):
+        self._compute = compute
+        self._emit('compute_changed')
+
+    @property
+    def compute_hints(self):
+        return self._compute_hints
+
+    @compute_hints.setter
+    def compute_hints(self, compute_hints):
+        self._compute_hints = frozenset(compute_hints)
+        # How compute is called is part of it, see ramen.core.instanced
+        self._emit('compute_changed')
+
     @property
     def root_parameter(self):
         if self._root_parameter is None:
-            self._root_parameter = parameter.Parameter(node=self)
+            # Set before it's added to the node, so parameter_added listeners
+            # can tell it's the root
+            self._root_parameter = parameter.Parameter.__new__(
+                parameter.Parameter)
+            self._root_parameter.__init__(node=self)
         return self._root_parameter
 
     @root_parameter.setter
@@ -193,20 +256,26 @@ class Node(parentable.Parentable):
 
     @property
     def graph(self):
-        return self._graph
+        if self._graph is None:
+            return None
+        return self._graph()
 
     @graph.setter
     def graph(self, new_graph):
-        if self._graph == new_graph:
+        old_graph = self.graph
+        if old_graph == new_graph:
             return
         self.deregister_callbacks()
         if self.parent is not None and self.parent.graph != new_graph:
             self.parent = None
-        self._graph.node_removed.emit(node=self)
-        self._graph = new_graph
-        if self._graph is not None:
-            self.register_callbacks()
-            self._graph.node_added.emit(node=self)
+        if old_graph is not None:
+            old_graph.node_removed.emit(node=self)
+        if new_graph is None:
+            self._graph = None
+            return
+        self._graph = weakref.ref(new_graph)
+        self.register_callbacks()
+        new_graph.node_added.emit(node=self)
 
     @property
     def parameters(self):
@@ -247,41 +316,80 @@ class Node(parentable.Parentable):
             parameter.parameter_id = self._uniquefy_parameter_id(
                     parameter.parameter_id)
         self._parameters[parameter.parameter_id] = parameter
+        self._parameter_id_allocator.note(parameter.parameter_id)
 
     def _parameter_removed_callback(self, parameter):
-        if param.parameter_id in self._parameters:
-            del self._parameters[param.parameter_id]
+        if self._parameters.get(parameter.parameter_id) is parameter:
+            del self._parameters[parameter.parameter_id]
 
     def _uniquefy_parameter_id(self, param_id):
-        if not param_id not in self._parameters:
-            return param_id
-        # The param_id can be either a string or int (or anything you want,
-        # but we need to be able to make a unique type)
-        if type(param_id) == type(str):
-            attempt = 0
-            unique_id = param_id
-            while unique_id in self._parameters:
-                attempt += 1
-                unique_id = param_id + '_' + str(attempt)
-            return unique_id
-
-        elif type(param_id) == type(int) or type(param_id) == type(float):
-            while unique_id in self._parameters:
-                unique_id += 1
-            return unique_id
-
-        print('Warning! Unable to unquefy node_id type %s' %
-              str(type(node_id)))
-        return param_id
+        return self._parameter_id_allocator.uniquefy(param_id,
+                                                     self._parameters)
 
 
 class SubgraphNode(Node):
+    __slots__ = ('_tunnel_parameters', '_parameter_to_tunnel',
+                 '_tunnel_to_parameter', '_feeding_tunnels',
+                 '_fed_tunnels', '_chunk_store')
+
     def __init__(self, *args, **kwargs):
+        super(SubgraphNode, self).__init__(*args, **kwargs)
+        self.accepts_children = True
+
+    def _init_node(self, *args, **kwargs):
         self._tunnel_parameters = {}
         self._parameter_to_tunnel = {}
         self._tunnel_to_parameter = {}
-        super(SubgraphNode, self).__init__(*args, **kwargs)
-        self.accepts_children = True
+        # Weak reference to a parameter -> the tunnels connected to it, as
+        # sources (feeding it) and as sinks (fed by it), so lofting finds
+        # the tunnel already serving a parameter without a scan. Kept
+        # current by the tunnels' connection signals.
+        self._feeding_tunnels = {}
+        self._fed_tunnels = {}
+        # Weak reference to where the contents come from when they're
+        # loaded lazily, see ramen.core.serialize.ChunkStore
+        self._chunk_store = None
+        super(SubgraphNode, self)._init_node(*args, **kwargs)
+
+    def _emit(self, name, **kwargs):
+        if name in ('connection_added', 'connection_removed'):
+            self._index_tunnel_connection(kwargs['source'], kwargs['sink'],
+                                          name == 'connection_added')
+        super(SubgraphNode, self)._emit(name, **kwargs)
+
+    def _index_tunnel_connection(self, source, sink, connected):
+        for tunnel, param, index in ((source, sink, self._feeding_tunnels),
+                                     (sink, source, self._fed_tunnels)):
+            if self._tunnel_to_parameter.get(tunnel) is None:
+                continue
+            param_ref = weakref.ref(param)
+            if connected:
+                index.setdefault(param_ref, set()).add(tunnel)
+            elif param_ref in index:
+                tunnels = index[param_ref]
+                tunnels.discard(tunnel)
+                if not tunnels:
+                    del index[param_ref]
+
+    def _index_tunnel(self, tunnel, connected):
+        for sink in tunnel.connections_out:
+            self._index_tunnel_connection(tunnel, sink, connected)
+        for source in tunnel.connections_in:
+            self._index_tunnel_connection(source, tunnel, connected)
+
+    def ensure_loaded(self):
+        '''Load the contents of a lazily loaded subgraph, if they aren't
+        already'''
+        if self._chunk_store is None:
+            return
+        chunk_store = self._chunk_store()
+        if chunk_store is not None:
+            chunk_store.touch(self)
+
+    @parentable.Parentable.children.getter
+    def children(self):
+        self.ensure_loaded()
+        return set(self._children)
 
     @property
     def accepts_children(self):
@@ -293,41 +401,81 @@ class SubgraphNode(Node):
         parentable.Parentable.accepts_children.fset(self, True)
 
     def _parameter_added_callback(self, param):
+        is_tunnel = isinstance(param, parameter.TunnelParameter)
+        if is_tunnel:
+            tunneled_param = param.tunneled_parameter
+            old_tunnel = self._parameter_to_tunnel.get(tunneled_param)
+            if old_tunnel is not None and old_tunnel is not param:
+                # A tunnel coming back (e.g. undoing its removal, see
+                # ramen.core.history) replaces the one its parameter got
+                # when it came back first
+                del self._parameter_to_tunnel[tunneled_param]
+                del self._tunnel_to_parameter[old_tunnel]
+                old_tunnel.node = None
+
         # This is pretty dirty, TODO: clean up
         if (param.parameter_id in self._parameters or
                 param.parameter_id in self._tunnel_parameters):
             param.parameter_id = self._uniquefy_parameter_id(
                 param.parameter_id)
 
-        if isinstance(param, parameter.TunnelParameter):
+        if is_tunnel:
             self._tunnel_parameters[param.parameter_id] = param
+            self._parameter_id_allocator.note(param.parameter_id)
+            self._parameter_to_tunnel[tunneled_param] = param
+            self._tunnel_to_parameter[param] = tunneled_param
+            # A tunnel coming back keeps its connections
+            self._index_tunnel(param, True)
         else:
             super(SubgraphNode, self)._parameter_added_callback(param)
-            tunnel = parameter.TunnelParameter(parameter=param)
-            self._parameter_to_tunnel[param] = tunnel
-            self._tunnel_to_parameter[tunnel] = param
+            # Unless its tunnel came back first
+            if param not in self._parameter_to_tunnel:
+                parameter.TunnelParameter(parameter=param)
 
     def _parameter_removed_callback(self, param):
-        # This is pretty dirty, TODO: clean up
+        # A parameter and its tunnel go together: removing either removes
+        # the other (which calls back here, finding the mappings gone)
         if isinstance(param, parameter.TunnelParameter):
-            if param.parameter_id in self._tunnel_parameters:
+            if self._tunnel_parameters.get(param.parameter_id) is param:
                 del self._tunnel_parameters[param.parameter_id]
-                if param in self._tunnel_to_parameter:
-                    self._tunnel_to_parameter[param].node = None
+            self._index_tunnel(param, False)
+            tunneled_param = self._tunnel_to_parameter.pop(param, None)
+            if tunneled_param is not None:
+                del self._parameter_to_tunnel[tunneled_param]
+                tunneled_param.node = None
         else:
-            tunnel_param = self.get_tunnel_parameter(param)
-            tunnel_param.node = None
-            tunnel_param.tunneledParameter = None
-            super(SubgraphNode, self)._parameter_added_callback(param)
-            del self._parameter_to_tunnel[param]
-            del self._tunnel_to_parameter[tunnel_param]
+            super(SubgraphNode, self)._parameter_removed_callback(param)
+            tunnel_param = self._parameter_to_tunnel.pop(param, None)
+            if tunnel_param is not None:
+                self._index_tunnel(tunnel_param, False)
+                del self._tunnel_to_parameter[tunnel_param]
+                tunnel_param.node = None
+
+    def _uniquefy_parameter_id(self, param_id):
+        # Tunnel parameters share the id space with regular parameters
+        return self._parameter_id_allocator.uniquefy(
+            param_id, self._parameters, self._tunnel_parameters)
 
     def get_tunnel_parameter(self, param):
+        self.ensure_loaded()
         return self._parameter_to_tunnel.get(param, None)
 
     def get_parameter_for_tunnel(self, tunnel):
         return self._tunnel_to_parameter.get(tunnel, None)
 
+    def get_feeding_tunnel(self, param):
+        '''A tunnel of this subgraph connected to param, as its source'''
+        self.ensure_loaded()
+        tunnels = self._feeding_tunnels.get(weakref.ref(param))
+        return None if not tunnels else next(iter(tunnels))
+
+    def get_fed_tunnel(self, param):
+        '''A tunnel of this subgraph connected to param, as its sink'''
+        self.ensure_loaded()
+        tunnels = self._fed_tunnels.get(weakref.ref(param))
+        return None if not tunnels else next(iter(tunnels))
+
     @property
     def tunnel_parameters(self):
+        self.ensure_loaded()
         return list(self._tunnel_parameters.values())
@@ -1,37 +1,43 @@
-from ramen.core.signal import Signal
+import weakref
+
+from ramen.core.signal import LazySignal
+from ramen.core import reachability
 from ramen.core.node import parentable
 from ramen.core.node import connectable
 
+# Parameter signal -> node signal it lofts up to
+_NODE_SIGNALS = {
+    'connection_added': 'connection_added',
+    'connection_removed': 'connection_removed',
+    'sink_changed': 'parameter_sink_changed',
+    'source_changed': 'parameter_source_changed',
+    'value_changed': 'parameter_value_changed',
+}
+
 
 class Parameter(parentable.Parentable, connectable.Connectable):
+    __slots__ = ('_parameter_id', '_label', '_index', '_value', '_dirty',
+                 '_node', '_registered', '_connections_out',
+                 '_connections_in', '_sink', '_source',
+                 '_parameter_id_changed', '_label_changed', '_index_changed',
+                 '_value_changed', '_connection_added', '_connection_removed',
+                 '_sink_changed', '_source_changed')
+
+    # property signals
+    parameter_id_changed = LazySignal('_parameter_id_changed')
+    label_changed = LazySignal('_label_changed')
+    index_changed = LazySignal('_index_changed')
+    value_changed = LazySignal('_value_changed')
+
     def __init__(self, label=None, parameter_id=0, parent=None, index=0,
-                 node=None, source=False, sink=False):
+                 node=None, source=False, sink=False, value=None):
         super(Parameter, self).__init__()
         if parent is not None:
             if parent.node is not node and node is not None:
                 print("Warning: Specified node differs from parent's node. "
                       "Using parent's node")
             node = parent.node
-        # Properties
-        self._parameter_id = parameter_id
-        self._label = label
-        self._inbex = index
-
-        # Attached node
-        self._node = node
-        # Outward and inward connections
-        self._connections_out = set()
-        self._connections_in = set()
-
-        # property signals
-        self.parameter_id_changed = Signal()
-        self.label_changed = Signal()
-        self.index_changed = Signal()
-
-        self.connection_added = Signal()
-        self.connection_removed = Signal()
-        self.sink_changed = Signal()
-        self.source_changed = Signal()
+        self._init_parameter(label, parameter_id, index, node, value)
 
         self.parent = parent
         # TODO: this needs to fill in the other sink/source value
@@ -41,32 +47,78 @@ class Parameter(parentable.Parentable, connectable.Connectable):
         self.source = source
         self.sink = sink
         self.register_callbacks()
-        if self._node is not None:
-            self._node.parameter_added.emit(parameter=self, param=self)
+        if node is not None:
+            node._add_parameter(self)
+
+    @classmethod
+    def _create_quietly(cls, label, parameter_id, parent, index, node,
+                        source, sink, value):
+        '''Create a parameter on node without emitting anything (though
+        the node still registers it). Used by ramen.core.serialize.'''
+        param = cls.__new__(cls)
+        parentable.Parentable.__init__(param)
+        param._init_parameter(label, parameter_id, index, node, value)
+        param._source = source
+        param._sink = sink
+        if parent is not None:
+            param._parent = weakref.ref(parent)
+            parent._children.add(param)
+        param.register_callbacks()
+        node._parameter_added_callback(param)
+        return param
+
+    def _init_parameter(self, label, parameter_id, index, node, value):
+        # Properties
+        self._parameter_id = parameter_id
+        self._label = label
+        self._index = index
+        # Static value, used when nothing is connected to pull a value from
+        self._value = value
+        # Whether the evaluated value needs to be recomputed
+        self._dirty = True
+
+        # Weak reference to the attached node, which owns its parameters
+        self._node = None if node is None else weakref.ref(node)
+        # Whether signals loft up to the node
+        self._registered = False
+        # Outward and inward connections
+        self._connections_out = set()
+        self._connections_in = set()
+        self._sink = False
+        self._source = False
 
     def delete(self):
         self.parent = None
         self.node = None
 
+    def _emit(self, name, **kwargs):
+        super(Parameter, self)._emit(name, **kwargs)
+        if not self._registered or name not in _NODE_SIGNALS:
+            return
+        node = self._node()
+        if node is not None:
+            kwargs['parameter'] = self
+            kwargs['param'] = self
+            node._emit(_NODE_SIGNALS[name], **kwargs)
+
+    def _deferring(self):
+        node = self.node
+        return node is not None and node._deferring()
+
+    def _connection_allowed(self, source, sink):
+        # The graph turns down connections making a cycle
+        node = self.node
+        graph = None if node is None else node.graph
+        return graph is None or graph._connection_allowed(source, sink)
+
     def register_callbacks(self):
+        # Lofted signals
         if self._node is None:
             return
-        self.connection_added.connect(self.node.connection_added.emit,
-                                      parameter=self, param=self)
-        self.connection_removed.connect(self.node.connection_removed.emit,
-                                        parameter=self, param=self)
-        self.sink_changed.connect(self.node.parameter_sink_changed.emit,
-                                  parameter=self, param=self)
-        self.source_changed.connect(self.node.parameter_source_changed.emit,
-                                    parameter=self, param=self)
+        self._registered = True
 
     def deregister_callbacks(self):
-        if self._node is None:
-            return
-        self.connection_added.disconnect(self.node.connection_added.emit)
-        self.connection_removed.disconnect(self.node.connection_removed.emit)
-        self.sink_changed.disconnect(self.node.parameter_sink_changed.emit)
-        self.source_changed.disconnect(self.node.parameter_source_changed.emit)
+        self._registered = False
 
     def __repr__(self):
         '''fake convenience repr'''
@@ -85,7 +137,8 @@ class Parameter(parentable.Parentable, connectable.Connectable):
     @parameter_id.setter
     def parameter_id(self, new_val):
         self._parameter_id = new_val
-        self.parameter_id_changed.emit(parameter_id=self._parameter_id)
+        self._emit('parameter_id_changed',
+                   parameter_id=self._parameter_id)
 
     @parameter_id.deleter
     def parameter_id(self):
@@ -98,7 +151,7 @@ class Parameter(parentable.Parentable, connectable.Connectable):
     @label.setter
     def label(self, new_val):
         self._label = new_val
-        self.label_changed.emit(label=self._label)
+        self._emit('label_changed', label=self._label)
 
     @label.deleter
     def label(self):
@@ -111,30 +164,58 @@ class Parameter(parentable.Parentable, connectable.Connectable):
     @index.setter
     def index(self, new_val):
         self._index = new_val
-        self.index_changed.emit(index=self._index)
+        self._emit('index_changed', index=self._index)
 
     @index.deleter
     def index(self):
         del self._index
 
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, new_val):
+        old_value = self._value
+        self._value = new_val
+        self._emit('value_changed', value=self._value, old_value=old_value)
+
+    @property
+    def dirty(self):
+        return self._dirty
+
     @property
     def node(self):
-        return self._node
+        if self._node is None:
+            return None
+        return self._node()
 
     @node.setter
     def node(self, new_node):
-        if self._parent is not None:
+        old_parent = self.parent
+        if old_parent is not None:
             self.parent = None
-        if self._node is not None:
+        old_node = self.node
+        if old_node is not None:
             self.deregister_callbacks()
-            self.parameter_removed.emit(parameter=self, param=self)
-        self._node = new_node
+            old_node._remove_parameter(self, old_parent)
+        self._node = None if new_node is None else weakref.ref(new_node)
         self.register_callbacks()
-        self.parameter_added.emit(parameter=self, param=self)
+        if new_node is not None:
+            new_node._add_parameter(self)
+
+    def feeds(self, param):
+        '''Whether a value flows from this parameter to param, through
+        connections and subgraph boundaries'''
+        graph = None
+        if self.node is not None:
+            graph = self.node.graph
+        if graph is not None and graph.reachability_index is not None:
+            return graph.reachability_index.reaches(self, param)
+        return reachability.feeds(self, param)
 
     def is_transitively_connected(self, param):
-        # TODO: two-sided BFS a la path tracing
-        return param in self.connections
+        return self.feeds(param) or param.feeds(self)
 
     @property
     def connection_subgraph(self):
@@ -150,11 +231,12 @@ class Parameter(parentable.Parentable, connectable.Connectable):
     def loft_sink(self):
         if not self.sink:
             return None
-        if self.node.parent is None:
+        subgraph = self.node.parent
+        if subgraph is None:
             return None
-        for tunnel_param in self.node.parent.tunnel_parameters:
-            if self in tunnel_param.connections:
-                return self.node.parent.get_parameter_for_tunnel(tunnel_param)
+        tunnel_param = subgraph.get_feeding_tunnel(self)
+        if tunnel_param is not None:
+            return subgraph.get_parameter_for_tunnel(tunnel_param)
         lofted_param = Parameter(node=self.node.parent)
         lofted_param.sink = True
         self.node.parent.get_tunnel_parameter(lofted_param).connect(self)
@@ -163,11 +245,12 @@ class Parameter(parentable.Parentable, connectable.Connectable):
     def loft_source(self):
         if not self.source:
             return None
-        if self.node.parent is None:
+        subgraph = self.node.parent
+        if subgraph is None:
             return None
-        for tunnel_param in self.node.parent.tunnel_parameters:
-            if self in tunnel_param.connections:
-                return self.node.parent.get_parameter_for_tunnel(tunnel_param)
+        tunnel_param = subgraph.get_fed_tunnel(self)
+        if tunnel_param is not None:
+            return subgraph.get_parameter_for_tunnel(tunnel_param)
         lofted_param = Parameter(node=self.node.parent)
         lofted_param.source = True
         self.node.parent.get_tunnel_parameter(lofted_param).connect(self)
@@ -175,36 +258,35 @@ class Parameter(parentable.Parentable, connectable.Connectable):
 
     def connect(self, param):
         # Easy case, connection in the same subgraph
-        if self.connection_subgraph == param.connection_subgraph:
+        subgraph = self.connection_subgraph
+        other_subgraph = param.connection_subgraph
+        if subgraph is other_subgraph:
             return super(Parameter, self).connect(param)
 
-        # Hard case, different parents
-        # Loft up the one with more ancestors.
-        # (in the case of equal length but different ancestors just choose
-        # one and the other will be lofted in recursion)
+        # Hard case, different subgraphs
         # Determine directionality
         # In ambiguous cases, prefer that we are the source
-        self_is_source = True
-        if self.source and param.sink:
-            self_is_source = True
-        elif self.sink and param.source:
-            self_is_source = False
+        if self.sink and param.source and not (self.source and param.sink):
+            source, sink = param, self
         else:
-            print('unable to connect')
-
-        deep_param = self
-        surface_param = param
-        deep_is_source = self_is_source
-        if len(self.node.ancestors) < len(param.node.ancestors):
-            deep_param = param
-            surface_param = self
-            deep_is_source = not self_is_source
-        if deep_is_source:
-            lofted_param = deep_param.loft_source()
-        else:
-            lofted_param = deep_param.loft_sink()
-        if lofted_param is not None:
-            return lofted_param.connect(surface_param)
+            if not (self.source and param.sink):
+                print('unable to connect')
+            source, sink = self, param
+
+        # Loft both ends up to the lowest subgraph containing both, one
+        # level at a time (subgraphs with no parent are under None)
+        common = None
+        if subgraph is not None and other_subgraph is not None:
+            common = subgraph.lowest_common_ancestor(other_subgraph)
+        while source.connection_subgraph is not common:
+            source = source.loft_source()
+            if source is None:
+                return None
+        while sink.connection_subgraph is not common:
+            sink = sink.loft_sink()
+            if sink is None:
+                return None
+        return connectable.Connectable.connect(source, sink)
 
 
 class TunnelParameter(Parameter):
@@ -212,13 +294,17 @@ class TunnelParameter(Parameter):
     to an existing parameter, or creates one on a specified node. Only valid
     if the node containing the parameter accepts children.
     '''
+    __slots__ = ('_tunneled_parameter', '_tunneled_parameterChanged')
+
+    tunneled_parameterChanged = LazySignal('_tunneled_parameterChanged')
+
     def __init__(self, parameter):
         self._tunneled_parameter = parameter
-        super(TunnelParameter, self).__init__(node=parameter.node)
-
-        self.tunneled_parameterChanged = Signal()
-        self.sink_changed = Signal()
-        self.source_changed = Signal()
+        # A tunnel is the inside face of its parameter, so its sink/source
+        # are flipped (and writing them writes through to the parameter)
+        super(TunnelParameter, self).__init__(node=parameter.node,
+                                              source=parameter.sink,
+                                              sink=parameter.source)
 
     def register_node_callbacks(self):
         if self.node is None:
@@ -252,8 +338,7 @@ class TunnelParameter(Parameter):
 
     @tunneled_parameter.setter
     def tunneled_parameter(self, param):
-        self.deregister_tunneled_parameter_callbacks()
-        self._parameter = param
+        self._tunneled_parameter = param
 
     @property
     def sink(self):
@@ -273,10 +358,10 @@ class TunnelParameter(Parameter):
 
     def loft_source(self):
         if self.sink:
-            return self._parameter
-        for tunnel_param in self.node.tunnel_parameters:
-            if self in tunnel_param.connections_in:
-                return tunnel_param
+            return self._tunneled_parameter
+        tunnel_param = self.node.get_fed_tunnel(self)
+        if tunnel_param is not None:
+            return self.node.get_parameter_for_tunnel(tunnel_param)
         new_param = Parameter(node=self.node)
         new_param.source = True
         self.node.get_tunnel_parameter(new_param).connect(self)
@@ -284,10 +369,10 @@ class TunnelParameter(Parameter):
 
     def loft_sink(self):
         if self.source:
-            return self._parameter
-        for tunnel_param in self.node.tunnel_parameters:
-            if self in tunnel_param.connections_out:
-                return tunnel_param
+            return self._tunneled_parameter
+        tunnel_param = self.node.get_feeding_tunnel(self)
+        if tunnel_param is not None:
+            return self.node.get_parameter_for_tunnel(tunnel_param)
         new_param = Parameter(node=self.node)
         new_param.sink = True
         self.node.get_tunnel_parameter(new_param).connect(self)
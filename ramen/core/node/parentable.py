@@ -1,53 +1,108 @@
-from ramen.core.signal import Signal
+from ramen.core.signal import LazySignal, SignalEmitter
 import itertools
+import weakref
 
 
-class Parentable(object):
-    '''An object with parent, child relationships'''
+class Parentable(SignalEmitter):
+    '''An object with parent, child relationships.
+
+    Parents own their children, and children only reference their parent
+    weakly, so a tree is freed as soon as nothing else references its root.
+
+    depth is cached, and dropped (for the whole subtree) when the parent
+    changes. An object only has its depth cached if its ancestors do, so
+    dropping stops at the first descendant without one. ancestors isn't
+    cached, since holding them would make children reference their parents
+    strongly.
+    '''
+    __slots__ = ('_parent', '_children', '_accepts_children', '_depth',
+                 '_accepts_children_changed',
+                 '_parent_changed', '_child_added', '_child_removed',
+                 '_children_changed', '__weakref__')
+
+    accepts_children_changed = LazySignal('_accepts_children_changed')
+    parent_changed = LazySignal('_parent_changed')
+    child_added = LazySignal('_child_added')
+    child_removed = LazySignal('_child_removed')
+    children_changed = LazySignal('_children_changed')
+
     def __init__(self):
+        # Weak reference to the parent, or None
         self._parent = None
         self._children = set()
         self._accepts_children = True
-
-        self.accepts_children_changed = Signal()
-        self.parent_changed = Signal()
-        self.child_added = Signal()
-        self.child_removed = Signal()
-        self.children_changed = Signal()
+        # Cached depth, or None
+        self._depth = None
 
     @property
     def parent(self):
-        return self._parent
+        if self._parent is None:
+            return None
+        return self._parent()
 
     @parent.setter
     def parent(self, parent):
-        if parent == self._parent:
+        old_parent = self.parent
+        if parent == old_parent:
             return
         if parent is not None and not parent.accepts_children:
             return
 
-        if self._parent is not None:
-            self._parent.disown_child(self)
+        if old_parent is not None:
+            # Unless it's what's disowning us, this sets our parent to None
+            # (and emits that change) first
+            old_parent.disown_child(self)
+            if self._parent is None:
+                old_parent = None
             self._parent = None
 
-        self._parent = parent
         if parent is not None:
+            self._parent = weakref.ref(parent)
             parent.adopt_child(self)
-        self.parent_changed.emit(parent=parent)
+        self._invalidate_ancestry()
+        self._emit('parent_changed', parent=parent, old_parent=old_parent)
+
+    def _invalidate_ancestry(self):
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            if item._depth is None:
+                continue
+            item._depth = None
+            stack.extend(item._children)
+
+    @property
+    def depth(self):
+        '''The number of ancestors'''
+        if self._depth is not None:
+            return self._depth
+        # Walk up to the first item with a known depth, then cache the
+        # depths on the way down
+        chain = []
+        item = self
+        while item is not None and item._depth is None:
+            chain.append(item)
+            item = item.parent
+        depth = -1 if item is None else item._depth
+        for item in reversed(chain):
+            depth += 1
+            item._depth = depth
+        return self._depth
 
     @property
     def ancestors(self):
+        '''The parent, its parent, and so on up to the root, as a tuple'''
         res = []
-        curItem = self
-        while curItem.parent is not None:
-            res.append(curItem.parent)
-            curItem = curItem.parent
-        return res
+        item = self.parent
+        while item is not None:
+            res.append(item)
+            item = item.parent
+        return tuple(res)
 
     @ancestors.setter
     def ancestors(self, new_ancestors):
         # This is basically calling parent.setter on everything in the list
-        new_ancestors = [None] + new_ancestors + [self]
+        new_ancestors = [None] + list(new_ancestors) + [self]
 
         def pairwise(iterable):
             # TODO: stick this somewhere better
@@ -57,6 +112,25 @@ class Parentable(object):
         for parent, child in pairwise(new_ancestors):
             child.parent = parent
 
+    def lowest_common_ancestor(self, other):
+        '''The deepest item that is self or one of its ancestors, and other
+        or one of its ancestors. None if they're in different trees.'''
+        depth = self.depth
+        other_depth = other.depth
+        item = self
+        while depth > other_depth:
+            item = item.parent
+            depth -= 1
+        while other_depth > depth:
+            other = other.parent
+            other_depth -= 1
+        while item is not other:
+            if item is None:
+                return None
+            item = item.parent
+            other = other.parent
+        return item
+
     @property
     def children(self):
         # explicitly copy for now
@@ -80,7 +154,8 @@ class Parentable(object):
     @accepts_children.setter
     def accepts_children(self, accepts_children):
         self._accepts_children = accepts_children
-        self.accepts_children_changed.emit(accepts_children=accepts_children)
+        self._emit('accepts_children_changed',
+                   accepts_children=accepts_children)
 
     def adopt_child(self, child):
         if not self.accepts_children:
@@ -89,11 +164,11 @@ class Parentable(object):
             return
         self._children.add(child)
         child.parent = self
-        self.child_added.emit(child=child)
+        self._emit('child_added', child=child)
 
     def disown_child(self, child):
         if child not in self._children:
             return
         self._children.remove(child)
         child.parent = None
-        self.child_removed.emit(child=child)
+        self._emit('child_removed', child=child)
@@ -0,0 +1,252 @@
+'''Diffing graphs, and patching one graph into another.
+
+diff(graph_a, graph_b) compares the two graphs' records (see
+ramen.core.serialize) and returns the edits that turn graph_a into
+graph_b. Nodes are matched by node_id, parameters by node_id and
+parameter_id, and connections by their endpoints (a tunnel is matched by
+its parameter). The root nodes always match. The edits are plain tuples
+that only hold ids and values, so a patch can be pickled and sent to
+another process:
+
+    ('disconnect', source endpoint, sink endpoint)
+    ('remove_parameter', node_id, parameter_id)
+    ('remove_node', node_id)
+    ('add_node', node_id, class name, label, parent node_id, pos)
+    ('set_node', node_id, {attribute: value})
+        for label, pos and parent (a node_id)
+    ('add_parameter', node_id, parameter_id, label, parent parameter_id,
+     index, source, sink, value, is the node's root parameter)
+    ('set_parameter', node_id, parameter_id, {attribute: value})
+        for label, parent (a parameter_id), index, source, sink and value
+    ('connect', source endpoint, sink endpoint)
+
+where an endpoint is (node_id, parameter_id, is a tunnel). Removals come
+first (children before parents), then additions and changes (parents
+before children), then new connections. A node whose class changed is
+removed and added again.
+
+apply_patch(graph, patch) applies the edits inside one Graph.batch, through
+the same setters as any other change, so listeners (and a History) see the
+individual changes and batched listeners get one ChangeSet.
+'''
+import collections
+
+from ramen.core import node
+from ramen.core import serialize
+
+# Attribute -> index in a node record
+_NODE_ATTRIBUTES = (('label', 3), ('pos', 5), ('parent', 4))
+# Attribute -> index in a parameter record
+_PARAMETER_ATTRIBUTES = (('label', 3), ('parent', 4), ('index', 5),
+                         ('source', 6), ('sink', 7), ('value', 8))
+
+
+def _equal(a, b):
+    try:
+        return bool(a == b)
+    except (TypeError, ValueError):
+        # e.g. arrays, which compare elementwise
+        return False
+
+
+def _index_records(graph, root_node_id):
+    '''The records of graph, keyed by what they're matched by. Its root
+    node's id is replaced with root_node_id.'''
+    graph_root_id = graph.root_node.node_id
+
+    def rename(node_id):
+        if node_id == graph_root_id:
+            return root_node_id
+        return node_id
+
+    # Keeping the records' parents first order
+    nodes = collections.OrderedDict()
+    params = collections.OrderedDict()
+    connections = collections.OrderedDict()
+    for record in serialize.records(graph):
+        kind = record[0]
+        if kind == 'node':
+            record = (record[0], rename(record[1]), record[2], record[3],
+                      rename(record[4]), record[5])
+            nodes[record[1]] = record
+        elif kind == 'parameter':
+            record = (record[0], rename(record[1])) + record[2:]
+            params[(record[1], record[2])] = record
+        elif kind == 'connection':
+            connections[((rename(record[1]),) + record[2:4],
+                         (rename(record[4]),) + record[5:7])] = True
+    return nodes, params, connections
+
+
+def _changes(record_a, record_b, attributes):
+    changes = {}
+    for name, index in attributes:
+        if not _equal(record_a[index], record_b[index]):
+            changes[name] = record_b[index]
+    return changes
+
+
+def diff(graph_a, graph_b):
+    '''The list of edits that turn graph_a into graph_b. See the module
+    docstring.'''
+    root_node_id = graph_a.root_node.node_id
+    nodes_a, params_a, connections_a = _index_records(graph_a, root_node_id)
+    nodes_b, params_b, connections_b = _index_records(graph_b, root_node_id)
+
+    # Nodes that are in both, but of different classes
+    replaced = set(node_id for node_id, record in nodes_b.items()
+                   if node_id in nodes_a and
+                   nodes_a[node_id][2] != record[2] and
+                   node_id != root_node_id)
+
+    def kept(endpoint):
+        return endpoint[0] not in replaced
+
+    edits = []
+    for source, sink in connections_a:
+        if ((source, sink) not in connections_b or not kept(source) or
+                not kept(sink)):
+            edits.append(('disconnect', source, sink))
+    for key in reversed(list(params_a)):
+        # Parameters of removed (or replaced) nodes go with them
+        if (key not in params_b and key[0] in nodes_b and
+                key[0] not in replaced):
+            edits.append(('remove_parameter',) + key)
+    for node_id in reversed(list(nodes_a)):
+        if node_id not in nodes_b or node_id in replaced:
+            edits.append(('remove_node', node_id))
+
+    for node_id, record in nodes_b.items():
+        if node_id not in nodes_a or node_id in replaced:
+            edits.append(('add_node',) + record[1:])
+            continue
+        changes = _changes(nodes_a[node_id], record, _NODE_ATTRIBUTES)
+        if record[4] in replaced:
+            # Same parent id, but a new parent node
+            changes['parent'] = record[4]
+        if changes:
+            edits.append(('set_node', node_id, changes))
+    for key, record in params_b.items():
+        if key not in params_a or key[0] in replaced:
+            edits.append(('add_parameter',) + record[1:])
+            continue
+        changes = _changes(params_a[key], record, _PARAMETER_ATTRIBUTES)
+        if changes:
+            edits.append(('set_parameter',) + key + (changes,))
+    for source, sink in connections_b:
+        if ((source, sink) not in connections_a or not kept(source) or
+                not kept(sink)):
+            edits.append(('connect', source, sink))
+    return edits
+
+
+class _Patcher(object):
+    '''Applies edits to a graph'''
+    def __init__(self, graph, node_classes):
+        self.graph = graph
+        self.node_classes = node_classes
+        # (node_id, parameter_id) -> parameter, for parameters that didn't
+        # get the parameter_id they were added with (root parameters, or
+        # clashes with a tunnel)
+        self.params = {}
+
+    def node(self, node_id):
+        graph_node = self.graph[node_id]
+        if graph_node is None:
+            raise ValueError('No node %r to patch' % (node_id,))
+        return graph_node
+
+    def parameter(self, node_id, parameter_id):
+        param = self.params.get((node_id, parameter_id))
+        if param is None:
+            param = self.node(node_id).get_parameter(parameter_id)
+        if param is None:
+            raise ValueError('No parameter %r on node %r to patch' % (
+                parameter_id, node_id))
+        return param
+
+    def endpoint(self, endpoint):
+        node_id, parameter_id, is_tunnel = endpoint
+        param = self.parameter(node_id, parameter_id)
+        if is_tunnel:
+            return param.node.get_tunnel_parameter(param)
+        return param
+
+    def apply(self, edit):
+        kind = edit[0]
+        if kind == 'disconnect':
+            self.endpoint(edit[1]).disconnect_from_sink(
+                self.endpoint(edit[2]))
+        elif kind == 'remove_parameter':
+            self.parameter(edit[1], edit[2]).delete()
+        elif kind == 'remove_node':
+            self.node(edit[1]).delete()
+        elif kind == 'add_node':
+            self.add_node(*edit[1:])
+        elif kind == 'set_node':
+            graph_node = self.node(edit[1])
+            for name, value in edit[2].items():
+                if name == 'parent' and value is not None:
+                    value = self.node(value)
+                setattr(graph_node, name, value)
+        elif kind == 'add_parameter':
+            self.add_parameter(*edit[1:])
+        elif kind == 'set_parameter':
+            param = self.parameter(edit[1], edit[2])
+            for name, value in edit[3].items():
+                if name == 'parent' and value is not None:
+                    value = self.parameter(edit[1], value)
+                setattr(param, name, value)
+        elif kind == 'connect':
+            self.endpoint(edit[1]).connect_to_sink(self.endpoint(edit[2]))
+        else:
+            raise ValueError('Unknown edit %s' % kind)
+
+    def add_node(self, node_id, class_name, label, parent_id, pos):
+        node_class = self.node_classes.get(class_name)
+        if node_class is None:
+            raise ValueError('Unknown node class %s' % class_name)
+        parent = None
+        if parent_id is not None:
+            parent = self.node(parent_id)
+        if pos is not None:
+            pos = tuple(pos)
+        new_node = self.graph.create_nodes([(label, parent, node_id, pos)],
+                                           node_class=node_class)[0]
+        if new_node.node_id != node_id:
+            raise ValueError('Node %r is already in the graph' % (node_id,))
+
+    def add_parameter(self, node_id, parameter_id, label, parent_id, index,
+                      source, sink, value, is_root):
+        graph_node = self.node(node_id)
+        if is_root:
+            param = graph_node.root_parameter
+            param.label = label
+            param.index = index
+            param.source = source
+            param.sink = sink
+            param.value = value
+        else:
+            parent = None
+            if parent_id is not None:
+                parent = self.parameter(node_id, parent_id)
+            param = node.parameter.Parameter(
+                label=label, parameter_id=parameter_id, parent=parent,
+                index=index, node=graph_node, source=source, sink=sink,
+                value=value)
+        if param.parameter_id != parameter_id:
+            self.params[(node_id, parameter_id)] = param
+
+
+def apply_patch(graph, patch, node_classes=None):
+    '''Apply the edits of patch (from diff) to graph, in one Graph.batch.
+    node_classes maps class names to node classes, for nodes of classes
+    other than Node and SubgraphNode.'''
+    classes = {'Node': node.Node, 'SubgraphNode': node.SubgraphNode}
+    if node_classes is not None:
+        classes.update(node_classes)
+    patcher = _Patcher(graph, classes)
+    with graph.batch():
+        for edit in patch:
+            patcher.apply(edit)
+    return graph
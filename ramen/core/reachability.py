@@ -0,0 +1,320 @@
+'''Reachability queries between parameters: "does A feed B?"
+
+Values flow from a source along its connections, and through subgraph
+boundaries: a SubgraphNode parameter passes what it sinks on to its
+tunnel, and a tunnel passes what it sinks on to its parameter. They don't
+flow through a node's compute, from its sinks to its sources: which
+sources a compute writes from which sinks isn't known, so this answers
+what a parameter is wired to. ramen.core.topology, which orders the nodes
+for computing them, does treat a node as passing any of its sinks on to
+any of its sources.
+
+feeds() answers a single query with a bidirectional breadth first search,
+expanding whichever of the forward and backward frontiers is smaller.
+For many queries on a large graph, a ReachabilityIndex keeps the
+transitive closure as bitsets, so each query is O(1). It is updated
+incrementally as connections and sink/source flags change: adding an edge
+updates its ancestors' bitsets, and removing one works out again only
+what the parameters upstream of it reach. Removed parameters give their
+bits back, to be reused. It takes O(parameters^2) bits of memory.
+'''
+import weakref
+
+from ramen.core import node
+
+
+def _partner(param):
+    '''The other face of a subgraph boundary crossing: the parameter of a
+    tunnel, or the tunnel of a subgraph parameter'''
+    if isinstance(param, node.parameter.TunnelParameter):
+        return param.tunneled_parameter
+    if isinstance(param.node, node.SubgraphNode):
+        return param.node.get_tunnel_parameter(param)
+    return None
+
+
+def successors(param):
+    '''The parameters param passes its value on to directly'''
+    succs = list(param.iter_connections_out())
+    if param.sink:
+        partner = _partner(param)
+        if partner is not None:
+            succs.append(partner)
+    return succs
+
+
+def predecessors(param):
+    '''The parameters param gets its value from directly'''
+    preds = list(param.iter_connections_in())
+    if param.source:
+        partner = _partner(param)
+        if partner is not None:
+            preds.append(partner)
+    return preds
+
+
+def feeds(source, sink):
+    '''Whether a value flows from source to sink'''
+    if source is sink:
+        return False
+    forward = set([source])
+    backward = set([sink])
+    forward_frontier = [source]
+    backward_frontier = [sink]
+    while forward_frontier and backward_frontier:
+        if len(forward_frontier) <= len(backward_frontier):
+            next_frontier = []
+            for param in forward_frontier:
+                for succ in successors(param):
+                    if succ in backward:
+                        return True
+                    if succ not in forward:
+                        forward.add(succ)
+                        next_frontier.append(succ)
+            forward_frontier = next_frontier
+        else:
+            next_frontier = []
+            for param in backward_frontier:
+                for pred in predecessors(param):
+                    if pred in forward:
+                        return True
+                    if pred not in backward:
+                        backward.add(pred)
+                        next_frontier.append(pred)
+            backward_frontier = next_frontier
+    return False
+
+
+def _node_parameters(graph_node):
+    '''graph_node's parameters, tunnels included'''
+    return (list(graph_node.parameters) +
+            list(getattr(graph_node, 'tunnel_parameters', ())))
+
+
+def _bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class ReachabilityIndex(object):
+    '''Transitive closure of a graph's parameters, kept up to date by the
+    graph's connection signals. See the module docstring.'''
+    def __init__(self, graph):
+        # The graph owns this, so only reference it weakly
+        self._graph = weakref.ref(graph)
+        self._stale = True
+        self.clear()
+        self.register_callbacks()
+
+    def _graph_callbacks(self):
+        graph = self.graph
+        return [
+            (graph.connection_added, self._connection_added_callback),
+            (graph.connection_removed, self._connection_removed_callback),
+            (graph.parameter_sink_changed, self._sink_changed_callback),
+            (graph.parameter_source_changed,
+             self._source_changed_callback),
+            (graph.parameter_added, self._parameter_added_callback),
+            (graph.parameter_removed, self._parameter_removed_callback),
+            (graph.node_added, self._node_added_callback),
+            (graph.node_removed, self._node_removed_callback),
+        ]
+
+    def register_callbacks(self):
+        for signal, callback in self._graph_callbacks():
+            signal.connect(callback)
+
+    def deregister_callbacks(self):
+        for signal, callback in self._graph_callbacks():
+            signal.disconnect(callback)
+
+    @property
+    def graph(self):
+        return self._graph()
+
+    def clear(self):
+        # param -> bit, and the reverse (None for bits given back)
+        self._bit = {}
+        self._params = []
+        # Bits given back, to reuse
+        self._free_bits = []
+        # bit -> bitset of the params it reaches, and that reach it
+        self._reach = []
+        self._ancestors = []
+
+    def invalidate(self):
+        # Nothing is kept alive until the rebuild
+        self.clear()
+        self._stale = True
+
+    def rebuild(self):
+        self.clear()
+        self._stale = False
+        for graph_node in self.graph.nodes:
+            for param in _node_parameters(graph_node):
+                self._vertex(param)
+        for param in list(self._params):
+            for succ in param.iter_connections_out():
+                # Not parameters of deleted nodes, which keep their
+                # connections
+                if succ in self._bit:
+                    self.add_edge(param, succ)
+
+    def reaches(self, source, sink):
+        if source is sink:
+            return False
+        if self._stale:
+            self.rebuild()
+        source_bit = self._bit.get(source)
+        sink_bit = self._bit.get(sink)
+        if source_bit is None or sink_bit is None:
+            # Never connected, or not in the graph: not worth indexing
+            return feeds(source, sink)
+        return bool(self._reach[source_bit] >> sink_bit & 1)
+
+    def add_edge(self, source, sink):
+        source_bit = self._vertex(source)
+        sink_bit = self._vertex(sink)
+        if self._reach[source_bit] >> sink_bit & 1:
+            return
+        descendants = self._reach[sink_bit] | (1 << sink_bit)
+        ancestors = self._ancestors[source_bit] | (1 << source_bit)
+        for bit in _bits(ancestors):
+            self._reach[bit] |= descendants
+        for bit in _bits(descendants):
+            self._ancestors[bit] |= ancestors
+
+    def remove_edge(self, source, sink):
+        '''Update the closure for an edge from source to sink that's gone.
+        Only what the parameters upstream of it reach can change, so only
+        that is worked out again, from their successors.'''
+        if source not in self._bit or sink not in self._bit:
+            return
+        source_bit = self._bit[source]
+        self._recompute(self._ancestors[source_bit] | (1 << source_bit))
+
+    def remove_vertex(self, param):
+        '''Drop param and its edges, and give its bit back'''
+        bit = self._bit.pop(param, None)
+        if bit is None:
+            return
+        self._params[bit] = None
+        for desc_bit in _bits(self._reach[bit]):
+            self._ancestors[desc_bit] &= ~(1 << bit)
+        affected = self._ancestors[bit] & ~(1 << bit)
+        self._reach[bit] = 0
+        self._ancestors[bit] = 0
+        self._recompute(affected)
+        self._free_bits.append(bit)
+
+    def _recompute(self, affected):
+        '''Work out again what the params whose bits are set in affected
+        reach, when some of that may be gone'''
+        affected_bits = list(_bits(affected))
+        # Start with what the successors outside of the affected ones reach,
+        # then spread it through the affected ones until nothing changes
+        # (there may be cycles among them)
+        reach = {}
+        for bit in affected_bits:
+            mask = 0
+            for succ in successors(self._params[bit]):
+                succ_bit = self._bit.get(succ)
+                if succ_bit is None:
+                    continue
+                mask |= 1 << succ_bit
+                if not affected >> succ_bit & 1:
+                    mask |= self._reach[succ_bit]
+            reach[bit] = mask
+        changed = True
+        while changed:
+            changed = False
+            for bit in affected_bits:
+                mask = reach[bit]
+                for succ_bit in _bits(mask & affected):
+                    mask |= reach[succ_bit]
+                if mask != reach[bit]:
+                    reach[bit] = mask
+                    changed = True
+        old_descendants = 0
+        for bit in affected_bits:
+            old_descendants |= self._reach[bit]
+        for bit in _bits(old_descendants):
+            self._ancestors[bit] &= ~affected
+        for bit in affected_bits:
+            self._reach[bit] = reach[bit]
+            for desc_bit in _bits(reach[bit]):
+                self._ancestors[desc_bit] |= 1 << bit
+
+    def _vertex(self, param):
+        bit = self._bit.get(param)
+        if bit is not None:
+            return bit
+        if self._free_bits:
+            bit = self._free_bits.pop()
+            self._params[bit] = param
+        else:
+            bit = len(self._params)
+            self._params.append(param)
+            self._reach.append(0)
+            self._ancestors.append(0)
+        self._bit[param] = bit
+        # Link up with the other face of a subgraph boundary once both
+        # faces are in the index
+        partner = _partner(param)
+        if partner is not None:
+            if partner in self._bit:
+                if param.sink:
+                    self.add_edge(param, partner)
+                if param.source:
+                    self.add_edge(partner, param)
+            else:
+                self._vertex(partner)
+        return bit
+
+    def _connection_added_callback(self, source, sink):
+        if not self._stale:
+            self.add_edge(source, sink)
+
+    def _connection_removed_callback(self, source, sink):
+        if not self._stale:
+            self.remove_edge(source, sink)
+
+    def _parameter_added_callback(self, parameter):
+        # New parameters have no connections, and get a bit when they get
+        # one. One coming back keeps its connections.
+        if parameter._connections_in or parameter._connections_out:
+            self.invalidate()
+
+    def _parameter_removed_callback(self, parameter):
+        if not self._stale:
+            self.remove_vertex(parameter)
+
+    def _node_added_callback(self, node):
+        for param in _node_parameters(node):
+            self._parameter_added_callback(param)
+
+    def _node_removed_callback(self, node):
+        if not self._stale:
+            for param in _node_parameters(node):
+                self.remove_vertex(param)
+
+    def _sink_changed_callback(self, parameter):
+        # A subgraph boundary passes on what its faces sink
+        partner = _partner(parameter)
+        if self._stale or partner is None:
+            return
+        if parameter.sink:
+            self.add_edge(parameter, partner)
+        else:
+            self.remove_edge(parameter, partner)
+
+    def _source_changed_callback(self, parameter):
+        partner = _partner(parameter)
+        if self._stale or partner is None:
+            return
+        if parameter.source:
+            self.add_edge(partner, parameter)
+        else:
+            self.remove_edge(partner, parameter)
@@ -0,0 +1,200 @@
+'''Parallel evaluation of a graph's independent nodes.
+
+The Scheduler evaluates parameters like Evaluator.evaluate, but computes
+the nodes of their upstream cone concurrently: a node is dispatched as soon
+as every node it depends on (through connections, with tunnels resolved)
+has finished. Outputs go through the graph evaluator's cache, so cached
+nodes are skipped and results are reused by later evaluations.
+
+Where a node runs depends on the executor and the node's compute_hints:
+
+    thread executor:
+        GIL_BOUND nodes run in the scheduling thread, since threads
+        wouldn't run them concurrently anyway. Everything else goes to
+        the thread pool.
+    process executor:
+        PICKLABLE nodes (the compute function, its inputs and outputs can
+        be pickled) go to the process pool. RELEASES_GIL nodes go to a
+        thread pool. Everything else runs in the scheduling thread.
+'''
+import concurrent.futures
+import time
+
+from ramen.core import evaluate
+
+# compute_hints
+GIL_BOUND = 'gil_bound'
+RELEASES_GIL = 'releases_gil'
+PICKLABLE = 'picklable'
+
+THREAD = 'thread'
+PROCESS = 'process'
+
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    # python 2
+    _clock = time.time
+
+
+def _timed_compute(compute, inputs):
+    # Module level so process pools can pickle it
+    start = _clock()
+    result = compute(inputs)
+    return result, _clock() - start
+
+
+def levels(compute_nodes):
+    '''Group compute_nodes, given in dependency order (as returned by
+    evaluate.upstream_nodes), into topological levels: each node is one
+    level after the deepest of its dependencies.'''
+    node_levels = {}
+    res = []
+    for compute_node in compute_nodes:
+        level = 0
+        for dep in evaluate.dependencies(compute_node):
+            if dep in node_levels:
+                level = max(level, node_levels[dep] + 1)
+        node_levels[compute_node] = level
+        if level == len(res):
+            res.append([])
+        res[level].append(compute_node)
+    return res
+
+
+class ScheduleResult(object):
+    def __init__(self):
+        # param -> value
+        self.values = {}
+        # node -> wall time of its compute, in seconds
+        self.timings = {}
+        # nodes computed, grouped by topological level
+        self.levels = []
+        # wall time of the whole evaluation, in seconds
+        self.wall_time = 0.0
+
+
+class Scheduler(object):
+    '''Evaluates parameters of a graph, computing independent nodes
+    concurrently. See the module docstring.'''
+    def __init__(self, graph, executor=THREAD, max_workers=None):
+        if executor not in (THREAD, PROCESS):
+            raise ValueError('Unknown executor %s' % executor)
+        self._graph = graph
+        self._executor_type = executor
+        self._max_workers = max_workers
+        self._thread_pool = None
+        self._process_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    @property
+    def graph(self):
+        return self._graph
+
+    @property
+    def thread_pool(self):
+        if self._thread_pool is None:
+            self._thread_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._max_workers)
+        return self._thread_pool
+
+    @property
+    def process_pool(self):
+        if self._process_pool is None:
+            self._process_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self._max_workers)
+        return self._process_pool
+
+    def shutdown(self):
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown()
+            self._thread_pool = None
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
+            self._process_pool = None
+
+    def _pool_for(self, compute_node):
+        '''The executor to run compute_node on, or None to run it in the
+        scheduling thread'''
+        hints = compute_node.compute_hints
+        if self._executor_type == THREAD:
+            if GIL_BOUND in hints:
+                return None
+            return self.thread_pool
+        if PICKLABLE in hints:
+            return self.process_pool
+        if RELEASES_GIL in hints:
+            return self.thread_pool
+        return None
+
+    def evaluate(self, params):
+        '''Evaluate params, returning a ScheduleResult. If a node raises,
+        the nodes that haven't started yet are cancelled and the exception
+        is raised.'''
+        start = _clock()
+        evaluator = self.graph.evaluator
+        result = ScheduleResult()
+        outputs = {}
+        order = evaluator.nodes_to_compute(params, outputs)
+
+        # node -> number of unfinished dependencies, and the reverse
+        waiting_on = {}
+        dependents = dict((compute_node, []) for compute_node in order)
+        for compute_node in order:
+            deps = [dep for dep in evaluate.dependencies(compute_node)
+                    if dep in dependents]
+            waiting_on[compute_node] = len(deps)
+            for dep in deps:
+                dependents[dep].append(compute_node)
+        ready = [compute_node for compute_node in order
+                 if not waiting_on[compute_node]]
+        # future -> node
+        running = {}
+
+        def finish(compute_node, node_result, seconds):
+            evaluator.store_outputs(compute_node, node_result, outputs)
+            result.timings[compute_node] = seconds
+            for dependent in dependents[compute_node]:
+                waiting_on[dependent] -= 1
+                if not waiting_on[dependent]:
+                    ready.append(dependent)
+
+        try:
+            while ready or running:
+                while ready:
+                    compute_node = ready.pop()
+                    if compute_node.compute is None:
+                        finish(compute_node, {}, 0.0)
+                        continue
+                    inputs = evaluator.gather_inputs(compute_node, outputs)
+                    pool = self._pool_for(compute_node)
+                    if pool is None:
+                        finish(compute_node,
+                               *_timed_compute(compute_node.compute, inputs))
+                    else:
+                        future = pool.submit(_timed_compute,
+                                             compute_node.compute, inputs)
+                        running[future] = compute_node
+                if running:
+                    done, _ = concurrent.futures.wait(
+                        running,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        compute_node = running.pop(future)
+                        finish(compute_node, *future.result())
+        except BaseException:
+            # Nothing is waiting for the rest any more
+            for future in running:
+                future.cancel()
+            raise
+
+        result.levels = levels(order)
+        for param in params:
+            result.values[param] = evaluator.value(param, outputs)
+        result.wall_time = _clock() - start
+        return result
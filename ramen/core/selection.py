@@ -0,0 +1,33 @@
+try:
+    from collections.abc import Set
+except ImportError:
+    # python 2
+    from collections import Set
+
+
+class SelectionView(Set):
+    '''A read-only, live view of a graph's selected nodes.
+
+    Membership tests are O(1) and nothing is copied: the view always
+    reflects the current selection. Set operations (|, &, -, ...) return
+    plain sets.
+    '''
+    def __init__(self, selected_nodes):
+        self._selected_nodes = selected_nodes
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    def __contains__(self, node):
+        return node in self._selected_nodes
+
+    def __iter__(self):
+        return iter(self._selected_nodes)
+
+    def __len__(self):
+        return len(self._selected_nodes)
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__,
+                             list(self._selected_nodes))
@@ -0,0 +1,532 @@
+'''Saving and loading graphs.
+
+A graph is written as a stream of records, generated one at a time so
+saving never holds more than one record in memory:
+
+    ('node', node_id, class name, label, parent node_id, pos)
+    ('parameter', node_id, parameter_id, label, parent parameter_id, index,
+     source, sink, value, is the node's root parameter)
+    ('connection', source node_id, source parameter_id, source is a tunnel,
+     sink node_id, sink parameter_id, sink is a tunnel)
+
+Nodes come parents first (and otherwise in topological order), then
+parameters (parents first), then connections. Tunnels aren't written,
+since SubgraphNodes create them for their parameters; connections refer to
+a tunnel by its parameter. Compute functions aren't written either.
+
+There are two encodings of the stream:
+
+    JSON lines: a header line, then one JSON array per record. Parameter
+    values have to be JSON serializable.
+    binary: BINARY_MAGIC, then one pickle per record. Any picklable value
+    can be saved, and as with any pickle, only load files you trust.
+
+Loading goes through the same quiet path as Graph.create_nodes, inside one
+Graph.batch: nodes and parameters are created without their per-object
+signals, and only graph level signals (node_added, connection_added) are
+emitted.
+'''
+import collections
+import itertools
+import json
+import os
+import pickle
+import struct
+import weakref
+
+from ramen.core import node
+
+FORMAT_VERSION = 1
+BINARY_MAGIC = b'\x00ramen\x01\n'
+CHUNKED_MAGIC = b'\x00ramen\x02\n'
+# Nodes are created in chunks of up to this many
+CHUNK_SIZE = 10000
+
+
+def _node_record(graph_node, parent_id):
+    return ('node', graph_node.node_id, type(graph_node).__name__,
+            graph_node.label, parent_id, graph_node.pos)
+
+
+def _node_records(graph):
+    # Subgraph nodes first, parents first. Only they can be parents, and
+    # they're all under the root node.
+    stack = [graph.root_node]
+    while stack:
+        cur_node = stack.pop()
+        parent_id = None
+        if cur_node.parent is not None:
+            parent_id = cur_node.parent.node_id
+        yield _node_record(cur_node, parent_id)
+        stack.extend(child for child in cur_node.children
+                     if child.accepts_children)
+    # Then the computing nodes (all of the others) in topological order, so
+    # loading their connections never has to reorder the graph's topology
+    for cur_node in graph.iter_topological_order():
+        yield _node_record(cur_node, cur_node.parent.node_id)
+
+
+def _parameter_records(graph_node):
+    root_parameter = graph_node._root_parameter
+    params = graph_node.parameters
+    # Parents first: walk down from the parentless parameters
+    stack = [param for param in params if param.parent is None]
+    while stack:
+        param = stack.pop()
+        parent_id = None
+        if param.parent is not None:
+            parent_id = param.parent.parameter_id
+        yield ('parameter', graph_node.node_id, param.parameter_id,
+               param.label, parent_id, param.index, param.source,
+               param.sink, param.value, param is root_parameter)
+        stack.extend(param._children)
+
+
+def _endpoint(param):
+    if isinstance(param, node.parameter.TunnelParameter):
+        param = param.tunneled_parameter
+        return (param.node.node_id, param.parameter_id, True)
+    return (param.node.node_id, param.parameter_id, False)
+
+
+def records(graph):
+    '''Generate the records describing graph'''
+    for record in _node_records(graph):
+        yield record
+    for graph_node in graph.nodes:
+        for record in _parameter_records(graph_node):
+            yield record
+    for source, sink in graph.connections:
+        yield ('connection',) + _endpoint(source) + _endpoint(sink)
+
+
+def write(graph, fp, binary=False):
+    '''Write graph to fp, a file opened in binary mode'''
+    if binary:
+        fp.write(BINARY_MAGIC)
+        for record in records(graph):
+            # One pickle per record, so no memo keeps them all alive
+            pickle.dump(record, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        return
+    header = {'format': 'ramen', 'version': FORMAT_VERSION}
+    fp.write(json.dumps(header).encode('utf-8') + b'\n')
+    for record in records(graph):
+        fp.write(json.dumps(record).encode('utf-8') + b'\n')
+
+
+def read_records(fp):
+    '''Generate the records from fp, in either encoding'''
+    head = fp.read(len(BINARY_MAGIC))
+    if head == BINARY_MAGIC:
+        while True:
+            try:
+                yield pickle.load(fp)
+            except EOFError:
+                return
+    header = json.loads(head + fp.readline())
+    if header.get('format') != 'ramen':
+        raise ValueError('Not a ramen graph file')
+    if header.get('version') != FORMAT_VERSION:
+        raise ValueError('Unsupported ramen graph file version %s' %
+                         header.get('version'))
+    for line in fp:
+        if line.strip():
+            yield json.loads(line)
+
+
+class _Loader(object):
+    '''Builds up a graph from a stream of records'''
+    def __init__(self, graph, node_classes, store=None):
+        # graph imports this module (through frozen)
+        from ramen.core.graph import CreatedNode
+        self.created_node = CreatedNode
+        self.graph = graph
+        self.node_classes = node_classes
+        # The ChunkStore subgraphs' chunks are loaded from, if any
+        self.store = store
+        # file node_id -> node
+        self.nodes = {}
+        # (file node_id, file parameter_id) -> parameter
+        self.params = {}
+        # Nodes waiting to be created: create_nodes specs, and their file
+        # node_ids
+        self.pending_specs = []
+        self.pending_ids = []
+        # file node_id -> CreatedNode of its index in pending_specs
+        self.pending_index = {}
+        self.root_node_id = None
+
+    def add(self, record):
+        kind = record[0]
+        if kind == 'node':
+            self.add_node(*record[1:])
+            return
+        self.flush()
+        if kind == 'parameter':
+            self.add_parameter(*record[1:])
+        elif kind == 'connection':
+            self.add_connection(*record[1:])
+        elif kind == 'chunk' and self.store is not None:
+            self.store._add_chunk(self.nodes[record[1]], record[1], record[2])
+        else:
+            print('Warning: skipping unknown record %s' % kind)
+
+    def add_node(self, node_id, class_name, label, parent_id, pos):
+        node_class = self.node_classes.get(class_name)
+        if node_class is None:
+            raise ValueError('Unknown node class %s' % class_name)
+        if parent_id is None and self.root_node_id is None:
+            # The file's root node becomes the graph's root node
+            self.root_node_id = node_id
+            self.nodes[node_id] = self.graph.root_node
+            return
+        if parent_id in self.pending_index:
+            parent = self.pending_index[parent_id]
+        else:
+            parent = self.nodes.get(parent_id)
+        if pos is not None:
+            pos = tuple(pos)
+        self.pending_index[node_id] = self.created_node(
+            len(self.pending_specs))
+        self.pending_specs.append((node_class, label, parent, node_id, pos))
+        self.pending_ids.append(node_id)
+        if len(self.pending_specs) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.pending_specs:
+            return
+        new_nodes = self.graph._create_nodes(self.pending_specs)
+        for node_id, new_node in zip(self.pending_ids, new_nodes):
+            self.nodes[node_id] = new_node
+        self.pending_specs = []
+        self.pending_ids = []
+        self.pending_index = {}
+
+    def add_parameter(self, node_id, parameter_id, label, parent_id, index,
+                      source, sink, value, is_root):
+        graph_node = self.nodes[node_id]
+        if is_root and graph_node._root_parameter is not None:
+            # Loading onto a node that already has one, e.g. the root node
+            self.params[(node_id, parameter_id)] = graph_node.root_parameter
+            return
+        parent = None
+        if parent_id is not None:
+            parent = self.params[(node_id, parent_id)]
+        param = node.parameter.Parameter._create_quietly(
+            label, parameter_id, parent, index, graph_node, source, sink,
+            value)
+        if is_root:
+            graph_node._root_parameter = param
+        self.params[(node_id, parameter_id)] = param
+
+    def endpoint(self, node_id, parameter_id, is_tunnel):
+        param = self.params.get((node_id, parameter_id))
+        if param is None:
+            # On a node loaded earlier, e.g. the subgraph of a chunk
+            param = self.nodes[node_id].get_parameter(parameter_id)
+        if is_tunnel:
+            return param.node.get_tunnel_parameter(param)
+        return param
+
+    def add_connection(self, source_node_id, source_id, source_is_tunnel,
+                       sink_node_id, sink_id, sink_is_tunnel):
+        source = self.endpoint(source_node_id, source_id, source_is_tunnel)
+        sink = self.endpoint(sink_node_id, sink_id, sink_is_tunnel)
+        self.graph._connect_quietly(source, sink)
+
+
+def read(fp, graph=None, node_classes=None):
+    '''Load the graph in fp (a file opened in binary mode) into graph, or a
+    new graph. node_classes maps class names to node classes, for nodes of
+    classes other than Node and SubgraphNode. Returns the graph.'''
+    from ramen.core.graph import Graph
+    if graph is None:
+        graph = Graph()
+    classes = {'Node': node.Node, 'SubgraphNode': node.SubgraphNode}
+    if node_classes is not None:
+        classes.update(node_classes)
+    loader = _Loader(graph, classes)
+    with graph.batch():
+        for record in read_records(fp):
+            loader.add(record)
+        loader.flush()
+    return graph
+
+
+def save(graph, path, binary=False):
+    with open(path, 'wb') as fp:
+        write(graph, fp, binary=binary)
+
+
+def load(path, graph=None, node_classes=None):
+    with open(path, 'rb') as fp:
+        return read(fp, graph=graph, node_classes=node_classes)
+
+
+def _chunk_records(subgraph, offsets, rank):
+    # Subgraphs first, then computing nodes in topological order
+    graph = subgraph.graph
+    children = sorted(subgraph.children, key=lambda child: (
+        not child.accepts_children, rank.get(child, 0)))
+    connections = graph.connections_within(subgraph)
+    if subgraph.parent is None:
+        # The root node itself goes in its chunk
+        yield _node_record(subgraph, None)
+        for record in _parameter_records(subgraph):
+            yield record
+        connections.extend(graph.connections_within(None))
+    for child in children:
+        yield _node_record(child, subgraph.node_id)
+    for child in children:
+        for record in _parameter_records(child):
+            yield record
+    for child in children:
+        if child in offsets:
+            yield ('chunk', child.node_id, offsets[child])
+    for source, sink in connections:
+        yield ('connection',) + _endpoint(source) + _endpoint(sink)
+    yield ('end',)
+
+
+def write_chunked(graph, fp):
+    '''Write graph to fp (a file opened in binary mode) for a ChunkStore.
+    The contents of each subgraph (its children, their parameters and the
+    connections between them) are written as a separate chunk of binary
+    records, ending with an ('end',) record. A subgraph's chunk refers to
+    its children's chunks with ('chunk', node_id, offset) records. The
+    file ends with the offset of the root node's chunk.'''
+    fp.write(CHUNKED_MAGIC)
+    rank = dict((graph_node, index) for index, graph_node in
+                enumerate(graph.topological_order()))
+    # Reversed preorder, so children's chunks are written before their
+    # parents' refer to them
+    subgraphs = []
+    stack = [graph.root_node]
+    while stack:
+        subgraph = stack.pop()
+        subgraphs.append(subgraph)
+        stack.extend(child for child in subgraph.children
+                     if child.accepts_children)
+    offsets = {}
+    for subgraph in reversed(subgraphs):
+        offsets[subgraph] = fp.tell()
+        for record in _chunk_records(subgraph, offsets, rank):
+            pickle.dump(record, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    fp.write(struct.pack('>Q', offsets[graph.root_node]))
+
+
+def save_chunked(graph, path):
+    with open(path, 'wb') as fp:
+        write_chunked(graph, fp)
+
+
+def _contents(subgraph):
+    '''What a subgraph's chunk creates'''
+    return frozenset(itertools.chain(
+        subgraph._children,
+        *(child._parameters.values() for child in subgraph._children)))
+
+
+class ChunkStore(object):
+    '''A graph written with write_chunked, loaded lazily: only the root
+    node's chunk is loaded up front, and each subgraph's contents are loaded
+    the first time they're touched (SubgraphNode.children,
+    tunnel_parameters, get_tunnel_parameter or ensure_loaded, which
+    evaluating and viewing a subgraph go through).
+
+    If max_loaded is set, the least recently touched subgraphs are unloaded
+    to keep at most that many loaded. Subgraphs whose contents changed since
+    they were loaded (or that are being touched, with their ancestors) are
+    never unloaded, since they can't be loaded back from the file.
+
+    The file stays open until close(), and the graph needs it to load
+    subgraphs until then. The graph only references the store weakly, so
+    keep it around for as long as subgraphs should load.
+    '''
+    def __init__(self, path, graph=None, node_classes=None, max_loaded=None):
+        from ramen.core.graph import Graph
+        if graph is None:
+            graph = Graph()
+        self._graph = graph
+        self._node_classes = {'Node': node.Node,
+                              'SubgraphNode': node.SubgraphNode}
+        if node_classes is not None:
+            self._node_classes.update(node_classes)
+        self.max_loaded = max_loaded
+        # subgraph -> (file node_id, offset of its chunk)
+        self._chunks = {}
+        # loaded subgraph -> its _contents when loaded, least recently
+        # touched first
+        self._loaded = collections.OrderedDict()
+        # loaded subgraphs whose contents changed since
+        self._modified = set()
+        # Set while loading or unloading, when changes aren't modifications
+        self._busy = False
+
+        self._fp = open(path, 'rb')
+        if self._fp.read(len(CHUNKED_MAGIC)) != CHUNKED_MAGIC:
+            self._fp.close()
+            raise ValueError('Not a chunked ramen graph file')
+        self._fp.seek(-8, os.SEEK_END)
+        root_offset = struct.unpack('>Q', self._fp.read(8))[0]
+        self._read_chunk(root_offset, {})
+        self.register_callbacks()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def register_callbacks(self):
+        self.graph.node_id_changed.connect_weak(self._node_changed_callback)
+        self.graph.node_label_changed.connect_weak(
+            self._node_changed_callback)
+        self.graph.node_pos_changed.connect_weak(
+            self._node_changed_callback)
+        self.graph.parameter_value_changed.connect_weak(
+            self._parameter_changed_callback)
+        self.graph.parameter_sink_changed.connect_weak(
+            self._parameter_changed_callback)
+        self.graph.parameter_source_changed.connect_weak(
+            self._parameter_changed_callback)
+        self.graph.connection_added.connect_weak(
+            self._connection_changed_callback)
+        self.graph.connection_removed.connect_weak(
+            self._connection_changed_callback)
+
+    def deregister_callbacks(self):
+        self.graph.node_id_changed.disconnect(self._node_changed_callback)
+        self.graph.node_label_changed.disconnect(self._node_changed_callback)
+        self.graph.node_pos_changed.disconnect(self._node_changed_callback)
+        self.graph.parameter_value_changed.disconnect(
+            self._parameter_changed_callback)
+        self.graph.parameter_sink_changed.disconnect(
+            self._parameter_changed_callback)
+        self.graph.parameter_source_changed.disconnect(
+            self._parameter_changed_callback)
+        self.graph.connection_added.disconnect(
+            self._connection_changed_callback)
+        self.graph.connection_removed.disconnect(
+            self._connection_changed_callback)
+
+    @property
+    def graph(self):
+        return self._graph
+
+    def close(self):
+        self.deregister_callbacks()
+        self._fp.close()
+
+    def is_loaded(self, subgraph):
+        return subgraph not in self._chunks or subgraph in self._loaded
+
+    @property
+    def loaded_subgraphs(self):
+        return list(self._loaded)
+
+    def touch(self, subgraph):
+        '''Load subgraph if it isn't, and mark it most recently used'''
+        if subgraph in self._loaded:
+            # Re-inserted to move it to the end (move_to_end is python 3
+            # only)
+            self._loaded[subgraph] = self._loaded.pop(subgraph)
+            return
+        if subgraph not in self._chunks:
+            return
+        # Loaded from here on, so touching it while loading doesn't recurse
+        self._loaded[subgraph] = frozenset()
+        node_id, offset = self._chunks[subgraph]
+        self._read_chunk(offset, {node_id: subgraph})
+        self._loaded[subgraph] = _contents(subgraph)
+        self._trim(subgraph)
+
+    def unload(self, subgraph):
+        '''Drop the contents of subgraph, to be loaded again when it's next
+        touched. Returns whether it's unloaded: subgraphs whose contents
+        changed since they were loaded are kept.'''
+        if subgraph not in self._loaded:
+            return subgraph in self._chunks
+        descendants = []
+        stack = list(subgraph._children)
+        while stack:
+            descendant = stack.pop()
+            descendants.append(descendant)
+            stack.extend(descendant._children)
+        for cur_node in itertools.chain([subgraph], descendants):
+            if cur_node in self._loaded and (
+                    cur_node in self._modified or
+                    self._loaded[cur_node] != _contents(cur_node)):
+                return False
+
+        self._busy = True
+        try:
+            with self.graph.batch():
+                params = list(subgraph._tunnel_parameters.values())
+                for descendant in descendants:
+                    params.extend(descendant.parameters)
+                    params.extend(getattr(descendant, '_tunnel_parameters',
+                                          {}).values())
+                for param in params:
+                    for other in list(param.connections):
+                        param.disconnect(other)
+                for descendant in descendants:
+                    descendant.graph = None
+                    self._loaded.pop(descendant, None)
+                    self._chunks.pop(descendant, None)
+                    self._modified.discard(descendant)
+        finally:
+            self._busy = False
+        del self._loaded[subgraph]
+        return True
+
+    def _trim(self, touched):
+        if self.max_loaded is None:
+            return
+        keep = set(touched.ancestors)
+        keep.add(touched)
+        for subgraph in list(self._loaded):
+            if len(self._loaded) <= self.max_loaded:
+                return
+            if subgraph in self._loaded and subgraph not in keep:
+                self.unload(subgraph)
+
+    def _add_chunk(self, subgraph, node_id, offset):
+        self._chunks[subgraph] = (node_id, offset)
+        subgraph._chunk_store = weakref.ref(self)
+
+    def _read_chunk(self, offset, nodes):
+        # Read the whole chunk first: loading it can touch other subgraphs
+        self._fp.seek(offset)
+        records = []
+        while True:
+            record = pickle.load(self._fp)
+            if record[0] == 'end':
+                break
+            records.append(record)
+        loader = _Loader(self.graph, self._node_classes, store=self)
+        loader.nodes.update(nodes)
+        busy = self._busy
+        self._busy = True
+        try:
+            with self.graph.batch():
+                for record in records:
+                    loader.add(record)
+                loader.flush()
+        finally:
+            self._busy = busy
+
+    def _modify(self, subgraph):
+        if not self._busy and subgraph in self._loaded:
+            self._modified.add(subgraph)
+
+    def _node_changed_callback(self, node):
+        self._modify(node.parent)
+
+    def _parameter_changed_callback(self, parameter):
+        if parameter.node is not None:
+            self._modify(parameter.node.parent)
+
+    def _connection_changed_callback(self, source, sink):
+        self._modify(source.connection_subgraph)
@@ -1,37 +1,242 @@
 import inspect
+import weakref
+
+try:
+    _getargspec = inspect.getfullargspec
+except AttributeError:
+    # python 2
+    _getargspec = inspect.getargspec
+
+
+# function -> accepted kwargs, shared by every bound method of a function.
+# Nodes connect the same handful of methods over and over.
+_accepted_kwargs_cache = weakref.WeakKeyDictionary()
+
+
+def _accepted_kwargs(slot):
+    '''Build the call plan for a slot: the set of keyword argument names
+    it accepts, or None if it accepts any keyword (**kwargs, or a callable
+    we can't introspect).'''
+    func = getattr(slot, '__func__', slot)
+    try:
+        return _accepted_kwargs_cache[func]
+    except (KeyError, TypeError):
+        pass
+    accepted = _introspect_accepted_kwargs(slot)
+    try:
+        _accepted_kwargs_cache[func] = accepted
+    except TypeError:
+        # Not weak referenceable, e.g. builtins
+        pass
+    return accepted
+
+
+def _introspect_accepted_kwargs(slot):
+    try:
+        argspec = _getargspec(slot)
+    except TypeError:
+        # builtins and other callables without an argspec
+        return None
+    # getfullargspec calls it varkw, getargspec calls it keywords
+    if getattr(argspec, 'varkw', getattr(argspec, 'keywords', None)):
+        return None
+    accepted = set(argspec.args)
+    accepted.update(getattr(argspec, 'kwonlyargs', None) or ())
+    return frozenset(accepted)
+
+
+try:
+    _WeakMethod = weakref.WeakMethod
+except AttributeError:
+    # python 2
+    class _WeakMethod(weakref.ref):
+        __slots__ = ('_func', '_meth_type')
+
+        def __new__(cls, meth, callback=None):
+            self = weakref.ref.__new__(cls, meth.__self__, callback)
+            self._func = meth.__func__
+            self._meth_type = type(meth)
+            return self
+
+        def __init__(self, meth, callback=None):
+            super(_WeakMethod, self).__init__(meth.__self__, callback)
+
+        def __call__(self):
+            obj = super(_WeakMethod, self).__call__()
+            if obj is None:
+                return None
+            return self._meth_type(self._func, obj, type(obj))
+
+        def __eq__(self, other):
+            if not isinstance(other, _WeakMethod):
+                return NotImplemented
+            if self() is None or other() is None:
+                return self is other
+            return (weakref.ref.__eq__(self, other) and
+                    self._func == other._func)
+
+        def __ne__(self, other):
+            return not self == other
+
+        __hash__ = weakref.ref.__hash__
+
+
+def _weak_ref(slot, callback=None):
+    '''A weak reference to slot. A bound method is referenced through its
+    object and function, since the method object itself is made on the fly
+    and dies right away.'''
+    if getattr(slot, '__self__', None) is not None:
+        return _WeakMethod(slot, callback)
+    return weakref.ref(slot, callback)
 
 
 class Signal(object):
     '''Small implementation of signals/slots with optional arguments'''
+    __slots__ = ('_slots', 'deferring', '__weakref__')
+
     def __init__(self):
         # _slots is a dictionary of:
         # Key: function to call when this signal is emitted.
-        # Value: tuple of args and kwargs specified at connection time.
+        # Value: call plan tuple of (args, kwargs, accepted kwarg names,
+        # batched, weak)
         # The connection-time args are useful for specifying default
         # arguments that emit may or may not specify (most commonly not).
+        # The accepted kwarg names are introspected once at connection time
+        # (None means the slot takes **kwargs), so emit only has to filter.
+        # A weak slot's key is a weak reference to the function instead (see
+        # connect_weak), which is removed when the function dies.
         # A function can only be connected to a Signal once.
-        self._slots = {}
+        # It's None until something is connected, since most signals never
+        # are.
+        self._slots = None
+        # While deferring, slots connected with connect_batched are skipped.
+        # They opted in to receiving a consolidated change set instead
+        # (see Graph.batch).
+        self.deferring = False
 
     def emit(self, *args, **kwargs):
-        for slot, (conn_args, conn_kwargs) in self._slots.items():
-            full_args = list(conn_args)
-            full_args.extend(args)
-
-            full_kwargs = dict(conn_kwargs)
-            full_kwargs.update(kwargs)
-            argspec = inspect.getargspec(slot)
-            if not argspec.keywords:
-                for key in list(full_kwargs.keys()):
-                    if key not in argspec.args:
-                        del full_kwargs[key]
+        if not self._slots:
+            return
+        # Copy the plans so slots can connect/disconnect while we emit
+        for slot, (conn_args, conn_kwargs, accepted, batched, weak) in list(
+                self._slots.items()):
+            if batched and self.deferring:
+                continue
+            if weak:
+                slot = slot()
+                if slot is None:
+                    continue
+            if conn_args:
+                full_args = conn_args + args
+            else:
+                full_args = args
+
+            if conn_kwargs:
+                full_kwargs = dict(conn_kwargs)
+                full_kwargs.update(kwargs)
+            else:
+                full_kwargs = kwargs
+            if accepted is not None:
+                full_kwargs = dict((key, val) for key, val
+                                   in full_kwargs.items() if key in accepted)
 
             slot(*full_args, **full_kwargs)
 
     def connect(self, slot, *slot_args, **slot_kwargs):
-        self._slots[slot] = (slot_args, slot_kwargs)
+        if self._slots is None:
+            self._slots = {}
+        self._slots[slot] = (slot_args, slot_kwargs, _accepted_kwargs(slot),
+                             False, False)
+
+    def connect_batched(self, slot, *slot_args, **slot_kwargs):
+        '''Connect a slot that is skipped while this signal is deferring,
+        because it handles the consolidated change set instead.'''
+        if self._slots is None:
+            self._slots = {}
+        self._slots[slot] = (slot_args, slot_kwargs, _accepted_kwargs(slot),
+                             True, False)
+
+    def connect_weak(self, slot, *slot_args, **slot_kwargs):
+        '''Connect a slot without keeping it alive. When a bound method's
+        object (or any other slot) dies, it's disconnected.
+
+        Use it for receivers that reference what they connect to, like an
+        editor item connected to its node, so the two don't make a reference
+        cycle that only the cyclic garbage collector can free.
+        '''
+        if self._slots is None:
+            self._slots = {}
+        # The cleanup only references this Signal weakly, or the Signal and
+        # the slot would be a cycle again
+        self_ref = weakref.ref(self)
+
+        def remove(slot_ref):
+            signal = self_ref()
+            if signal is not None and signal._slots:
+                signal._slots.pop(slot_ref, None)
+        self._slots[_weak_ref(slot, remove)] = (
+            slot_args, slot_kwargs, _accepted_kwargs(slot), False, True)
 
     def disconnect(self, slot):
-        if slot in self._slots:
+        if self._slots and slot in self._slots:
             del self._slots[slot]
-        else:
-            print('Warning: Could not disconnect %s from %s' % (slot, self))
+            return
+        if self._slots:
+            try:
+                slot_ref = _weak_ref(slot)
+            except TypeError:
+                # Not weak referenceable, so it can't be a weak slot
+                slot_ref = None
+            if slot_ref is not None and slot_ref in self._slots:
+                del self._slots[slot_ref]
+                return
+        print('Warning: Could not disconnect %s from %s' % (slot, self))
+
+
+class LazySignal(object):
+    '''A Signal attribute that is only created when it's first used, for
+    objects there are a lot of. The Signal lives in the __slots__ attribute
+    named slot:
+
+        class Foo(SignalEmitter):
+            __slots__ = ('_changed',)
+            changed = LazySignal('_changed')
+
+    Use SignalEmitter._emit to emit it without creating it.
+    '''
+    def __init__(self, slot):
+        self.slot = slot
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        signal = getattr(obj, self.slot, None)
+        if signal is None:
+            signal = Signal()
+            setattr(obj, self.slot, signal)
+        return signal
+
+
+class SignalEmitter(object):
+    '''Base for classes with LazySignals'''
+    __slots__ = ()
+
+    def _deferring(self):
+        '''Whether slots connected with connect_batched are skipped, e.g.
+        during a Graph.batch() of the graph this belongs to'''
+        return False
+
+    def _emit(self, name, **kwargs):
+        '''Emit the signal called name. A signal that was never created has
+        nothing connected, so it's left alone.'''
+        signal = getattr(self, '_' + name, None)
+        if signal is None:
+            return
+        if signal.deferring or not signal._slots or not self._deferring():
+            signal.emit(**kwargs)
+            return
+        signal.deferring = True
+        try:
+            signal.emit(**kwargs)
+        finally:
+            signal.deferring = False
@@ -0,0 +1,585 @@
+'''Copy-on-write snapshots and forks of a graph.
+
+graph.snapshot() returns a GraphSnapshot: an immutable view of the node
+hierarchy, parameters and connections, made of plain values (NodeState and
+ParameterState tuples) rather than the graph's objects, so it can be read
+and evaluated from any thread while the graph keeps changing. Parameters
+refer to each other by endpoint, (node_id, parameter_id, is a tunnel), as
+in ramen.core.serialize.
+
+Snapshots share structure. The node states live in a _PersistentMap, whose
+updates only copy the buckets that change, and the graph keeps track of
+which nodes changed since its last snapshot. So taking a snapshot costs
+nothing if nothing changed, and otherwise in proportion to what changed
+(plus a copy of the map's list of buckets), not to the graph.
+
+snapshot.fork() (or graph.fork()) returns a GraphFork: a mutable copy that
+only stores the node states it changed on top of its snapshot. Forks don't
+have signals, nodes or parameter objects; they're for what-if evaluations,
+one fork per thread:
+
+    variant = graph.fork()
+    variant.set_value(('a', 'in', False), 2)
+    variant.evaluate(('d', 'out', False))
+
+Evaluation follows ramen.core.evaluate (tunnels and subgraph parameters
+pass values through, and only the upstream cone is computed), without the
+cache: every evaluate() call computes its cone once.
+
+Parameter labels, indices and parents aren't part of the states, since the
+graph doesn't signal their changes.
+'''
+import collections
+import weakref
+
+from ramen.core import node
+from ramen.core.evaluate import _sort_key
+from ramen.core.serialize import _endpoint
+
+# Buckets of a _PersistentMap hold around this many keys
+_BUCKET_SIZE = 16
+_REMOVED = object()
+# Shared by every unconnected parameter state
+_NO_CONNECTIONS = frozenset()
+
+
+def _endpoint_key(endpoint):
+    '''evaluate.source_key for endpoints'''
+    return (_sort_key(endpoint[0]), _sort_key(endpoint[1]), endpoint[2])
+
+
+class _PersistentMap(object):
+    '''An immutable mapping that shares structure with the maps it's updated
+    into: keys are spread over small bucket dicts, and updated() copies the
+    list of buckets and only the buckets that change.'''
+    __slots__ = ('_buckets', '_mask', '_len')
+
+    def __init__(self, items=()):
+        items = list(items)
+        nbuckets = 8
+        while nbuckets * _BUCKET_SIZE < len(items):
+            nbuckets *= 2
+        self._buckets = [{} for i in range(nbuckets)]
+        self._mask = nbuckets - 1
+        for key, value in items:
+            self._buckets[hash(key) & self._mask][key] = value
+        self._len = len(items)
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, key):
+        return key in self._buckets[hash(key) & self._mask]
+
+    def __iter__(self):
+        for bucket in self._buckets:
+            for key in bucket:
+                yield key
+
+    def get(self, key, default=None):
+        return self._buckets[hash(key) & self._mask].get(key, default)
+
+    def values(self):
+        for bucket in self._buckets:
+            for value in bucket.values():
+                yield value
+
+    def items(self):
+        for bucket in self._buckets:
+            for item in bucket.items():
+                yield item
+
+    def updated(self, changes):
+        '''A new map with changes, a dict of key -> value (or _REMOVED),
+        applied'''
+        new_map = _PersistentMap.__new__(_PersistentMap)
+        new_map._buckets = list(self._buckets)
+        new_map._mask = self._mask
+        new_map._len = self._len
+        copied = set()
+        for key, value in changes.items():
+            index = hash(key) & self._mask
+            bucket = new_map._buckets[index]
+            if index not in copied:
+                bucket = new_map._buckets[index] = dict(bucket)
+                copied.add(index)
+            if value is _REMOVED:
+                if key in bucket:
+                    del bucket[key]
+                    new_map._len -= 1
+            else:
+                if key not in bucket:
+                    new_map._len += 1
+                bucket[key] = value
+        if new_map._len > 2 * _BUCKET_SIZE * len(new_map._buckets):
+            # Grown too big for its buckets: spread it over more
+            return _PersistentMap(new_map.items())
+        return new_map
+
+
+class NodeState(collections.namedtuple('NodeState', [
+        'node_id', 'node_class', 'label', 'parent_id', 'pos', 'compute',
+        'parameters'])):
+    '''A node as of a snapshot. parameters is a tuple of ParameterStates.'''
+    __slots__ = ()
+
+    @property
+    def accepts_children(self):
+        return issubclass(self.node_class, node.SubgraphNode)
+
+    def get_parameter(self, parameter_id):
+        for param in self.parameters:
+            if param.parameter_id == parameter_id:
+                return param
+        return None
+
+
+class ParameterState(collections.namedtuple('ParameterState', [
+        'parameter_id', 'source', 'sink', 'value', 'connections_in',
+        'connections_out', 'tunnel_connections_in',
+        'tunnel_connections_out'])):
+    '''A parameter as of a snapshot. Connections are frozensets of
+    endpoints. On a subgraph node, the tunnel_ ones are the connections of
+    its tunnel (None elsewhere).'''
+    __slots__ = ()
+
+
+def _endpoints(graph, refs):
+    '''The endpoints of the parameters in a set of weak references that are
+    (still) in graph'''
+    if not refs:
+        return _NO_CONNECTIONS
+    endpoints = []
+    for ref in refs:
+        param = ref()
+        if param is None:
+            continue
+        param_node = param.node
+        if param_node is not None and param_node.graph is graph:
+            endpoints.append(_endpoint(param))
+    return frozenset(endpoints)
+
+
+def node_state(graph, graph_node):
+    '''The NodeState of graph_node, a node of graph'''
+    tunnels = getattr(graph_node, '_parameter_to_tunnel', None)
+    params = []
+    for param in graph_node._parameters.values():
+        tunnel_in = tunnel_out = None
+        if tunnels is not None:
+            tunnel = tunnels.get(param)
+            tunnel_in = tunnel_out = _NO_CONNECTIONS
+            if tunnel is not None:
+                tunnel_in = _endpoints(graph, tunnel._connections_in)
+                tunnel_out = _endpoints(graph, tunnel._connections_out)
+        params.append(ParameterState(
+            param.parameter_id, param.source, param.sink, param.value,
+            _endpoints(graph, param._connections_in),
+            _endpoints(graph, param._connections_out), tunnel_in,
+            tunnel_out))
+    parent = graph_node.parent
+    parent_id = None if parent is None else parent.node_id
+    return NodeState(graph_node.node_id, type(graph_node), graph_node.label,
+                     parent_id, graph_node.pos, graph_node.compute,
+                     tuple(params))
+
+
+class GraphSnapshot(object):
+    '''An immutable view of a graph. See the module docstring.'''
+    def __init__(self, nodes, root_node_id):
+        # node_id -> NodeState
+        self._nodes = nodes
+        self._root_node_id = root_node_id
+        # node_id -> ids of its children, built on first use
+        self._children = None
+
+    @property
+    def root_node_id(self):
+        return self._root_node_id
+
+    @property
+    def root_node(self):
+        return self._nodes.get(self._root_node_id)
+
+    @property
+    def nodes(self):
+        return list(self._nodes.values())
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __getitem__(self, node_id):
+        return self._nodes.get(node_id, None)
+
+    def __contains__(self, node_id):
+        return node_id in self._nodes
+
+    def children(self, node_id):
+        '''The NodeStates of node_id's children'''
+        if self._children is None:
+            # Racing threads would only build the same index twice
+            children = collections.defaultdict(list)
+            for state in self._nodes.values():
+                if state.parent_id is not None:
+                    children[state.parent_id].append(state.node_id)
+            self._children = children
+        return [self._nodes.get(child_id)
+                for child_id in self._children.get(node_id, ())]
+
+    def parameter(self, endpoint):
+        '''The ParameterState of endpoint (for a tunnel, of its parameter)'''
+        state = self._nodes.get(endpoint[0])
+        param = None
+        if state is not None:
+            param = state.get_parameter(endpoint[1])
+        if param is None:
+            raise ValueError('No parameter %r on node %r' % endpoint[1::-1])
+        return param
+
+    def connections_in(self, endpoint):
+        param = self.parameter(endpoint)
+        if endpoint[2]:
+            return param.tunnel_connections_in or _NO_CONNECTIONS
+        return param.connections_in
+
+    def connections_out(self, endpoint):
+        param = self.parameter(endpoint)
+        if endpoint[2]:
+            return param.tunnel_connections_out or _NO_CONNECTIONS
+        return param.connections_out
+
+    def connections(self):
+        '''Generate every connection as (source endpoint, sink endpoint)'''
+        for state in self._nodes.values():
+            for param in state.parameters:
+                source = (state.node_id, param.parameter_id, False)
+                for sink in param.connections_out:
+                    yield source, sink
+                if param.tunnel_connections_out:
+                    tunnel = (state.node_id, param.parameter_id, True)
+                    for sink in param.tunnel_connections_out:
+                        yield tunnel, sink
+
+    def fork(self):
+        return GraphFork(self)
+
+    def evaluate(self, endpoint):
+        '''The value of the parameter at endpoint: what it outputs if it's a
+        source, otherwise what it receives'''
+        return _Evaluation(self).evaluate(endpoint)
+
+
+class _Evaluation(object):
+    '''One evaluation of a snapshot, as in ramen.core.evaluate'''
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        # node_id -> its outputs
+        self.outputs = {}
+
+    def evaluate(self, endpoint):
+        param = self.snapshot.parameter(endpoint)
+        is_source = param.source
+        if endpoint[2]:
+            # A tunnel's sink/source are flipped
+            is_source = param.sink
+        if is_source:
+            terminals = self.terminals([endpoint])
+        else:
+            terminals = self.terminals(self.snapshot.connections_in(endpoint))
+        for node_id in self.upstream_nodes(terminals):
+            self.compute(node_id)
+        if is_source:
+            return self.output(endpoint)
+        return self.input(endpoint)
+
+    def is_subgraph_parameter(self, endpoint):
+        return (not endpoint[2] and
+                self.snapshot[endpoint[0]].accepts_children)
+
+    def terminals(self, sources):
+        '''The source endpoints on computing nodes providing the values of
+        sources, in _endpoint_key order'''
+        terminals = []
+        seen = set()
+        stack = list(sources)
+        while stack:
+            source = stack.pop()
+            if source in seen:
+                continue
+            seen.add(source)
+            if source[2]:
+                # The inside face of a subgraph sink, passing its value in
+                stack.extend(self.snapshot.connections_in(
+                    (source[0], source[1], False)))
+            elif self.is_subgraph_parameter(source):
+                # The outside face of a subgraph source, passing its value
+                # out
+                stack.extend(self.snapshot.connections_in(
+                    (source[0], source[1], True)))
+            else:
+                terminals.append(source)
+        return sorted(terminals, key=_endpoint_key)
+
+    def dependencies(self, node_id):
+        deps = set()
+        for param in self.snapshot[node_id].parameters:
+            if param.sink:
+                for terminal in self.terminals(param.connections_in):
+                    deps.add(terminal[0])
+        return deps
+
+    def upstream_nodes(self, terminals):
+        '''The node_ids of the computing nodes terminals depend on, in
+        dependency order'''
+        order = []
+        # node_id -> False while its dependencies are being visited, True
+        # when done
+        visited = {}
+        stack = [(terminal[0], False) for terminal in terminals]
+        while stack:
+            node_id, expanded = stack.pop()
+            if expanded:
+                visited[node_id] = True
+                order.append(node_id)
+                continue
+            if node_id in visited:
+                continue
+            visited[node_id] = False
+            stack.append((node_id, True))
+            for dep in self.dependencies(node_id):
+                if dep not in visited:
+                    stack.append((dep, False))
+                elif not visited[dep]:
+                    raise RuntimeError('Cycle through %s and %s' %
+                                       (node_id, dep))
+        return order
+
+    def compute(self, node_id):
+        state = self.snapshot[node_id]
+        if state.compute is None:
+            self.outputs[node_id] = {}
+            return
+        inputs = {}
+        for param in state.parameters:
+            if param.sink:
+                inputs[param.parameter_id] = self.input(
+                    (node_id, param.parameter_id, False))
+        self.outputs[node_id] = state.compute(inputs)
+
+    def input(self, endpoint):
+        '''The value endpoint receives, acting as a sink'''
+        sources = self.snapshot.connections_in(endpoint)
+        if not sources:
+            if endpoint[2]:
+                return None
+            return self.snapshot.parameter(endpoint).value
+        if len(sources) == 1:
+            return self.output(next(iter(sources)))
+        return [self.output(source)
+                for source in sorted(sources, key=_endpoint_key)]
+
+    def output(self, endpoint):
+        '''The value endpoint provides, acting as a source'''
+        node_id, parameter_id, is_tunnel = endpoint
+        if is_tunnel:
+            return self.input((node_id, parameter_id, False))
+        param = self.snapshot.parameter(endpoint)
+        if self.is_subgraph_parameter(endpoint):
+            if not param.tunnel_connections_in:
+                return param.value
+            return self.input((node_id, parameter_id, True))
+        if self.snapshot[node_id].compute is None:
+            return param.value
+        return self.outputs[node_id].get(parameter_id, param.value)
+
+
+class GraphFork(object):
+    '''A mutable copy of a snapshot, sharing every node state it doesn't
+    change. See the module docstring.'''
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+        # node_id -> NodeState changed since the last snapshot()
+        self._changes = {}
+
+    def __getitem__(self, node_id):
+        if node_id in self._changes:
+            return self._changes[node_id]
+        return self._snapshot[node_id]
+
+    def __contains__(self, node_id):
+        return self[node_id] is not None
+
+    def snapshot(self):
+        '''An immutable snapshot of the fork as it is now'''
+        if self._changes:
+            self._snapshot = GraphSnapshot(
+                self._snapshot._nodes.updated(self._changes),
+                self._snapshot.root_node_id)
+            self._changes = {}
+        return self._snapshot
+
+    def fork(self):
+        return self.snapshot().fork()
+
+    def evaluate(self, endpoint):
+        return self.snapshot().evaluate(endpoint)
+
+    def _state(self, node_id):
+        state = self[node_id]
+        if state is None:
+            raise ValueError('No node %r' % (node_id,))
+        return state
+
+    def _replace_parameter(self, endpoint, **changes):
+        state = self._state(endpoint[0])
+        params = list(state.parameters)
+        for i, param in enumerate(params):
+            if param.parameter_id == endpoint[1]:
+                params[i] = param._replace(**changes)
+                self._changes[endpoint[0]] = state._replace(
+                    parameters=tuple(params))
+                return param
+        raise ValueError('No parameter %r on node %r' % endpoint[1::-1])
+
+    def set_value(self, endpoint, value):
+        self._replace_parameter(endpoint, value=value)
+
+    def set_compute(self, node_id, compute):
+        self._changes[node_id] = self._state(node_id)._replace(
+            compute=compute)
+
+    def _connections(self, endpoint, direction):
+        param = self._state(endpoint[0]).get_parameter(endpoint[1])
+        if param is None:
+            raise ValueError('No parameter %r on node %r' % endpoint[1::-1])
+        if endpoint[2]:
+            direction = 'tunnel_' + direction
+        return direction, getattr(param, direction) or _NO_CONNECTIONS
+
+    def _update_connection(self, source, sink, connected):
+        for endpoint, other, direction in (
+                (source, sink, 'connections_out'),
+                (sink, source, 'connections_in')):
+            name, connections = self._connections(endpoint, direction)
+            if connected:
+                connections = connections.union([other])
+            else:
+                connections = connections.difference([other])
+            self._replace_parameter((endpoint[0], endpoint[1]),
+                                    **{name: connections})
+
+    def connect(self, source, sink):
+        '''Connect the source endpoint to the sink endpoint. Like
+        Connectable.connect_to_sink, there's no lofting: they have to be in
+        the same subgraph.'''
+        self._update_connection(source, sink, True)
+
+    def disconnect(self, source, sink):
+        self._update_connection(source, sink, False)
+
+
+class SnapshotTracker(object):
+    '''Keeps a graph's latest snapshot, and which of its nodes changed since.
+    Created by Graph.snapshot.'''
+    def __init__(self, graph):
+        # The graph owns this, so only reference it weakly
+        self._graph = weakref.ref(graph)
+        # Nodes whose states changed (weakly, so nodes deleted in the
+        # meantime can go), and ids of nodes that went away
+        self._dirty = weakref.WeakSet()
+        self._removed = set()
+        self._snapshot = GraphSnapshot(
+            _PersistentMap((graph_node.node_id, node_state(graph, graph_node))
+                           for graph_node in graph.nodes),
+            graph.root_node.node_id)
+        self.register_callbacks()
+
+    def _graph_callbacks(self):
+        graph = self.graph
+        return [
+            (graph.node_added, self._node_moved_callback),
+            (graph.node_removed, self._node_removed_callback),
+            (graph.node_id_changed, self._node_id_changed_callback),
+            (graph.node_parent_changed, self._node_changed_callback),
+            (graph.node_label_changed, self._node_changed_callback),
+            (graph.node_pos_changed, self._node_changed_callback),
+            (graph.node_compute_changed, self._node_changed_callback),
+            (graph.parameter_added, self._parameter_moved_callback),
+            (graph.parameter_removed, self._parameter_moved_callback),
+            (graph.parameter_value_changed,
+             self._parameter_changed_callback),
+            (graph.parameter_sink_changed, self._parameter_changed_callback),
+            (graph.parameter_source_changed,
+             self._parameter_changed_callback),
+            (graph.connection_added, self._connection_changed_callback),
+            (graph.connection_removed, self._connection_changed_callback),
+        ]
+
+    def register_callbacks(self):
+        for signal, callback in self._graph_callbacks():
+            signal.connect_weak(callback)
+
+    def deregister_callbacks(self):
+        for signal, callback in self._graph_callbacks():
+            signal.disconnect(callback)
+
+    @property
+    def graph(self):
+        return self._graph()
+
+    def snapshot(self):
+        '''The graph's snapshot, updated with the nodes that changed'''
+        graph = self.graph
+        if not self._dirty and not self._removed:
+            return self._snapshot
+        changes = dict((node_id, _REMOVED) for node_id in self._removed)
+        for graph_node in self._dirty:
+            if graph_node.graph is graph:
+                changes[graph_node.node_id] = node_state(graph, graph_node)
+        self._snapshot = GraphSnapshot(
+            self._snapshot._nodes.updated(changes),
+            graph.root_node.node_id)
+        self._dirty = weakref.WeakSet()
+        self._removed = set()
+        return self._snapshot
+
+    def _dirty_neighbors(self, params):
+        # Nodes connected to params, whose connections refer to them by
+        # endpoint
+        for param in params:
+            for other in param.connections:
+                if other.node is not None:
+                    self._dirty.add(other.node)
+
+    def _node_params(self, graph_node):
+        params = graph_node.parameters
+        params.extend(getattr(graph_node, '_tunnel_parameters', {}).values())
+        return params
+
+    def _node_changed_callback(self, node):
+        self._dirty.add(node)
+
+    def _node_moved_callback(self, node):
+        self._dirty.add(node)
+        self._dirty_neighbors(self._node_params(node))
+
+    def _node_removed_callback(self, node):
+        self._removed.add(node.node_id)
+        self._node_moved_callback(node)
+
+    def _node_id_changed_callback(self, node, old_node_id, node_id):
+        self._removed.add(old_node_id)
+        self._node_moved_callback(node)
+
+    def _parameter_moved_callback(self, node, parameter):
+        self._dirty.add(node)
+        self._dirty_neighbors([parameter])
+
+    def _parameter_changed_callback(self, parameter):
+        if parameter.node is not None:
+            self._dirty.add(parameter.node)
+
+    def _connection_changed_callback(self, source, sink):
+        for param in (source, sink):
+            if param.node is not None:
+                self._dirty.add(param.node)
@@ -0,0 +1,208 @@
+'''Incrementally maintained topological order of a graph's dependencies.
+
+Vertices are what values flow through: a computing (non-subgraph) node is
+one vertex, since any of its sinks can feed any of its sources. A
+parameter on a SubgraphNode and its TunnelParameter are one pass-through
+vertex, so values tunneling in and out of a subgraph don't look like a
+cycle through the subgraph node. Every connection is an edge between the
+vertices of its source and sink. (ramen.core.reachability, which is
+about what parameters are wired to, doesn't pass values through a node.)
+
+The order is kept up to date with the Pearce-Kelly algorithm: adding an
+edge that already agrees with the order is O(1), otherwise only the
+vertices between the edge's endpoints in the order are searched and
+reordered, and an edge that would close a cycle is found in the same
+search. Removing edges never invalidates the order.
+'''
+from ramen.core import node
+
+
+def is_vertex_node(graph_node):
+    '''Whether graph_node is a vertex itself (rather than a subgraph whose
+    parameters are vertices)'''
+    return not isinstance(graph_node, node.SubgraphNode)
+
+
+def vertex(param):
+    '''The vertex that param's connections attach to'''
+    if isinstance(param, node.parameter.TunnelParameter):
+        return param.tunneled_parameter
+    if isinstance(param.node, node.SubgraphNode):
+        return param
+    return param.node
+
+
+class Topology(object):
+    def __init__(self):
+        # vertex -> position in the order, and the reverse (None for
+        # removed vertices, compacted every so often)
+        self._ord = {}
+        self._vertices = []
+        # vertex -> {vertex: number of edges}
+        self._out = {}
+        self._in = {}
+
+    def __contains__(self, vert):
+        return vert in self._ord
+
+    def __iter__(self):
+        '''The vertices in order, without copying them'''
+        for vert in self._vertices:
+            if vert is not None:
+                yield vert
+
+    def order(self):
+        return [vert for vert in self._vertices if vert is not None]
+
+    def add_vertex(self, vert):
+        if vert in self._ord:
+            return
+        self._ord[vert] = len(self._vertices)
+        self._vertices.append(vert)
+        self._out[vert] = {}
+        self._in[vert] = {}
+
+    def remove_vertex(self, vert):
+        '''Remove vert and its edges'''
+        if vert not in self._ord:
+            return
+        for succ in self._out.pop(vert):
+            del self._in[succ][vert]
+        for pred in self._in.pop(vert):
+            del self._out[pred][vert]
+        self._vertices[self._ord.pop(vert)] = None
+        if len(self._vertices) > 2 * len(self._ord) + 16:
+            self._vertices = self.order()
+            for index, cur_vert in enumerate(self._vertices):
+                self._ord[cur_vert] = index
+
+    def successors(self, vert):
+        return list(self._out.get(vert, ()))
+
+    def predecessors(self, vert):
+        return list(self._in.get(vert, ()))
+
+    def would_create_cycle(self, source, sink):
+        if source is sink:
+            return True
+        if source not in self._ord or sink not in self._ord:
+            return False
+        if self._ord[source] < self._ord[sink]:
+            return False
+        return self._forward(sink, self._ord[source]) is None
+
+    def add_edge(self, source, sink):
+        '''Add an edge, reordering as needed. Returns False (and doesn't
+        add the edge) if it would create a cycle.'''
+        if source is sink:
+            return False
+        self.add_vertex(source)
+        self.add_vertex(sink)
+        out_edges = self._out[source]
+        if sink not in out_edges:
+            lower = self._ord[sink]
+            upper = self._ord[source]
+            if lower < upper:
+                forward = self._forward(sink, upper)
+                if forward is None:
+                    return False
+                self._reorder(self._backward(source, lower), forward)
+        out_edges[sink] = out_edges.get(sink, 0) + 1
+        self._in[sink][source] = self._in[sink].get(source, 0) + 1
+        return True
+
+    def add_edges(self, edges):
+        '''Add many (source, sink) edges. Returns the indices of the ones
+        not added, for creating a cycle (with the edges before them).
+
+        A batch big enough next to the graph is added in one go and the
+        order rebuilt once, rather than searched edge by edge; only if
+        that finds a cycle are the edges added one at a time.
+        '''
+        edges = list(edges)
+        if len(edges) * 4 < len(self._ord) or any(
+                source is sink for source, sink in edges):
+            return [i for i, (source, sink) in enumerate(edges)
+                    if not self.add_edge(source, sink)]
+        for source, sink in edges:
+            self.add_vertex(source)
+            self.add_vertex(sink)
+            out_edges = self._out[source]
+            out_edges[sink] = out_edges.get(sink, 0) + 1
+            self._in[sink][source] = self._in[sink].get(source, 0) + 1
+        order = self._sorted()
+        if order is not None:
+            self._vertices = order
+            for index, vert in enumerate(order):
+                self._ord[vert] = index
+            return []
+        for source, sink in edges:
+            self.remove_edge(source, sink)
+        return [i for i, (source, sink) in enumerate(edges)
+                if not self.add_edge(source, sink)]
+
+    def _sorted(self):
+        '''A topological order of every vertex, or None if there's a
+        cycle'''
+        in_degrees = dict((vert, len(preds))
+                          for vert, preds in self._in.items())
+        ready = [vert for vert in reversed(self.order())
+                 if not in_degrees[vert]]
+        order = []
+        while ready:
+            vert = ready.pop()
+            order.append(vert)
+            for succ in self._out[vert]:
+                in_degrees[succ] -= 1
+                if not in_degrees[succ]:
+                    ready.append(succ)
+        if len(order) < len(self._ord):
+            return None
+        return order
+
+    def remove_edge(self, source, sink):
+        out_edges = self._out.get(source)
+        if not out_edges or sink not in out_edges:
+            return False
+        out_edges[sink] -= 1
+        self._in[sink][source] -= 1
+        if not out_edges[sink]:
+            del out_edges[sink]
+            del self._in[sink][source]
+        return True
+
+    def _forward(self, start, upper):
+        '''Vertices reachable from start that are before upper in the
+        order, or None if the vertex at upper is reachable'''
+        visited = set([start])
+        stack = [start]
+        while stack:
+            for succ in self._out[stack.pop()]:
+                succ_ord = self._ord[succ]
+                if succ_ord == upper:
+                    return None
+                if succ_ord < upper and succ not in visited:
+                    visited.add(succ)
+                    stack.append(succ)
+        return visited
+
+    def _backward(self, start, lower):
+        '''Vertices that reach start and are after lower in the order'''
+        visited = set([start])
+        stack = [start]
+        while stack:
+            for pred in self._in[stack.pop()]:
+                if self._ord[pred] > lower and pred not in visited:
+                    visited.add(pred)
+                    stack.append(pred)
+        return visited
+
+    def _reorder(self, backward, forward):
+        # Everything that reaches the new edge's source goes before
+        # everything reachable from its sink, reusing the same positions
+        by_ord = self._ord.__getitem__
+        verts = sorted(backward, key=by_ord) + sorted(forward, key=by_ord)
+        positions = sorted(by_ord(vert) for vert in verts)
+        for vert, position in zip(verts, positions):
+            self._ord[vert] = position
+            self._vertices[position] = vert
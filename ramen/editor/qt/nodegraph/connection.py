@@ -41,8 +41,8 @@ class Connection(QtGui.QGraphicsPathItem):
 
     def registerNodegraphCallbacks(self):
         # TODO create faster lighterweight self.updatePos
-        self.sourceNodeUI.updatedGeo.connect(self.updateGeo)
-        self.sinkNodeUI.updatedGeo.connect(self.updateGeo)
+        self.sourceNodeUI.updatedGeo.connect_weak(self.updateGeo)
+        self.sinkNodeUI.updatedGeo.connect_weak(self.updateGeo)
 
     def deregisterRamenCallbacks(self):
         pass
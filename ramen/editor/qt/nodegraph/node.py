@@ -31,15 +31,14 @@ class Node(QtGui.QGraphicsItem):
         return self._ramenNode
 
     def registerRamenCallbacks(self):
-        self._ramenNode.pos_changed.connect(self.updateGeo)
-        self._ramenNode.selected_changed.connect(self.updateGeo)
-        self._ramenNode.label_changed.connect(self.updateGeo)
-        self._ramenNode.parameter_added.connect(self._addParameter)
-        self._ramenNode.parameter_removed.connect(self._removeParameter)
+        # Selection changes are forwarded by the Nodegraph
+        self._ramenNode.pos_changed.connect_weak(self.updateGeo)
+        self._ramenNode.label_changed.connect_weak(self.updateGeo)
+        self._ramenNode.parameter_added.connect_weak(self._addParameter)
+        self._ramenNode.parameter_removed.connect_weak(self._removeParameter)
 
     def deregisterRamenCallbacks(self):
         self._ramenNode.pos_changed.disconnect(self.updateGeo)
-        self._ramenNode.selected_changed.disconnect(self.updateGeo)
         self._ramenNode.label_changed.disconnect(self.updateGeo)
         self._ramenNode.parameter_added.disconnect(self._addParameter)
         self._ramenNode.parameter_removed.disconnect(self._removeParameter)
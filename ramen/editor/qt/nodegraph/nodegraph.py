@@ -31,14 +31,19 @@ class Nodegraph(QtGui.QWidget):
         self._nodegraphView.viewSubgraph(self.graph.root_node)
 
     def registerRamenCallbacks(self):
-        self.graph.node_added.connect(self._addNode)
-        self.graph.node_removed.connect(self._removeNode)
-        self.graph.node_parent_changed.connect(self._reparentNode)
+        # Inside a graph.batch(), these are replaced by one _applyChanges
+        self.graph.node_added.connect_batched(self._addNode)
+        self.graph.node_removed.connect_batched(self._removeNode)
+        self.graph.node_parent_changed.connect_batched(self._reparentNode)
+        self.graph.batch_committed.connect(self._applyChanges)
+        self.graph.selection_changed.connect(self._selectionChanged)
 
     def deregisterRamenCallbacks(self):
         self.graph.node_added.disconnect(self._addNode)
         self.graph.node_removed.disconnect(self._removeNode)
         self.graph.node_parent_changed.disconnect(self._reparentNode)
+        self.graph.batch_committed.disconnect(self._applyChanges)
+        self.graph.selection_changed.disconnect(self._selectionChanged)
 
     def syncFromRamen(self):
         # TODO: difference of nodes in the editor and not
@@ -83,6 +88,20 @@ class Nodegraph(QtGui.QWidget):
         self._removeNode(node)
         self._addNode(node)
 
+    def _applyChanges(self, changes):
+        for node in changes.removed_nodes:
+            self._removeNode(node)
+        for node in changes.added_nodes:
+            self._addNode(node)
+        for node in changes.reparented_nodes:
+            self._reparentNode(node)
+
+    def _selectionChanged(self, added, removed):
+        for node in added.union(removed):
+            uiNode = self.getNodeUI(node)
+            if uiNode is not None:
+                uiNode.updateGeo()
+
     @property
     def graph(self):
         return self._graph
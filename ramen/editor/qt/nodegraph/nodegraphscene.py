@@ -114,10 +114,10 @@ class NodegraphScene(QtGui.QGraphicsScene):
         if self._bandSelectAnchor is not None:
             # If we had a band select anchor, hide it.
             event.accept()
-            self.graph.selected_nodes = []
-            for uiItem in self.collidingItems(self._bandSelectRect):
-                if isinstance(uiItem, ramen.editor.qt.nodegraph.Node):
-                    uiItem.node.selected = True
+            self.graph.selected_nodes = [
+                uiItem.node for uiItem
+                in self.collidingItems(self._bandSelectRect)
+                if isinstance(uiItem, ramen.editor.qt.nodegraph.Node)]
             self._bandSelectRect.hide()
             self._bandSelectAnchor = None
         super(NodegraphScene, self).mouseReleaseEvent(event)
@@ -127,7 +127,7 @@ class NodegraphScene(QtGui.QGraphicsScene):
         hoveredNodeUI = self.itemTypeAt(event.scenePos(),
                                         ramen.editor.qt.nodegraph.Node)
         if hoveredNodeUI is not None:
-            hoveredNodeUI.node.selected = True
+            self.graph.select([hoveredNodeUI.node])
 
     def mousePressEvent(self, event):
         super(NodegraphScene, self).mousePressEvent(event)
@@ -154,12 +154,11 @@ class NodegraphScene(QtGui.QGraphicsScene):
                         hoveredNode = hoveredNodeUI.node
                         if event.modifiers() == QtCore.Qt.ShiftModifier:
                             # Shift modifier acts as a not, and we dont drag
-                            hoveredNode.selected = not hoveredNode.selected
+                            self.graph.toggle([hoveredNode])
                         else:
                             if not hoveredNode.selected:
                                 # If this node wasn't selected, select it
-                                self.graph.selected_nodes = []
-                                hoveredNode.selected = True
+                                self.graph.selected_nodes = [hoveredNode]
                             # Drag if this node was clicked without a modifier
                             self.activeDrag = True
                 else:
@@ -9,6 +9,8 @@ class NodegraphView(QtGui.QGraphicsView):
         self.setRenderHints(QtGui.QPainter.Antialiasing)
 
     def viewSubgraph(self, subgraphNode):
+        # Lazily loaded subgraphs are loaded when they're looked at
+        subgraphNode.ensure_loaded()
         nodeUI = self.nodegraph.getNodeUI(subgraphNode)
         if nodeUI is None:
             raise RuntimeError('No Node UI for %s' % subgraphNode)
@@ -30,12 +30,12 @@ class Parameter(QtGui.QGraphicsItem):
         return self._ramenParameter
 
     def registerRamenCallbacks(self):
-        self.ramenParameter.connection_added.connect(
+        self.ramenParameter.connection_added.connect_weak(
             self._connectionAddedCallback)
-        self.ramenParameter.connection_removed.connect(
+        self.ramenParameter.connection_removed.connect_weak(
             self._connectionRemovedCallback)
-        self.ramenParameter.source_changed.connect(self.updateGeo)
-        self.ramenParameter.sink_changed.connect(self.updateGeo)
+        self.ramenParameter.source_changed.connect_weak(self.updateGeo)
+        self.ramenParameter.sink_changed.connect_weak(self.updateGeo)
 
     def deregisterRamenCallbacks(self):
         self.ramenParameter.connection_added.disconnect(
@@ -47,8 +47,10 @@ class Parameter(QtGui.QGraphicsItem):
 
     def _connectionAddedCallback(self, source, sink):
         # Only create the connection if we're the source
-        # (prevent double-creating the connection)
-        if source == self.ramenParameter:
+        # (prevent double-creating the connection), and if it wasn't
+        # rejected (e.g. for creating a cycle) before we heard about it
+        if (source == self.ramenParameter and
+                sink in self.ramenParameter.connections_out):
             return self._addConnectionOut(sink)
 
     def _connectionRemovedCallback(self, source, sink):
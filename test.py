@@ -1,5 +1,8 @@
 # Quick tests just as I go -- formalize and make full coverage later
 
+import gc
+import weakref
+
 import ramen
 graph = ramen.Graph()
 
@@ -144,3 +147,1376 @@ param_e.source = True
 param_e.connect(param_f)
 assert(len(node_d.parameters) == 1)
 assert(len(node_d.parameters[0].connections) == 2)
+
+# Signals only pass the kwargs a slot accepts, connection-time kwargs
+# included, and pass everything to slots taking **kwargs
+signal = ramen.core.signal.Signal()
+scope = Scope()
+scope.calls = []
+
+
+def filtered_slot(node, pos):
+    scope.calls.append(('filtered', node, pos))
+
+
+def kwargs_slot(**kwargs):
+    scope.calls.append(('kwargs', kwargs))
+signal.connect(filtered_slot, node='a')
+signal.connect(kwargs_slot)
+signal.emit(pos=(1, 2), selected=True)
+assert(('filtered', 'a', (1, 2)) in scope.calls)
+assert(('kwargs', {'pos': (1, 2), 'selected': True}) in scope.calls)
+signal.disconnect(kwargs_slot)
+scope.calls = []
+signal.emit(pos=(3, 4))
+assert(scope.calls == [('filtered', 'a', (3, 4))])
+
+# Batched changes: normal slots see every event, batched slots are skipped
+# and one collapsed change set is delivered at the end of the batch
+graph.clear()
+scope = Scope()
+scope.added = []
+scope.batched_added = []
+scope.changes = []
+graph.node_added.connect(lambda node: scope.added.append(node))
+graph.node_added.connect_batched(
+    lambda node: scope.batched_added.append(node))
+graph.batch_committed.connect(lambda changes: scope.changes.append(changes))
+moved_node = graph.create_node()
+assert(scope.batched_added == [moved_node])
+with graph.batch():
+    with graph.batch():
+        node_a = graph.create_node()
+        node_b = graph.create_node()
+        for i in range(10):
+            moved_node.pos = (i, i)
+    assert(not scope.changes)
+    node_b.delete()
+assert(len(scope.added) == 3)
+assert(scope.batched_added == [moved_node])
+assert(len(scope.changes) == 1)
+changes = scope.changes[0]
+assert(changes.added_nodes == [node_a])
+assert(changes.removed_nodes == [])
+assert(changes.changed_attributes == {moved_node: {'pos': (9, 9)}})
+assert(not graph.batching)
+
+# A node changed, removed and put back in one batch keeps its changes, and
+# batched slots of node and parameter signals wait for the batch too
+scope.label_changes = []
+moved_node.label_changed.connect_batched(
+    lambda label: scope.label_changes.append(label))
+with graph.batch() as changes:
+    moved_node.label = 'moved'
+    assert(not scope.label_changes)
+    moved_node.graph = None
+    assert(moved_node in changes.removed_nodes)
+    assert(moved_node not in changes.changed_attributes)
+    moved_node.graph = graph
+assert(not scope.label_changes)
+changes = scope.changes[-1]
+assert(changes.added_nodes == [])
+assert(changes.removed_nodes == [])
+assert(changes.changed_attributes[moved_node]['label'] == 'moved')
+moved_node.label = 'moved again'
+assert(scope.label_changes == ['moved again'])
+
+# Bulk node creation
+graph.clear()
+subgraph = ramen.node.SubgraphNode(graph=graph, label='subgraph')
+scope.changes = []
+scope.children_added = []
+subgraph.child_added.connect(
+    lambda child: scope.children_added.append(child))
+nodes = graph.create_nodes([('a', None, 0, None),
+                            ('b', subgraph, 'b', (10, 20)),
+                            ('c', subgraph, 'b', None)])
+assert(scope.children_added == nodes[1:])
+assert([node.label for node in nodes] == ['a', 'b', 'c'])
+assert(len(set(node.node_id for node in nodes)) == 3)
+assert(all(graph[node.node_id] is node for node in nodes))
+assert(nodes[0].parent == graph.root_node)
+assert(nodes[1] in subgraph.children and nodes[2] in subgraph.children)
+assert(nodes[1].pos == (10, 20))
+assert(len(scope.changes) == 1)
+assert(scope.changes[0].added_nodes == nodes)
+# Bulk created nodes are wired up like any other
+param_a = nodes[2].create_parameter('a', source=True)
+param_b = nodes[1].create_parameter('b', sink=True)
+param_a.connect(param_b)
+assert(param_b in param_a.connections_out)
+# Parents must be in the graph
+other_graph = ramen.Graph()
+node_count = len(graph.nodes)
+try:
+    graph.create_nodes([('d', None, 0, None),
+                        ('e', other_graph.root_node, 0, None)])
+    assert(False)
+except ValueError:
+    pass
+assert(len(graph.nodes) == node_count)
+
+# Unique ids
+graph.clear()
+nodes = [graph.create_node() for i in range(100)]
+assert(len(set(node.node_id for node in nodes)) == 100)
+assert(all(graph[node.node_id] is node for node in nodes))
+node_a = graph.create_node(node_id='a')
+node_b = graph.create_node(node_id='a')
+node_c = graph.create_node(node_id='a')
+assert(node_b.node_id == 'a_1' and node_c.node_id == 'a_2')
+# Renames are tracked, and renaming onto a used id uniquefies it
+node_c.node_id = 'c'
+assert(graph['c'] is node_c and 'a_2' not in graph)
+scope.id_changes = []
+node_c.node_id_changed.connect(
+    lambda node_id: scope.id_changes.append(node_id))
+node_c.node_id = 'a'
+assert(node_c.node_id == 'a_3' and graph['a_3'] is node_c)
+assert(scope.id_changes == ['a_3'])
+assert(graph['a'] is node_a and 'c' not in graph)
+node_b.delete()
+assert(graph.create_node(node_id='a').node_id not in ('a', 'a_3'))
+params = [node_a.create_parameter('p') for i in range(10)]
+assert(len(set(param.parameter_id for param in params)) == 10)
+
+# Selection
+graph.clear()
+nodes = graph.create_nodes([('n', None, 0, None)] * 10)
+scope.selection_changes = []
+graph.selection_changed.connect(
+    lambda added, removed: scope.selection_changes.append((added, removed)))
+selected_nodes = graph.selected_nodes
+scope.node_selections = []
+nodes[0].selected_changed.connect(
+    lambda selected: scope.node_selections.append(selected))
+scope.graph_node_selections = []
+graph.node_selected_changed.connect(
+    lambda node, selected: scope.graph_node_selections.append(node))
+graph.select(nodes[:5])
+assert(len(scope.selection_changes) == 1)
+# Nodes still emit their own signals
+assert(scope.node_selections == [True])
+assert(set(scope.graph_node_selections) == set(nodes[:5]))
+assert(scope.selection_changes[0] == (frozenset(nodes[:5]), frozenset()))
+# The view is live and read-only
+assert(len(selected_nodes) == 5 and nodes[0] in selected_nodes)
+assert(not hasattr(selected_nodes, 'add'))
+assert(all(node.selected for node in nodes[:5]))
+graph.toggle(nodes[3:7])
+assert(scope.selection_changes[-1] == (frozenset(nodes[5:7]),
+                                       frozenset(nodes[3:5])))
+assert(set(selected_nodes) == set(nodes[:3] + nodes[5:7]))
+nodes[9].selected = True
+assert(scope.selection_changes[-1] == (frozenset([nodes[9]]), frozenset()))
+graph.selected_nodes = nodes[:2]
+assert(set(selected_nodes) == set(nodes[:2]))
+assert(not nodes[9].selected)
+nodes[0].delete()
+assert(set(selected_nodes) == set(nodes[1:2]))
+assert(not nodes[0].selected)
+graph.clear_selection()
+assert(len(selected_nodes) == 0)
+
+# Evaluation
+# root
+# |\
+# A S
+#   |\
+#   B C
+# A.out -> S.in, S.in's tunnel -> B.in, B.out -> C.in, C.out -> S.out's tunnel
+# S.out -> D.in, and an unrelated node E that must not be computed
+graph.clear()
+scope.computed = []
+
+
+def make_compute(label, fn):
+    def compute(inputs):
+        scope.computed.append(label)
+        return fn(inputs)
+    return compute
+node_a = graph.create_node(label='a')
+node_s = ramen.node.SubgraphNode(graph=graph, label='s')
+node_b = ramen.node.Node(parent=node_s, label='b')
+node_c = ramen.node.Node(parent=node_s, label='c')
+node_d = graph.create_node(label='d')
+node_e = graph.create_node(label='e')
+a_out = node_a.create_parameter('out', parameter_id='out', source=True)
+s_in = node_s.create_parameter('in', parameter_id='in', sink=True)
+s_out = node_s.create_parameter('out', parameter_id='out', source=True)
+assert(s_in.sink and not s_in.source)
+b_in = node_b.create_parameter('in', parameter_id='in', sink=True)
+b_out = node_b.create_parameter('out', parameter_id='out', source=True)
+c_in = node_c.create_parameter('in', parameter_id='in', sink=True)
+c_out = node_c.create_parameter('out', parameter_id='out', source=True)
+d_in = node_d.create_parameter('in', parameter_id='in', sink=True)
+e_out = node_e.create_parameter('out', parameter_id='out', source=True)
+a_out.connect(s_in)
+node_s.get_tunnel_parameter(s_in).connect(b_in)
+b_out.connect(c_in)
+c_out.connect(node_s.get_tunnel_parameter(s_out))
+s_out.connect(d_in)
+node_a.compute = make_compute('a', lambda inputs: {'out': 2})
+node_b.compute = make_compute('b', lambda inputs: {'out': inputs['in'] * 3})
+node_c.compute = make_compute('c', lambda inputs: {'out': inputs['in'] + 1})
+node_e.compute = make_compute('e', lambda inputs: {'out': 0})
+assert(graph.evaluate(d_in) == 7)
+assert(scope.computed == ['a', 'b', 'c'])
+scope.computed = []
+graph.evaluator.cache.clear()
+assert(graph.evaluate(b_out) == 6)
+assert(scope.computed == ['a', 'b'])
+# Unconnected sinks use their static value
+assert(graph.evaluate(e_out) == 0)
+s_in.disconnect(a_out)
+s_in.value = 5
+assert(graph.evaluate(d_in) == 16)
+
+# Dirty propagation and caching (using the graph from the last test)
+s_in.connect(a_out)
+scope.computed = []
+assert(graph.evaluate(d_in) == 7)
+assert(not d_in.dirty and not b_out.dirty)
+assert(graph.evaluate(d_in) == 7)
+# A's cached output survived the rewiring
+assert(scope.computed == ['b', 'c'])
+# Changing C only dirties C and what's downstream
+node_c.compute = make_compute('c', lambda inputs: {'out': inputs['in'] + 2})
+assert(c_out.dirty and d_in.dirty)
+assert(not b_out.dirty and not a_out.dirty)
+scope.computed = []
+assert(graph.evaluate(d_in) == 8)
+assert(scope.computed == ['c'])
+# Rewiring dirties the sink's downstream cone
+s_in.disconnect(a_out)
+assert(b_in.dirty and c_out.dirty and d_in.dirty and not a_out.dirty)
+scope.computed = []
+assert(graph.evaluate(d_in) == 17)
+assert(scope.computed == ['b', 'c'])
+# Evicted outputs are recomputed even if they're clean
+graph.evaluator.cache.max_entries = 1
+assert(len(graph.evaluator.cache) == 1)
+scope.computed = []
+assert(graph.evaluate(d_in) == 17)
+assert(scope.computed == [])
+assert(graph.evaluate(b_out) == 15)
+assert(scope.computed == ['b'])
+graph.evaluator.cache.max_entries = None
+# Several sources come in source_key order, whatever order they were
+# connected in
+fan_node = graph.create_node(label='fan')
+fan_param = fan_node.create_parameter('in', parameter_id='in', sink=True)
+for node_id in ('feed_c', 'feed_a', 'feed_b'):
+    feed = graph.create_node(node_id=node_id)
+    feed.create_parameter('out', parameter_id='out',
+                          source=True).connect(fan_param)
+    feed.compute = lambda inputs, node_id=node_id: {'out': node_id}
+assert(graph.evaluate(fan_param) == ['feed_a', 'feed_b', 'feed_c'])
+
+# Parallel scheduling
+import ramen.core.scheduler
+# Four independent chains of two nodes, plus a node joining them
+graph.clear()
+join_node = graph.create_node(label='join')
+chain_outs = []
+for i in range(4):
+    head = graph.create_node(label='head')
+    head_out = head.create_parameter('out', parameter_id='out', source=True)
+    head.compute = lambda inputs, i=i: {'out': i}
+    tail = graph.create_node(label='tail')
+    tail_in = tail.create_parameter('in', parameter_id='in', sink=True)
+    tail_out = tail.create_parameter('out', parameter_id='out', source=True)
+    tail.compute = lambda inputs: {'out': inputs['in'] * 10}
+    # GIL bound nodes run in the scheduling thread
+    tail.compute_hints = [ramen.core.scheduler.GIL_BOUND]
+    head_out.connect(tail_in)
+    join_in = join_node.create_parameter('in', parameter_id=i, sink=True)
+    tail_out.connect(join_in)
+    chain_outs.append(tail_out)
+join_out = join_node.create_parameter('out', parameter_id='out', source=True)
+join_node.compute = lambda inputs: {'out': sum(inputs.values())}
+with ramen.core.scheduler.Scheduler(graph, max_workers=4) as scheduler:
+    result = scheduler.evaluate([join_out, chain_outs[1]])
+assert(result.values == {join_out: 60, chain_outs[1]: 10})
+assert(len(result.timings) == 9)
+assert([len(level) for level in result.levels] == [4, 4, 1])
+# Results are cached for later evaluations
+assert(not join_out.dirty)
+scope.computed = []
+join_node.compute = make_compute('join',
+                                 lambda inputs: {'out': max(inputs.values())})
+assert(graph.evaluate(join_out) == 30)
+assert(scope.computed == ['join'])
+
+
+def double(inputs):
+    # Module level, so process pools can pickle it
+    return {'out': inputs['in'] * 2}
+# Picklable nodes run in the process pool, the others in this thread
+doubled = graph.create_node(label='doubled')
+doubled_in = doubled.create_parameter('in', parameter_id='in', sink=True)
+doubled_out = doubled.create_parameter('out', parameter_id='out',
+                                       source=True)
+doubled.compute = double
+doubled.compute_hints = [ramen.core.scheduler.PICKLABLE]
+join_out.connect(doubled_in)
+with ramen.core.scheduler.Scheduler(
+        graph, executor=ramen.core.scheduler.PROCESS) as scheduler:
+    result = scheduler.evaluate([doubled_out])
+assert(result.values == {doubled_out: 60})
+assert(doubled in result.timings)
+
+# A node raising cancels the nodes that haven't started
+import time
+graph.clear()
+scope.started = []
+
+
+def failing_compute(inputs):
+    scope.started.append(True)
+    time.sleep(0.05)
+    raise RuntimeError('failed')
+failing_outs = []
+for i in range(6):
+    failing = graph.create_node(label='failing')
+    failing_outs.append(failing.create_parameter('out', parameter_id='out',
+                                                 source=True))
+    failing.compute = failing_compute
+with ramen.core.scheduler.Scheduler(graph, max_workers=1) as scheduler:
+    try:
+        scheduler.evaluate(failing_outs)
+        assert(False)
+    except RuntimeError:
+        pass
+assert(len(scope.started) <= 2)
+
+# Topological order and cycle rejection
+graph.clear()
+node_a = graph.create_node(label='a')
+node_b = graph.create_node(label='b')
+node_c = graph.create_node(label='c')
+node_s = ramen.node.SubgraphNode(graph=graph, label='s')
+node_inner = ramen.node.Node(parent=node_s, label='inner')
+params = {}
+for cur_node in (node_a, node_b, node_c, node_s, node_inner):
+    params[cur_node.label] = (
+        cur_node.create_parameter('in', parameter_id='in', sink=True),
+        cur_node.create_parameter('out', parameter_id='out', source=True))
+scope.cycles = []
+graph.cycle_detected.connect(
+    lambda source, sink: scope.cycles.append((source, sink)))
+# c -> s.in -> inner -> s.out -> b -> a, with the tunnels in between
+params['c'][1].connect(params['s'][0])
+node_s.get_tunnel_parameter(params['s'][0]).connect(params['inner'][0])
+params['inner'][1].connect(node_s.get_tunnel_parameter(params['s'][1]))
+params['s'][1].connect(params['b'][0])
+params['b'][1].connect(params['a'][0])
+assert(not scope.cycles)
+order = graph.topological_order()
+assert(set(order) == set([node_a, node_b, node_c, node_inner]))
+assert(order.index(node_c) < order.index(node_inner) < order.index(node_b) <
+       order.index(node_a))
+# Closing the loop is rejected, before it's announced
+scope.connections_added = []
+graph.connection_added.connect(
+    lambda source, sink: scope.connections_added.append((source, sink)))
+params['a'][1].connect(params['c'][0])
+assert(len(scope.cycles) == 1)
+assert(params['c'][0] not in params['a'][1].connections_out)
+assert(not params['c'][0].connections_in)
+assert(not scope.connections_added)
+# ... unless cycles are allowed, in which case they're only flagged
+graph.reject_cycles = False
+params['a'][1].connect(params['c'][0])
+assert(len(scope.cycles) == 2)
+assert(params['c'][0] in params['a'][1].connections_out)
+params['a'][1].disconnect(params['c'][0])
+graph.reject_cycles = True
+# Removing an edge lets the order flip
+params['b'][1].disconnect(params['a'][0])
+params['a'][1].connect(params['b'][0])
+assert(len(scope.cycles) == 2)
+order = graph.topological_order()
+assert(order.index(node_a) < order.index(node_b))
+
+# Reachability (using the graph from the last test)
+# c -> s.in -> inner, inner -> s.out -> b, a -> b
+for index_enabled in (False, True):
+    if index_enabled:
+        graph.enable_reachability_index()
+    assert(params['c'][1].feeds(params['s'][0]))
+    assert(params['c'][1].feeds(params['inner'][0]))
+    assert(params['inner'][1].feeds(params['b'][0]))
+    assert(not params['inner'][0].feeds(params['c'][1]))
+    assert(params['inner'][0].is_transitively_connected(params['c'][1]))
+    # Connections don't go through a node's compute
+    assert(not params['c'][1].feeds(params['b'][0]))
+    assert(not params['a'][1].feeds(params['c'][0]))
+    params['c'][1].connect(params['a'][0])
+    assert(params['c'][1].feeds(params['a'][0]))
+    params['c'][1].disconnect(params['a'][0])
+    assert(not params['c'][1].feeds(params['a'][0]))
+# Removing connections and flipping flags updates the index in place
+index = graph.enable_reachability_index()
+params['c'][1].connect(params['a'][0])
+params['c'][1].connect(params['b'][0])
+params['c'][1].disconnect(params['s'][0])
+assert(not index._stale)
+assert(not params['c'][1].feeds(params['inner'][0]))
+assert(params['c'][1].feeds(params['a'][0]))
+assert(params['c'][1].feeds(params['b'][0]))
+params['c'][1].disconnect(params['b'][0])
+assert(params['c'][1].feeds(params['a'][0]))
+assert(not params['c'][1].feeds(params['b'][0]))
+assert(params['inner'][1].feeds(params['b'][0]))
+params['s'][1].source = False
+assert(not index._stale)
+assert(not params['inner'][1].feeds(params['b'][0]))
+params['s'][1].source = True
+assert(params['inner'][1].feeds(params['b'][0]))
+params['c'][1].disconnect(params['a'][0])
+params['c'][1].connect(params['s'][0])
+graph.disable_reachability_index()
+# Deleted nodes give their parameters' bits back, for new ones to reuse
+freed_graph = ramen.Graph()
+index = freed_graph.enable_reachability_index()
+a_out = freed_graph.create_node().create_parameter(source=True)
+for i in range(2):
+    extra = freed_graph.create_node()
+    a_out.connect(extra.create_parameter(sink=True))
+    assert(a_out.feeds(extra.parameters[-1]))
+    num_bits = len(index._params)
+    param_ref = weakref.ref(extra.parameters[-1])
+    extra.delete()
+    del extra
+    gc.collect()
+    assert(param_ref() is None)
+    assert(not list(a_out.iter_connections_out()))
+assert(len(index._params) == num_bits)
+
+# Saving and loading (using the graph from the last test), in both
+# encodings
+import io
+import ramen.core.serialize
+params['a'][0].value = [1, 2]
+for binary in (False, True):
+    stream = io.BytesIO()
+    ramen.core.serialize.write(graph, stream, binary=binary)
+    stream.seek(0)
+    loaded = ramen.core.serialize.read(stream)
+    assert(set(loaded._nodes) == set(graph._nodes))
+    for node_id in graph._nodes:
+        orig_node = graph[node_id]
+        loaded_node = loaded[node_id]
+        assert(type(loaded_node) is type(orig_node))
+        assert(loaded_node.label == orig_node.label)
+        if orig_node.parent is not None:
+            assert(loaded_node.parent.node_id == orig_node.parent.node_id)
+        for param in orig_node.parameters:
+            loaded_param = loaded_node[param.parameter_id]
+            assert(loaded_param.label == param.label)
+            assert((loaded_param.sink, loaded_param.source) ==
+                   (param.sink, param.source))
+            assert(loaded_param.value == param.value)
+            endpoint = ramen.core.serialize._endpoint
+            assert(sorted(map(endpoint, loaded_param.connections)) ==
+                   sorted(map(endpoint, param.connections)))
+    loaded_s = loaded[node_s.node_id]
+    loaded_inner = loaded[node_inner.node_id]
+    assert(loaded_inner['in'] in loaded_s.get_tunnel_parameter(
+        loaded_s['in']).connections_out)
+    loaded_c = loaded[node_c.node_id]
+    assert(loaded_c['out'].feeds(loaded_inner['in']))
+    assert(loaded.topological_order().index(loaded_c) <
+           loaded.topological_order().index(loaded_inner))
+# Bulk created nodes accept children like any other
+assert(not graph.create_nodes([('plain', None, 0, None)])[0].accepts_children)
+assert(graph.create_nodes([('sub', None, 0, None)],
+                          node_class=ramen.node.SubgraphNode)[0]
+       .accepts_children)
+
+# Lazily loaded subgraphs
+# root
+# |\ \  \
+# A B S1 S3 -- S1.in -> inner1 -> S1.out
+#       \
+#        S2 -- S2.in -> inner2
+# A.out -> S1.in, S1.out -> B.in
+import os
+import tempfile
+graph.clear()
+node_a = graph.create_node(label='a')
+node_b = graph.create_node(label='b')
+node_s1 = ramen.node.SubgraphNode(graph=graph, label='s1')
+node_s2 = ramen.node.SubgraphNode(parent=node_s1, label='s2')
+node_inner1 = ramen.node.Node(parent=node_s1, label='inner1')
+node_inner2 = ramen.node.Node(parent=node_s2, label='inner2')
+node_s3 = ramen.node.SubgraphNode(graph=graph, label='s3')
+params = {}
+for cur_node in (node_a, node_b, node_s1, node_s2, node_inner1,
+                 node_inner2):
+    params[cur_node.label] = (
+        cur_node.create_parameter('in', parameter_id='in', sink=True),
+        cur_node.create_parameter('out', parameter_id='out', source=True))
+params['a'][1].connect(params['s1'][0])
+node_s1.get_tunnel_parameter(params['s1'][0]).connect(params['inner1'][0])
+params['inner1'][1].connect(node_s1.get_tunnel_parameter(params['s1'][1]))
+params['s1'][1].connect(params['b'][0])
+node_s2.get_tunnel_parameter(params['s2'][0]).connect(params['inner2'][0])
+
+handle, path = tempfile.mkstemp()
+os.close(handle)
+ramen.core.serialize.save_chunked(graph, path)
+
+
+def find(nodes, label):
+    return [cur_node for cur_node in nodes if cur_node.label == label][0]
+
+
+store = ramen.core.serialize.ChunkStore(path)
+lazy = store.graph
+# Only the top level is loaded
+assert(len(lazy.nodes) == 5)
+lazy_a = find(lazy.nodes, 'a')
+lazy_b = find(lazy.nodes, 'b')
+lazy_s1 = find(lazy.nodes, 's1')
+assert(not store.is_loaded(lazy_s1))
+assert(lazy_a['out'] in lazy_s1['in'].connections_in)
+# Touching a subgraph loads its contents, but not its subgraphs'
+assert(len(lazy_s1.children) == 2)
+assert(store.is_loaded(lazy_s1))
+assert(len(lazy.nodes) == 7)
+lazy_s2 = find(lazy_s1.children, 's2')
+lazy_inner1 = find(lazy_s1.children, 'inner1')
+assert(lazy_inner1['in'] in lazy_s1.get_tunnel_parameter(
+    lazy_s1['in']).connections_out)
+assert(not store.is_loaded(lazy_s2))
+lazy_s2.ensure_loaded()
+assert(len(lazy.nodes) == 8)
+# Unloading drops the subgraph's contents, and anything evaluating through
+# it loads them again
+assert(store.unload(lazy_s1))
+assert(len(lazy.nodes) == 5)
+assert(not store.is_loaded(lazy_s1))
+lazy_a.compute = lambda inputs: {'out': 10}
+assert(lazy.evaluate(lazy_b['in']) is None)
+assert(store.is_loaded(lazy_s1))
+find(lazy_s1.children, 'inner1').compute = (
+    lambda inputs: {'out': inputs['in'] + 1})
+assert(lazy.evaluate(lazy_b['in']) == 11)
+# Changed subgraphs aren't unloaded
+find(lazy_s1.children, 'inner1').pos = (1, 1)
+assert(not store.unload(lazy_s1))
+store.close()
+# Least recently touched subgraphs are unloaded past max_loaded, unless
+# they're being touched
+store = ramen.core.serialize.ChunkStore(path, max_loaded=1)
+lazy = store.graph
+lazy_s1 = find(lazy.nodes, 's1')
+find(lazy_s1.children, 's2').ensure_loaded()
+assert(store.loaded_subgraphs == [lazy_s1, find(lazy_s1.children, 's2')])
+find(lazy.nodes, 's3').ensure_loaded()
+assert(store.loaded_subgraphs == [find(lazy.nodes, 's3')])
+assert(len(lazy.nodes) == 5)
+store.close()
+# Touching a loaded subgraph again makes it the most recently touched
+store = ramen.core.serialize.ChunkStore(path)
+lazy_s1 = find(store.graph.nodes, 's1')
+lazy_s3 = find(store.graph.nodes, 's3')
+for lazy_subgraph in (lazy_s3, lazy_s1, lazy_s3):
+    lazy_subgraph.ensure_loaded()
+assert(store.loaded_subgraphs == [lazy_s1, lazy_s3])
+store.close()
+os.remove(path)
+
+# Deleting parameters, and a subgraph parameter takes its tunnel with it
+node_s = ramen.node.SubgraphNode(graph=graph)
+param = node_s.create_parameter('x', parameter_id='x', sink=True)
+tunnel = node_s.get_tunnel_parameter(param)
+param.delete()
+assert(param not in node_s.parameters)
+assert(tunnel not in node_s.tunnel_parameters)
+assert(tunnel.node is None)
+param = node_s.create_parameter('x', parameter_id='x', sink=True)
+node_s.get_tunnel_parameter(param).delete()
+assert(param not in node_s.parameters)
+
+# Signals are only created when they're used, and lofting doesn't need
+# them
+node_a = graph.create_node()
+assert(getattr(node_a, '_pos_changed', None) is None)
+scope.moved = []
+graph.node_pos_changed.connect(lambda node, pos: scope.moved.append(node))
+node_a.pos = (1, 2)
+assert(scope.moved == [node_a])
+node_a.pos_changed.connect(lambda pos: scope.moved.append(pos))
+node_a.pos = (3, 4)
+assert(scope.moved == [node_a, (3, 4), node_a])
+
+# Weak slots don't keep their receiver alive, and disconnect when it dies
+class Receiver(object):
+    def __init__(self):
+        self.calls = []
+
+    def slot(self, value):
+        self.calls.append(value)
+signal = ramen.core.signal.Signal()
+receiver = Receiver()
+signal.connect_weak(receiver.slot)
+signal.emit(value=1)
+assert(receiver.calls == [1])
+receiver_ref = weakref.ref(receiver)
+del receiver
+assert(receiver_ref() is None)
+assert(not signal._slots)
+receiver = Receiver()
+signal.connect_weak(receiver.slot)
+signal.disconnect(receiver.slot)
+signal.emit(value=2)
+assert(receiver.calls == [])
+
+# Graphs, nodes and parameters are freed by reference counting alone
+gc.disable()
+freed_graph = ramen.Graph()
+node_a = freed_graph.create_node()
+node_b = ramen.node.SubgraphNode(graph=freed_graph)
+node_a.create_parameter(source=True).connect(
+    node_b.create_parameter(sink=True))
+freed_graph.evaluator
+freed_graph.enable_reachability_index()
+node_ref = weakref.ref(node_a)
+param_ref = weakref.ref(node_b.parameters[-1])
+del node_a, node_b
+freed_graph.clear()
+assert(node_ref() is None)
+assert(param_ref() is None)
+node_ref = weakref.ref(freed_graph.create_node())
+# Asking a child for its ancestors doesn't keep them alive
+subgraph_ref = weakref.ref(ramen.node.SubgraphNode(graph=freed_graph))
+ramen.node.Node(parent=subgraph_ref()).ancestors
+graph_ref = weakref.ref(freed_graph)
+del freed_graph
+assert(graph_ref() is None)
+assert(node_ref() is None)
+assert(subgraph_ref() is None)
+# A parameter freed while connected drops out of its peer's connections
+freed_graph = ramen.Graph()
+node_a = freed_graph.create_node()
+node_b = freed_graph.create_node()
+node_a.create_parameter(source=True).connect(
+    node_b.create_parameter(sink=True))
+b_in = node_b.parameters[-1]
+node_a.delete()
+assert(len(b_in._connections_in) == 1)
+del node_a
+assert(not b_in._connections_in and not b_in.connections_in)
+# So is a deleted subgraph parameter, which was a vertex of the topology
+node_s = ramen.node.SubgraphNode(graph=freed_graph)
+s_in = node_s.create_parameter(sink=True)
+b_in.node.create_parameter(source=True).connect(s_in)
+param_ref = weakref.ref(s_in)
+node_s.delete_parameter(s_in)
+del s_in
+assert(param_ref() is None)
+assert(list(freed_graph._topology) == [b_in.node])
+gc.enable()
+
+# Undo/redo
+import ramen.core.history
+graph.clear()
+history = ramen.core.history.History(graph)
+with history.transaction('Add nodes'):
+    node_a = graph.create_node(label='a')
+    node_s = ramen.node.SubgraphNode(graph=graph, label='s')
+    node_b = ramen.node.Node(parent=node_s, label='b')
+    param_a = node_a.create_parameter('out', parameter_id='out',
+                                      source=True)
+    param_b = node_b.create_parameter('in', parameter_id='in', sink=True)
+assert(history.undo_labels == ['Add nodes'])
+# Creating a root parameter isn't a change
+node_s.root_parameter
+assert(not history._deltas)
+
+
+def graph_state():
+    # What undo and redo should restore
+    return (sorted(repr(n) for n in graph.nodes),
+            dict((repr(n), repr(n.parent)) for n in graph.nodes),
+            dict((repr(n), (n.label, n.pos)) for n in graph.nodes),
+            dict((repr(n), sorted(repr(p) for p in n.parameters))
+                 for n in graph.nodes),
+            dict((repr(n), sorted(repr(p) for p in n.tunnel_parameters))
+                 for n in graph.nodes if n.accepts_children),
+            sorted((repr(p), repr(q)) for n in graph.nodes
+                   for p in n.parameters + getattr(n, 'tunnel_parameters', [])
+                   for q in p.connections_out))
+added_state = graph_state()
+
+# Connecting across the subgraph lofts a parameter (and tunnel) onto it
+with history.transaction('Connect'):
+    param_a.connect(param_b)
+    node_a.pos = (10, 20)
+    node_s.label = 'subgraph'
+assert(param_a.feeds(param_b))
+connected_state = graph_state()
+lofted = [p for p in node_s.parameters if p is not node_s.root_parameter]
+assert(len(lofted) == 1)
+tunnel = node_s.get_tunnel_parameter(lofted[0])
+
+assert(history.undo())
+assert(graph_state() == added_state)
+assert(not param_a.feeds(param_b))
+assert(history.redo())
+assert(graph_state() == connected_state)
+# The same lofted parameter and tunnel come back
+assert(node_s.get_tunnel_parameter(lofted[0]) is tunnel)
+assert(param_b in tunnel.connections_out)
+
+# Deleting, and undoing it
+node_b.delete()
+lofted[0].delete()
+assert(history.undo())
+assert(graph_state() == connected_state)
+assert(node_s.get_tunnel_parameter(lofted[0]) is tunnel)
+assert(param_a.feeds(param_b))
+assert(history.redo_labels == [None])
+assert(history.undo() and history.undo())
+assert(len(graph.nodes) == 1)
+assert(history.redo() and history.redo())
+assert(graph_state() == connected_state)
+
+# Rolling back
+try:
+    with history.transaction('Fail'):
+        node_a.label = 'changed'
+        node_a.delete()
+        raise ValueError
+except ValueError:
+    pass
+assert(graph_state() == connected_state)
+assert(history.undo_labels == ['Add nodes', 'Connect'])
+history.begin('Outer')
+node_a.pos = (1, 1)
+history.begin('Inner')
+node_a.pos = (2, 2)
+history.rollback()
+assert(node_a.pos == (1, 1))
+history.commit()
+assert(history.undo_labels == ['Add nodes', 'Connect', 'Outer'])
+
+# Rejected cycles aren't changes
+node_c = graph.create_node()
+node_d = graph.create_node()
+node_c.create_parameter('out', parameter_id='out', source=True).connect(
+    node_d.create_parameter('in', parameter_id='in', sink=True))
+node_d.create_parameter('out', parameter_id='out', source=True)
+node_c.create_parameter('in', parameter_id='in', sink=True)
+history.commit()
+node_d['out'].connect(node_c['in'])
+assert(not node_c['in'].connections_in)
+assert(not history._deltas)
+history.deregister_callbacks()
+
+# Diffing and patching
+import pickle
+graph_a = ramen.Graph()
+graph_a.create_nodes([('a', None, 'a', (0, 0)), ('b', None, 'b', (1, 0)),
+                      ('c', None, 'c', (2, 0))])
+sub_a = ramen.node.SubgraphNode(graph=graph_a, node_id='s', label='s')
+for node_id in ('a', 'b', 'c'):
+    graph_a[node_id].create_parameter('in', parameter_id='in', sink=True)
+    graph_a[node_id].create_parameter('out', parameter_id='out', source=True)
+graph_a['a']['out'].connect(graph_a['b']['in'])
+graph_a['b']['out'].connect(graph_a['c']['in'])
+
+stream = io.BytesIO()
+ramen.core.serialize.write(graph_a, stream, binary=True)
+stream.seek(0)
+graph_b = ramen.core.serialize.read(stream)
+assert(ramen.core.diff(graph_a, graph_b) == [])
+
+# Edit the copy: move, relabel, remove, add, rewire, change a value, and
+# put a node in the subgraph with a connection through a tunnel
+graph_b['a'].pos = (5, 5)
+graph_b['b'].label = 'B'
+graph_b['c'].delete()
+graph_b['b']['in'].value = 3
+graph_b['a']['out'].disconnect(graph_b['b']['in'])
+inner = ramen.node.Node(parent=graph_b['s'], node_id='inner')
+inner.create_parameter('in', parameter_id='in', sink=True)
+graph_b['b']['out'].connect(inner['in'])
+ramen.node.SubgraphNode(graph=graph_b, node_id='b2').delete()
+graph_b.create_node(node_id='d')
+patch = ramen.core.diff(graph_a, graph_b)
+kinds = sorted(set(edit[0] for edit in patch))
+assert(kinds == ['add_node', 'add_parameter', 'connect', 'disconnect',
+                 'remove_node', 'set_node', 'set_parameter'])
+# A patch can be sent elsewhere
+patch = pickle.loads(pickle.dumps(patch))
+scope.committed = []
+graph_a.batch_committed.connect(
+    lambda changes: scope.committed.append(changes))
+ramen.core.apply_patch(graph_a, patch)
+assert(len(scope.committed) == 1)
+assert(ramen.core.diff(graph_a, graph_b) == [])
+assert(graph_a['a'].pos == (5, 5))
+assert('c' not in graph_a)
+assert(graph_a['b']['out'].feeds(graph_a['inner']['in']))
+assert(not graph_a['a']['out'].feeds(graph_a['b']['in']))
+
+# A node changing class is replaced, and keeps its children
+graph_b['d'].delete()
+sub_d = ramen.node.SubgraphNode(graph=graph_b, node_id='d')
+graph_b['inner'].parent = sub_d
+patch = ramen.core.diff(graph_a, graph_b)
+assert(('remove_node', 'd') in patch)
+ramen.core.apply_patch(graph_a, patch)
+assert(ramen.core.diff(graph_a, graph_b) == [])
+assert(graph_a['inner'].parent is graph_a['d'])
+assert(graph_a['b']['out'].feeds(graph_a['inner']['in']))
+
+# Snapshots and forks
+# a.out -> s.in, s.in's tunnel -> inner.in, inner.out -> s.out's tunnel,
+# s.out -> b.in
+graph = ramen.Graph()
+node_a = graph.create_node(node_id='a')
+node_s = ramen.node.SubgraphNode(graph=graph, node_id='s')
+inner = ramen.node.Node(parent=node_s, node_id='inner')
+node_b = graph.create_node(node_id='b')
+a_out = node_a.create_parameter('out', parameter_id='out', source=True)
+s_in = node_s.create_parameter('in', parameter_id='in', sink=True)
+s_out = node_s.create_parameter('out', parameter_id='out', source=True)
+inner_in = inner.create_parameter('in', parameter_id='in', sink=True)
+inner_out = inner.create_parameter('out', parameter_id='out', source=True)
+b_in = node_b.create_parameter('in', parameter_id='in', sink=True)
+a_out.connect(s_in)
+node_s.get_tunnel_parameter(s_in).connect(inner_in)
+inner_out.connect(node_s.get_tunnel_parameter(s_out))
+s_out.connect(b_in)
+a_out.value = 2
+inner.compute = lambda inputs: {'out': inputs['in'] * 10}
+snapshot = graph.snapshot()
+assert(graph.snapshot() is snapshot)
+assert(len(snapshot) == len(graph.nodes))
+assert(snapshot['inner'].parent_id == 's')
+assert([state.node_id for state in snapshot.children('s')] == ['inner'])
+assert(snapshot.connections_out(('s', 'in', True)) ==
+       frozenset([('inner', 'in', False)]))
+assert(len(list(snapshot.connections())) == 4)
+assert(snapshot.evaluate(('b', 'in', False)) == 20)
+assert(snapshot.evaluate(('b', 'in', False)) == graph.evaluate(b_in))
+
+# Changing the graph leaves the snapshot as it was, and the next snapshot
+# shares the states of the nodes that didn't change
+a_out.value = 3
+node_b.label = 'b'
+new_snapshot = graph.snapshot()
+assert(snapshot.evaluate(('b', 'in', False)) == 20)
+assert(new_snapshot.evaluate(('b', 'in', False)) == 30)
+assert(new_snapshot['b'].label == 'b' and snapshot['b'].label is None)
+assert(new_snapshot['inner'] is snapshot['inner'])
+assert(new_snapshot['s'] is snapshot['s'])
+s_out.disconnect(b_in)
+node_c = graph.create_node(node_id='c')
+node_a.node_id = 'a2'
+node_a['out'].connect(node_c.create_parameter('in', parameter_id='in',
+                                              sink=True))
+snapshot = graph.snapshot()
+assert(not snapshot['b'].get_parameter('in').connections_in)
+assert('a' not in snapshot and 'a2' in snapshot)
+assert(snapshot['s'].get_parameter('in').connections_in ==
+       frozenset([('a2', 'out', False)]))
+assert(snapshot.evaluate(('c', 'in', False)) == 3)
+node_c.delete()
+assert('c' not in graph.snapshot())
+assert(graph.snapshot()['a2'].get_parameter('out').connections_out ==
+       frozenset([('s', 'in', False)]))
+
+# Forks change values, computes and connections without touching the graph
+# or the snapshot they came from
+s_out.connect(b_in)
+base = graph.snapshot()
+fork = graph.fork()
+fork.set_value(('a2', 'out', False), 4)
+assert(fork.evaluate(('b', 'in', False)) == 40)
+fork.set_compute('inner', lambda inputs: {'out': inputs['in'] + 1})
+assert(fork.evaluate(('b', 'in', False)) == 5)
+fork.disconnect(('inner', 'out', False), ('s', 'out', True))
+assert(fork.evaluate(('b', 'in', False)) is None)
+fork.connect(('inner', 'out', False), ('s', 'out', True))
+assert(fork.snapshot()['b'] is base['b'])
+assert(fork.fork().evaluate(('b', 'in', False)) == 5)
+assert(base.evaluate(('b', 'in', False)) == 30)
+assert(graph.evaluate(b_in) == 30)
+# Several sources come in source_key order, as in the graph's evaluator
+fan_node = graph.create_node(node_id='fan')
+fan_param = fan_node.create_parameter('in', parameter_id='in', sink=True)
+for node_id in ('feed_c', 'feed_e', 'feed_a', 'feed_f', 'feed_b',
+                'feed_d'):
+    feed = graph.create_node(node_id=node_id)
+    feed.create_parameter('out', parameter_id='out',
+                          source=True).connect(fan_param)
+    feed.compute = lambda inputs, node_id=node_id: {'out': node_id}
+fan_values = ['feed_%s' % letter for letter in 'abcdef']
+assert(graph.snapshot().evaluate(('fan', 'in', False)) == fan_values)
+assert(graph.fork().evaluate(('fan', 'in', False)) == fan_values)
+assert(graph.evaluate(fan_param) == fan_values)
+for node_id in fan_values:
+    graph[node_id].delete()
+fan_node.delete()
+
+# What-if evaluations in parallel threads
+import concurrent.futures
+
+
+def what_if(value):
+    variant = base.fork()
+    variant.set_value(('a2', 'out', False), value)
+    return variant.evaluate(('b', 'in', False))
+with concurrent.futures.ThreadPoolExecutor(4) as executor:
+    assert(list(executor.map(what_if, range(20))) ==
+           [value * 10 for value in range(20)])
+
+# The map behind snapshots grows its buckets, and updates share the
+# buckets they don't change
+import ramen.core.snapshot
+persistent = ramen.core.snapshot._PersistentMap()
+for i in range(1000):
+    persistent = persistent.updated({i: i})
+assert(len(persistent) == 1000 and len(persistent._buckets) > 8)
+updated = persistent.updated({5: 'five', 6: ramen.core.snapshot._REMOVED})
+assert(persistent.get(5) == 5)
+assert(updated.get(5) == 'five' and 6 not in updated and len(updated) == 999)
+shared = sum(1 for old, new in zip(persistent._buckets, updated._buckets)
+             if old is new)
+assert(shared >= len(updated._buckets) - 2)
+
+# Freezing (using the graph from the last test)
+# a2.out -> s.in, s.in's tunnel -> inner.in, inner.out -> s.out's tunnel,
+# s.out -> b.in
+frozen = graph.freeze()
+assert(frozen.num_nodes == len(graph.nodes))
+assert(frozen.num_connections == 4)
+index = frozen.index
+node_index = frozen.node_index
+assert(frozen.node_parent[node_index['inner']] == node_index['s'])
+assert(frozen.node_parent[node_index[graph.root_node.node_id]] == -1)
+assert(frozen.node_depth[node_index['inner']] == 2)
+assert(list(frozen.children(node_index['s'])) == [node_index['inner']])
+s_in_tunnel = node_s.get_tunnel_parameter(s_in)
+assert(frozen.param_partner[index(s_in)] == index(s_in_tunnel))
+assert(frozen.param_flags[index(s_in_tunnel)] ==
+       ramen.core.frozen.SOURCE | ramen.core.frozen.TUNNEL)
+assert(list(frozen.connections_out(index(s_in_tunnel))) ==
+       [index(inner_in)])
+assert(list(frozen.connections_in(index(b_in))) == [index(s_out)])
+fan_in = frozen.fan_in()
+assert(fan_in[index(inner_in)] == 1 and fan_in[index(a_out)] == 0)
+assert(sum(frozen.fan_out()) == 4)
+assert(frozen.feeds(index(a_out), index(inner_in)))
+assert(not frozen.feeds(index(inner_in), index(a_out)))
+assert(not frozen.feeds(index(a_out), index(b_in)))
+assert(frozen.feeds(index(inner_out), index(b_in)))
+assert(set(frozen.params[param] for param in
+           frozen.reachable([index(b_in)], backward=True)) ==
+       set([('s', 'out', False), ('s', 'out', True),
+            ('inner', 'out', False)]))
+
+# The graph's connection table
+# a.out -> s.in, s.in's tunnel -> inner.in, inner.out -> s.out's tunnel,
+# s.out -> b.in
+graph = ramen.Graph()
+node_a = graph.create_node(node_id='a')
+node_s = ramen.node.SubgraphNode(graph=graph, node_id='s')
+inner = ramen.node.Node(parent=node_s, node_id='inner')
+node_b = graph.create_node(node_id='b')
+a_out = node_a.create_parameter('out', parameter_id='out', source=True)
+s_in = node_s.create_parameter('in', parameter_id='in', sink=True)
+s_out = node_s.create_parameter('out', parameter_id='out', source=True)
+inner_in = inner.create_parameter('in', parameter_id='in', sink=True)
+inner_out = inner.create_parameter('out', parameter_id='out', source=True)
+b_in = node_b.create_parameter('in', parameter_id='in', sink=True)
+b_out = node_b.create_parameter('out', parameter_id='out', source=True)
+s_in_tunnel = node_s.get_tunnel_parameter(s_in)
+s_out_tunnel = node_s.get_tunnel_parameter(s_out)
+a_out.connect(s_in)
+s_in_tunnel.connect(inner_in)
+inner_out.connect(s_out_tunnel)
+s_out.connect(b_in)
+assert(len(graph.connections) == 4)
+assert((a_out, s_in) in graph.connections)
+assert(set(graph.connections_from(node_s)) ==
+       set([(s_in_tunnel, inner_in), (s_out, b_in)]))
+assert(graph.connections_to(node_b) == [(s_out, b_in)])
+assert(set(graph.connections_within(node_s)) ==
+       set([(s_in_tunnel, inner_in), (inner_out, s_out_tunnel)]))
+assert(set(graph.connections_within(graph.root_node)) ==
+       set([(a_out, s_in), (s_out, b_in)]))
+# Rejected connections never make it in
+b_out.connect(node_a.create_parameter('in', parameter_id='in', sink=True))
+assert(len(graph.connections) == 4)
+assert((b_out, node_a['in']) not in graph.connections)
+# Deleting and restoring nodes and parameters
+node_b.delete()
+assert(len(graph.connections) == 3 and not graph.connections_to(node_b))
+node_b.graph = graph
+assert(graph.connections_to(node_b) == [(s_out, b_in)])
+inner_in.delete()
+assert((s_in_tunnel, inner_in) not in graph.connections)
+inner_in.node = inner
+assert((s_in_tunnel, inner_in) in graph.connections)
+# Moving a node moves the connections out of it to the other subgraph
+node_c = graph.create_node(node_id='c')
+c_in = node_c.create_parameter('in', parameter_id='in', sink=True)
+b_out.connect(c_in)
+node_t = ramen.node.SubgraphNode(graph=graph, node_id='t')
+node_b.parent = node_t
+assert(graph.connections_within(node_t) == [(b_out, c_in)])
+b_out.disconnect(c_in)
+assert(not graph.connections_within(node_t) and
+       len(graph.connections) == 4)
+assert(len(list(ramen.core.serialize.records(graph))) ==
+       len([record for record in ramen.core.serialize.records(graph)
+            if record[0] != 'connection']) + 4)
+
+# Cached depth, ancestors, and lowest common ancestors
+graph = ramen.Graph()
+node_a = ramen.node.SubgraphNode(graph=graph, node_id='a')
+node_b = ramen.node.SubgraphNode(parent=node_a, node_id='b')
+node_c = ramen.node.Node(parent=node_b, node_id='c')
+node_d = ramen.node.Node(parent=node_a, node_id='d')
+assert(node_c.depth == 3)
+assert(node_c.ancestors == (node_b, node_a, graph.root_node))
+assert(node_c.lowest_common_ancestor(node_d) is node_a)
+assert(node_b.lowest_common_ancestor(node_c) is node_b)
+# Reparenting drops the cached depths of the whole subtree
+node_b.parent = graph.root_node
+assert(node_c.depth == 2)
+assert(node_c.ancestors == (node_b, graph.root_node))
+assert(node_c.lowest_common_ancestor(node_d) is graph.root_node)
+assert(node_c.lowest_common_ancestor(ramen.Graph().root_node) is None)
+
+# Connecting across a deep hierarchy lofts level by level, iteratively
+deep = [graph.root_node]
+for i in range(2000):
+    deep.append(ramen.node.SubgraphNode(parent=deep[-1]))
+leaf = ramen.node.Node(parent=deep[-1])
+leaf_out = leaf.create_parameter('out', parameter_id='out', source=True)
+d_in = node_d.create_parameter('in', parameter_id='in', sink=True)
+leaf_out.connect(d_in)
+assert(leaf_out.feeds(d_in))
+assert(all(len(subgraph.parameters) == 1 for subgraph in deep[1:]))
+assert(len(node_a.parameters) == 1)
+# A second connection reuses the lofted parameters
+leaf_out.connect(node_c.create_parameter('in', parameter_id='in',
+                                         sink=True))
+assert(all(len(subgraph.parameters) == 1 for subgraph in deep[1:]))
+assert(leaf_out.feeds(node_c['in']))
+
+# A tunnel lofting out of its own subgraph reuses the parameter it got the
+# first time
+s_in = node_a.parameters[0]
+s_in_tunnel = node_a.get_tunnel_parameter(s_in)
+e_in = graph.create_node(node_id='e').create_parameter(
+    'in', parameter_id='in', sink=True)
+f_in = graph.create_node(node_id='f').create_parameter(
+    'in', parameter_id='in', sink=True)
+s_in_tunnel.connect(e_in)
+s_in_tunnel.connect(f_in)
+assert(len(node_a.parameters) == 2)
+assert(s_in_tunnel.feeds(e_in) and s_in_tunnel.feeds(f_in))
+
+# Subgraphs index their tunnels by the parameters they're connected to
+graph = ramen.Graph()
+node_s = ramen.node.SubgraphNode(graph=graph, node_id='s')
+node_i = ramen.node.Node(parent=node_s, node_id='i')
+i_in = node_i.create_parameter('in', parameter_id='in', sink=True)
+i_out = node_i.create_parameter('out', parameter_id='out', source=True)
+node_o = graph.create_node(node_id='o')
+o_in = node_o.create_parameter('in', parameter_id='in', sink=True)
+o_out = node_o.create_parameter('out', parameter_id='out', source=True)
+o_out.connect(i_in)
+i_out.connect(o_in)
+s_in, s_out = sorted(node_s.parameters, key=lambda param: param.source)
+assert(node_s.get_feeding_tunnel(i_in) is node_s.get_tunnel_parameter(s_in))
+assert(node_s.get_fed_tunnel(i_out) is node_s.get_tunnel_parameter(s_out))
+assert(node_s.get_feeding_tunnel(i_out) is None)
+assert(i_in.loft_sink() is s_in and i_out.loft_source() is s_out)
+# Disconnecting drops the entry, so lofting makes a new parameter
+node_s.get_tunnel_parameter(s_in).disconnect(i_in)
+assert(node_s.get_feeding_tunnel(i_in) is None)
+assert(i_in.loft_sink() not in (None, s_in))
+# As does removing the tunnel's parameter
+node_s.delete_parameter(s_out)
+assert(node_s.get_fed_tunnel(i_out) is None)
+
+# Loaded graphs have their tunnels indexed too
+stream = io.BytesIO()
+ramen.core.serialize.write(graph, stream)
+stream.seek(0)
+loaded = ramen.core.serialize.read(stream)
+loaded_s = loaded['s']
+loaded_in = loaded['i']['in']
+assert(loaded_s.get_feeding_tunnel(loaded_in) is not None)
+assert(loaded_in.loft_sink() in loaded_s.parameters)
+
+# Connecting many pairs at once
+graph = ramen.Graph()
+deep = [graph.root_node]
+for i in range(5):
+    deep.append(ramen.node.SubgraphNode(parent=deep[-1]))
+node_a = ramen.node.Node(parent=deep[-1], node_id='a')
+a_out = node_a.create_parameter('out', parameter_id='out', source=True)
+tops = [graph.create_node().create_parameter('in', sink=True)
+        for i in range(3)]
+node_b = graph.create_node(node_id='b')
+b_in = node_b.create_parameter('in', parameter_id='in', sink=True)
+b_out = node_b.create_parameter('out', parameter_id='out', source=True)
+committed = []
+graph.batch_committed.connect(lambda changes: committed.append(changes))
+connections = graph.connect_many([(a_out, top) for top in tops] +
+                                 [(b_out, tops[0])])
+assert(len(committed) == 1)
+assert(all(a_out.feeds(top) for top in tops) and b_out.feeds(tops[0]))
+# Every pair shares the parameters lofted for the first
+assert(all(len(subgraph.parameters) == 1 for subgraph in deep[1:]))
+lofted = deep[1].parameters[0]
+assert(connections[:3] == [(lofted, top) for top in tops])
+assert(connections[3] == (b_out, tops[0]))
+assert(set(graph.connections_to(tops[0].node)) ==
+       set([(lofted, tops[0]), (b_out, tops[0])]))
+assert(deep[-1].get_fed_tunnel(a_out) is not None)
+# Connections that would make a cycle are rejected
+tops[1].node.create_parameter('out', parameter_id='out', source=True)
+assert(graph.connect_many([(tops[1].node['out'], b_in),
+                           (b_out, tops[1])]) == [(tops[1].node['out'],
+                                                   b_in), None])
+# A batch of connections big next to the graph is ordered in one go, and
+# still rejects exactly the ones that would make a cycle
+graph = ramen.Graph()
+chain = [graph.create_node(node_id=i) for i in range(10)]
+for chain_node in chain:
+    chain_node.create_parameter('in', parameter_id='in', sink=True)
+    chain_node.create_parameter('out', parameter_id='out', source=True)
+pairs = [(chain[i]['out'], chain[i + 1]['in']) for i in range(9)]
+pairs.reverse()
+assert(None not in graph.connect_many(pairs))
+order = graph.topological_order()
+assert([order.index(chain_node) for chain_node in chain] ==
+       sorted(order.index(chain_node) for chain_node in chain))
+graph = ramen.Graph()
+chain = [graph.create_node(node_id=i) for i in range(10)]
+for chain_node in chain:
+    chain_node.create_parameter('in', parameter_id='in', sink=True)
+    chain_node.create_parameter('out', parameter_id='out', source=True)
+pairs = [(chain[i]['out'], chain[i + 1]['in']) for i in range(9)]
+pairs.insert(4, (chain[9]['out'], chain[0]['in']))
+connections = graph.connect_many(pairs)
+assert(connections.count(None) == 1 and connections[-1] is None)
+# Like connecting one at a time: the last closes the cycle
+assert(chain[9]['out'].feeds(chain[0]['in']))
+assert(not chain[8]['out'].connections_out)
+
+# Flattening a subgraph collapses tunnel chains into direct edges
+import ramen.core.compile
+graph = ramen.Graph()
+node_s = ramen.node.SubgraphNode(graph=graph, node_id='s')
+node_t = ramen.node.SubgraphNode(parent=node_s, node_id='t')
+node_u = ramen.node.SubgraphNode(parent=node_t, node_id='u')
+node_a = ramen.node.Node(parent=node_u, node_id='a')
+node_b = ramen.node.Node(parent=node_s, node_id='b')
+a_in = node_a.create_parameter('in', parameter_id='in', sink=True)
+a_out = node_a.create_parameter('out', parameter_id='out', source=True)
+b_in = node_b.create_parameter('in', parameter_id='in', sink=True)
+b_out = node_b.create_parameter('out', parameter_id='out', source=True)
+s_in = node_s.create_parameter('in', parameter_id='in', sink=True)
+s_out = node_s.create_parameter('out', parameter_id='out', source=True)
+node_s.get_tunnel_parameter(s_in).connect(a_in)
+a_out.connect(b_in)
+b_out.connect(node_s.get_tunnel_parameter(s_out))
+flat = ramen.core.compile.flatten(node_s)
+assert(set(flat.nodes) == set([node_a, node_b]))
+assert(set(flat.edges()) == set([(s_in, a_in), (a_out, b_in),
+                                 (b_out, s_out)]))
+assert(flat.inputs == [s_in] and flat.outputs == [s_out])
+assert(flat.sources(b_in) == [a_out] and flat.sinks(a_out) == [b_in])
+assert(flat.dependencies(node_b) == set([node_a]))
+assert(flat.order() == [node_a, node_b])
+# The path of an edge goes through the lofted parameters and tunnels
+path = flat.path(a_out, b_in)
+assert(path[0] is a_out and path[-1] is b_in and len(path) == 6)
+assert(all(isinstance(param, ramen.node.parameter.TunnelParameter)
+           for param in path[1:-1:2]))
+assert(path[2].node is node_u and path[4].node is node_t)
+assert(flat.path(s_in, a_in)[:2] ==
+       (s_in, node_s.get_tunnel_parameter(s_in)))
+assert(flat.path(b_out, a_in) is None)
+
+# Connections changing update it
+node_c = ramen.node.Node(parent=node_t, node_id='c')
+c_in = node_c.create_parameter('in', parameter_id='in', sink=True)
+a_out.connect(c_in)
+assert(set(flat.sinks(a_out)) == set([b_in, c_in]))
+# Cutting any connection of a chain cuts its edge
+path[4].disconnect(b_in)
+assert(flat.sinks(a_out) == [c_in] and not flat.sources(b_in))
+order = flat.order()
+assert(order.index(node_a) < order.index(node_c))
+path[2].disconnect(c_in)
+assert(not flat.sources(c_in) and not flat.sinks(a_out))
+# Moving a node out of the subgraph takes its edges with it
+node_a.parent = graph.root_node
+assert(set(flat.nodes) == set([node_b, node_c]))
+assert(set(flat.edges()) == set([(b_out, s_out)]))
+
+# Generated evaluators
+graph = ramen.Graph()
+node_s = ramen.node.SubgraphNode(graph=graph, node_id='s')
+node_t = ramen.node.SubgraphNode(parent=node_s, node_id='t')
+node_a = ramen.node.Node(parent=node_t, node_id='a')
+node_b = ramen.node.Node(parent=node_s, node_id='b')
+node_c = ramen.node.Node(parent=node_s, node_id='c')
+for compute_node in (node_a, node_b, node_c):
+    compute_node.create_parameter('in', parameter_id='in', sink=True)
+    compute_node.create_parameter('out', parameter_id='out', source=True)
+s_in = node_s.create_parameter('x', parameter_id='x', sink=True)
+s_in.value = 1
+s_out = node_s.create_parameter('y', parameter_id='y', source=True)
+scope.computed = []
+
+
+def add_one(inputs):
+    scope.computed.append('a')
+    return {'out': inputs['in'] + 1}
+
+
+def double(inputs):
+    scope.computed.append('b')
+    return {'out': inputs['in'] * 2}
+
+
+node_a.compute = add_one
+node_b.compute = double
+node_c.compute = double
+node_s.get_tunnel_parameter(s_in).connect(node_a['in'])
+node_a['out'].connect(node_b['in'])
+node_b['out'].connect(node_s.get_tunnel_parameter(s_out))
+program = graph.program(node_s)
+assert(graph.program(node_s) is program)
+assert(program({'x': 3}) == {'y': 8})
+# Only what the outputs depend on is computed
+assert(scope.computed == ['a', 'b'])
+assert(program() == {'y': 4} == {'y': graph.evaluate(s_out)})
+function = program.function
+# Values are read when it's called, without regenerating
+s_in.value = 5
+assert(program() == {'y': 12} and program.function is function)
+# Structural changes regenerate it
+node_b.compute = add_one
+assert(program() == {'y': 7} and program.function is not function)
+node_a['out'].connect(node_c['in'])
+node_c['out'].connect(node_s.get_tunnel_parameter(s_out))
+assert(sorted(program({'x': 1})['y']) == [3, 4])
+node_b['in'].value = 10
+node_b['in'].connections_in.pop().disconnect(node_b['in'])
+assert(sorted(program({'x': 1})['y']) == [4, 11])
+
+# Instanced evaluation over many records
+import ramen.core.instanced
+graph = ramen.Graph()
+node_s = ramen.node.SubgraphNode(graph=graph, node_id='s')
+node_t = ramen.node.SubgraphNode(parent=node_s, node_id='t')
+node_a = ramen.node.Node(parent=node_t, node_id='a')
+node_b = ramen.node.Node(parent=node_s, node_id='b')
+for compute_node in (node_a, node_b):
+    compute_node.create_parameter('in', parameter_id='in', sink=True)
+    compute_node.create_parameter('out', parameter_id='out', source=True)
+node_b.create_parameter('k', parameter_id='k', sink=True).value = 10
+s_x = node_s.create_parameter('x', parameter_id='x', sink=True)
+s_y = node_s.create_parameter('y', parameter_id='y', source=True)
+node_s.get_tunnel_parameter(s_x).connect(node_a['in'])
+node_a['out'].connect(node_b['in'])
+node_b['out'].connect(node_s.get_tunnel_parameter(s_y))
+scope.calls = []
+
+
+def vectorized_double(inputs):
+    scope.calls.append(len(inputs['in']))
+    return {'out': ramen.core.instanced.column(
+        value * 2 for value in inputs['in'])}
+
+
+def add_k(inputs):
+    return {'out': inputs['in'] + inputs['k']}
+
+
+node_a.compute = vectorized_double
+node_a.compute_hints = [ramen.core.instanced.VECTORIZED]
+node_b.compute = add_k
+program = graph.instanced_program(node_s)
+assert(graph.instanced_program(node_s) is program)
+assert(graph.program(node_s) is not program)
+result = program({'x': list(range(10))}, batch_size=4)
+assert(list(result['y']) == [value * 2 + 10 for value in range(10)])
+# The vectorized node is called once per batch
+assert(scope.calls == [4, 4, 2])
+# Inputs not given are the parameter's value for every record
+s_x.value = 1
+assert(list(program({}, size=3)['y']) == [12, 12, 12])
+assert(list(program({'x': []})['y']) == [])
+# Hints are part of the compute, so changing them regenerates it
+node_a.compute = lambda inputs: {'out': inputs['in'] * 3}
+node_a.compute_hints = []
+assert(list(program({'x': [1, 2]})['y']) == [13, 16])
+try:
+    program({'x': [1, 2]}, batch_size=0)
+    assert(False)
+except ValueError:
+    pass
+# A sink several sources feed gets a list of them per record, or a list of
+# columns if vectorized
+graph = ramen.Graph()
+node_s = ramen.node.SubgraphNode(graph=graph, node_id='s')
+s_x = node_s.create_parameter('x', parameter_id='x', sink=True)
+s_y = node_s.create_parameter('y', parameter_id='y', source=True)
+s_z = node_s.create_parameter('z', parameter_id='z', source=True)
+fan_nodes = [ramen.node.Node(parent=node_s, node_id=node_id)
+             for node_id in 'abc']
+for fan_node in fan_nodes:
+    fan_node.create_parameter('in', parameter_id='in', sink=True)
+    fan_node.create_parameter('out', parameter_id='out', source=True)
+node_a, node_b, node_c = fan_nodes
+node_a.compute = lambda inputs: {'out': inputs['in']}
+node_b.compute = lambda inputs: {'out': inputs['in'] * 2}
+node_c.compute = lambda inputs: {'out': sum(inputs['in'])}
+for fan_node in (node_a, node_b):
+    node_s.get_tunnel_parameter(s_x).connect(fan_node['in'])
+    fan_node['out'].connect(node_c['in'])
+    fan_node['out'].connect(node_s.get_tunnel_parameter(s_z))
+node_c['out'].connect(node_s.get_tunnel_parameter(s_y))
+assert(graph.program(node_s)({'x': 3}) == {'y': 9, 'z': [3, 6]})
+program = graph.instanced_program(node_s)
+result = program({'x': [3, 4, 5]})
+assert(list(result['y']) == [9, 12, 15])
+assert([list(values) for values in result['z']] == [[3, 6], [4, 8], [5, 10]])
+
+
+def vectorized_sum(inputs):
+    return {'out': [sum(values) for values in zip(*inputs['in'])]}
+
+
+node_c.compute = vectorized_sum
+node_c.compute_hints = [ramen.core.instanced.VECTORIZED]
+assert(list(program({'x': [3, 4, 5]})['y']) == [9, 12, 15])
+# List values aren't columns, whether the records go through the
+# Program one at a time or through the nodes in columns
+node_c.compute = lambda inputs: {'out': len(inputs['in'])}
+node_c.compute_hints = []
+node_c['in'].disconnect(node_a['out'])
+node_c['in'].disconnect(node_b['out'])
+node_c['in'].value = [1, 2]
+assert(list(program({'x': [3, 4]})['y']) == [2, 2])
+assert(not program._vectorized)
+node_a.compute_hints = [ramen.core.instanced.VECTORIZED]
+assert(list(program({'x': [3, 4]})['y']) == [2, 2])
+assert(program._vectorized)